@@ -104,6 +104,9 @@ setup(
         'doc': [
             'docutils>=0.7',
             'Sphinx>=1.0.7',
+        ],
+        'numpy': [
+            'numpy',
         ]
     }
 )
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Measure the time to import the modules of `xotl.ql`.
+
+This is not part of the test suite.  Run it with::
+
+    python -m tests.benchmark_import
+
+Each module is imported in a new interpreter with ``-X importtime``.  Python
+3.5 and 3.6 don't have that option; the benchmark then measures the imports
+with an import hook which prints the same report.  The time of each import
+is the median of several runs, and the slowest modules of the last run are
+listed.
+
+'''
+
+import statistics
+import subprocess
+import sys
+
+
+MODULES = (
+    'xotl.ql.core',
+    'xotl.ql.revenge',
+    'xotl.ql.translation.py',
+)
+
+# The import hook used when the interpreter doesn't have -X importtime.  It
+# prints a line for each module after it's imported, like -X importtime.
+_IMPORTTIME = '''
+import sys
+import time
+
+
+class _Timer:
+    stack = []
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                loader = spec.loader
+                if hasattr(loader, 'exec_module') and \\
+                        not isinstance(loader, type):
+                    loader.exec_module = self.timed(name, loader.exec_module)
+                return spec
+        return None
+
+    def timed(self, name, exec_module):
+        def timed(module):
+            self.stack.append(0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                total = int((time.perf_counter() - start) * 1e6)
+                children = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += total
+                print('import time: %9d | %10d | %s%s' % (
+                    total - children, total, '  ' * len(self.stack), name
+                ), file=sys.stderr)
+        return timed
+
+
+sys.meta_path.insert(0, _Timer())
+'''
+
+
+def importtime(module):
+    '''Import `module` in a new interpreter.
+
+    Return a list of the tuples ``(self, cumulative, depth, name)`` for each
+    module imported, with the times in microseconds.  Modules imported by
+    another module have a greater `depth`.
+
+    '''
+    if sys.version_info >= (3, 7):
+        args = ['-X', 'importtime', '-c', 'import %s' % module]
+    else:
+        args = ['-c', '%s\nimport %s' % (_IMPORTTIME, module)]
+    process = subprocess.run([sys.executable] + args,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True,
+                             check=True)
+    result = []
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            own, cumulative, name = line[len('import time:'):].split('|')
+            if own.strip().isdigit():
+                depth = (len(name) - len(name.lstrip()) - 1) // 2
+                result.append((int(own), int(cumulative), depth,
+                               name.strip()))
+    return result
+
+
+def main(runs=7, slowest=10):
+    for module in MODULES:
+        times = [importtime(module) for _ in range(runs)]
+        total = statistics.median(
+            sum(cumulative for _, cumulative, depth, _ in report if not depth)
+            for report in times
+        )
+        # The namespace package 'xotl' is shared with other distributions,
+        # its time is reported apart.
+        namespace = statistics.median(
+            sum(cumulative for _, cumulative, _, name in report
+                if name == 'xotl')
+            for report in times
+        )
+        print('%s: %.1f ms (%d modules), %.1f ms without the namespace '
+              'package' % (module, total / 1000, len(times[-1]),
+                           (total - namespace) / 1000))
+        for own, _, _, name in sorted(times[-1], reverse=True)[:slowest]:
+            print('    %8.1f ms  %s' % (own / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
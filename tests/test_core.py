@@ -76,3 +76,99 @@ def test_names():
     assert 'x' not in q.locals
     assert 'global_sentinel' in q.globals
     assert '1qwwee' not in q.globals
+
+
+def test_subqueries_are_expanded_once_and_lazily():
+    q = normalize_query(y for y in (x for x in this))
+    sub = q.get_value('.0')
+    assert 'qst' not in vars(sub), 'The QST must be computed on demand'
+    assert q.get_value('.0') is sub
+    assert q.locals['.0'] is sub
+    assert dict(q.locals.items())['.0'] is sub
+    assert sub.qst == normalize_query(x for x in this).qst
+
+
+def test_only_free_names():
+    from xotl.ql.core import get_query_object, get_predicate_object
+
+    def f(a=100):
+        b = 'ignored'  # noqa
+        return get_query_object(
+            (x for x in (y for y in this if y < a) if x > global_sentinel),
+            only_free_names=True
+        )
+
+    query = f()
+    assert query.expression is None
+    assert set(query.locals) == {'.0'}
+    assert set(query.globals) == {'global_sentinel'}
+    assert query.get_value('global_sentinel') == global_sentinel
+    sub = query.get_value('.0')
+    assert sub.expression is None
+    assert set(sub.locals) == {'.0', 'a'}
+    assert sub.get_value('a') == 100
+    assert sub.get_value('.0') is this
+
+    def g(a=100):
+        b = 'ignored'  # noqa
+        return lambda y: global_sentinel < y < a
+
+    pred = get_predicate_object(g(), only_free_names=True)
+    assert set(pred.locals) == {'a'}
+    assert set(pred.globals) == {'global_sentinel'}
+
+
+def test_partitionable_query_object():
+    from xotl.ql.core import get_query_object, PartionableQueryObject
+    from xotl.ql.interfaces import PartionableQueryObject as Interface
+    query = get_query_object((x for x in this),
+                             query_type=PartionableQueryObject)
+    assert isinstance(query, Interface)
+    assert query.partition is None
+    limited = query.limit_by(10)
+    assert limited.partition == slice(None, 10, None)
+    assert limited.qst is query.qst
+    assert limited.offset(5).partition == slice(5, 15, None)
+    assert limited.offset(5).limit_by(2).partition == slice(5, 7, None)
+    assert query.offset(5).partition == slice(5, None, None)
+    assert query.partition is None
+    top = query.limit_by(3, key=len, reverse=True)
+    assert top.ordering == (len, True)
+    assert limited.ordering is None
+
+
+def test_order_by():
+    from xotl.ql.core import get_query_object
+    query = get_query_object(x for x in this)
+    assert query.ordering is None
+    assert query.order_by().ordering == (None, False)
+    assert query.order_by(len, reverse=True).ordering == (len, True)
+    assert get_query_object((x for x in this), order=len).ordering == \
+        (len, False)
+    assert get_query_object((x for x in this), order=(len, True)).ordering \
+        == (len, True)
+
+
+def test_import_is_lazy():
+    # Importing the core must not load the decompiler (nor its grammar) or
+    # the translators; they are loaded by the first query.
+    import os
+    import subprocess
+    import sys
+    code = '''if True:
+        import sys
+        from xotl.ql.core import get_query_object, this
+        lazy = ('xotl.ql.revenge.spark', 'xotl.ql.revenge.parsers',
+                'xotl.ql.revenge.scanners', 'xotl.ql.revenge.walkers',
+                'xotl.ql.translation.monads')
+        assert not any(name in sys.modules for name in lazy)
+        query = get_query_object(x for x in this)
+        assert query.qst
+        assert 'xotl.ql.revenge.parsers' in sys.modules
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [root, env.get('PYTHONPATH')])
+    )
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
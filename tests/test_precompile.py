@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+import sys
+
+import pytest
+
+from xotl.ql.precompile import main
+
+
+SOURCE = '''
+from xotl.ql.core import get_query_object, get_predicate_object, this
+
+
+def adults():
+    return get_query_object(p.name for p in this if p.age > 18)
+
+
+def older():
+    return get_predicate_object(lambda: (p for p in this if p.age > least),
+                                params=('least', ))
+
+
+def other():
+    return (x for x in this)
+'''
+
+
+@pytest.fixture
+def package(tmpdir):
+    root = tmpdir.mkdir('precompiled_queries')
+    root.join('__init__.py').write(SOURCE)
+    root.join('broken.py').write('raise RuntimeError("broken")\n')
+    sys.path.insert(0, str(tmpdir))
+    yield root
+    sys.path.remove(str(tmpdir))
+    for name in list(sys.modules):
+        if name.startswith('precompiled_queries'):
+            del sys.modules[name]
+
+
+def test_precompile(package, capsys):
+    from xotl.ql import revenge
+    from xotl.ql.revenge import get_qst, Uncompyled
+    assert main(['precompiled_queries']) == 1
+    out, err = capsys.readouterr()
+    assert 'precompiled_queries: 2 queries' in out
+    assert 'precompiled_queries.broken: cannot import' in err
+    assert 'cannot decompile' not in err
+    assert 'cannot translate' not in err
+
+    import precompiled_queries
+    directory = str(package.join('__pycache__'))
+    get_qst.cache_clear()
+    revenge._precompiled.pop(directory, None)
+    try:
+        query = precompiled_queries.adults()
+        predicate = precompiled_queries.older()
+        cache = revenge._precompiled[directory]
+        assert (cache.hits, cache.misses) == (2, 0)
+        assert query.qst == Uncompyled(query.expression).qst
+        assert predicate.qst == Uncompyled(predicate.predicate).qst
+        misses = cache.misses
+        get_qst(precompiled_queries.other().gi_code)
+        assert cache.misses == misses + 1
+        cache.close()
+    finally:
+        revenge._precompiled.pop(directory, None)
+        get_qst.cache_clear()
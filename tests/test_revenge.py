@@ -87,7 +87,7 @@ def test_scanner_normalization_single_return():
 
 
 def test_scanner_normalization():
-    from xotl.ql.revenge.scanners import InstructionSetBuilder
+    from xotl.ql.revenge.scanners import InstructionSetBuilder, label
     from xotl.ql.revenge.scanners import without_nops
 
     # The PyPy byte code for `a if b else c`:
@@ -130,15 +130,14 @@ def test_scanner_normalization():
                     argval='x', argrepr='x',
                     starts_line=1),
         Instruction(opname='POP_JUMP_IF_FALSE',
-                    arg=10, argval=10, argrepr='',
-                    starts_line=None),
+                    arg=label('else'), starts_line=None),
         Instruction(opname='LOAD_NAME', arg=1,
                     argval='a', argrepr='a',
                     starts_line=None),
         Instruction(opname='RETURN_VALUE',
                     arg=None, argval=None, argrepr='',
                     starts_line=None),
-        Instruction(opname='LOAD_NAME', arg=2,
+        Instruction(label='else', opname='LOAD_NAME', arg=2,
                     argval='y', argrepr='y',
                     starts_line=None),
         Instruction(opname='RETURN_VALUE', arg=None,
@@ -148,14 +147,13 @@ def test_scanner_normalization():
     assert res == expected
 
 
-@pytest.mark.xfail(_py_version >= (3, 6),
-                   reason='Non-critical for Python 3.6')
 def test_pypy_normalization():
     from xotl.ql.revenge.scanners import Instruction, LOAD_NAME
     from xotl.ql.revenge.scanners import POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE
     from xotl.ql.revenge.scanners import RETURN_VALUE, JUMP_FORWARD
-    from xotl.ql.revenge.scanners import JUMP_ABSOLUTE, NOP
+    from xotl.ql.revenge.scanners import JUMP_ABSOLUTE
     from xotl.ql.revenge.scanners import normalize_pypy_conditional
+    from xotl.ql.revenge.scanners import InstructionSetBuilder, label
 
     # The PyPy byte code for `a if b else c`:
     pypy_program = [
@@ -180,34 +178,17 @@ def test_pypy_normalization():
                     offset=15, starts_line=None, is_jump_target=True)
     ]
 
-    modified_pypy_program = [
-        Instruction(opname='LOAD_NAME', opcode=LOAD_NAME,
-                    arg=0, argval='x', argrepr='x',
-                    offset=0, starts_line=1, is_jump_target=False),
-        Instruction(opname='POP_JUMP_IF_FALSE', opcode=POP_JUMP_IF_FALSE,
-                    arg=12, argval=12, argrepr='', offset=3,
-                    starts_line=None, is_jump_target=False),
-        Instruction(opname='LOAD_NAME', opcode=LOAD_NAME, arg=1,
-                    argval='a', argrepr='a', offset=6,
-                    starts_line=None, is_jump_target=False),
-
-        Instruction(opname='RETURN_VALUE', opcode=RETURN_VALUE, arg=None,
-                    argval=None, argrepr='', offset=9,
-                    starts_line=None, is_jump_target=False),
-        Instruction(opname='NOP', opcode=NOP, arg=None,
-                    argval=None, argrepr='', offset=10,
-                    starts_line=None, is_jump_target=False),
-        Instruction(opname='NOP', opcode=NOP, arg=None,
-                    argval=None, argrepr='', offset=11,
-                    starts_line=None, is_jump_target=False),
-
-        Instruction(opname='LOAD_NAME', opcode=LOAD_NAME,
-                    arg=2, argval='y', argrepr='y', offset=12,
-                    starts_line=None, is_jump_target=True),
-        Instruction(opname='RETURN_VALUE', opcode=RETURN_VALUE,
-                    arg=None, argval=None, argrepr='',
-                    offset=15, starts_line=None, is_jump_target=True)
-    ]
+    builder = InstructionSetBuilder()
+    with builder() as Instr:
+        Instr(opname='LOAD_NAME', arg=0, argval='x', argrepr='x',
+              starts_line=1)
+        Instr(opname='POP_JUMP_IF_FALSE', arg=label('else'))
+        Instr(opname='LOAD_NAME', arg=1, argval='a', argrepr='a')
+        Instr(opname='RETURN_VALUE', arg=None, argval=None, argrepr='')
+        Instr(label='else',
+              opname='LOAD_NAME', arg=2, argval='y', argrepr='y')
+        Instr(opname='RETURN_VALUE', arg=None, argval=None, argrepr='')
+    modified_pypy_program = list(builder)
 
     res = list(normalize_pypy_conditional(pypy_program))
     assert modified_pypy_program == res
@@ -260,34 +241,17 @@ def test_pypy_normalization():
                     offset=15, starts_line=None, is_jump_target=True)
     ]
 
-    modified_pypy_program = [
-        Instruction(opname='LOAD_NAME', opcode=LOAD_NAME,
-                    arg=0, argval='b', argrepr='b',
-                    offset=0, starts_line=1, is_jump_target=False),
-        Instruction(opname='POP_JUMP_IF_TRUE', opcode=POP_JUMP_IF_TRUE,
-                    arg=12, argval=12, argrepr='', offset=3,
-                    starts_line=None, is_jump_target=False),
-        Instruction(opname='LOAD_NAME', opcode=LOAD_NAME, arg=1,
-                    argval='a', argrepr='a', offset=6,
-                    starts_line=None, is_jump_target=False),
-
-        Instruction(opname='RETURN_VALUE', opcode=RETURN_VALUE, arg=None,
-                    argval=None, argrepr='', offset=9,
-                    starts_line=None, is_jump_target=False),
-        Instruction(opname='NOP', opcode=NOP, arg=None,
-                    argval=None, argrepr='', offset=10,
-                    starts_line=None, is_jump_target=False),
-        Instruction(opname='NOP', opcode=NOP, arg=None,
-                    argval=None, argrepr='', offset=11,
-                    starts_line=None, is_jump_target=False),
-
-        Instruction(opname='LOAD_NAME', opcode=LOAD_NAME,
-                    arg=2, argval='c', argrepr='c', offset=12,
-                    starts_line=None, is_jump_target=True),
-        Instruction(opname='RETURN_VALUE', opcode=RETURN_VALUE,
-                    arg=None, argval=None, argrepr='',
-                    offset=15, starts_line=None, is_jump_target=True)
-    ]
+    builder = InstructionSetBuilder()
+    with builder() as Instr:
+        Instr(opname='LOAD_NAME', arg=0, argval='b', argrepr='b',
+              starts_line=1)
+        Instr(opname='POP_JUMP_IF_TRUE', arg=label('else'))
+        Instr(opname='LOAD_NAME', arg=1, argval='a', argrepr='a')
+        Instr(opname='RETURN_VALUE', arg=None, argval=None, argrepr='')
+        Instr(label='else',
+              opname='LOAD_NAME', arg=2, argval='c', argrepr='c')
+        Instr(opname='RETURN_VALUE', arg=None, argval=None, argrepr='')
+    modified_pypy_program = list(builder)
 
     res = list(normalize_pypy_conditional(pypy_program))
     assert modified_pypy_program == res
@@ -326,6 +290,44 @@ def test_real_pypy_normalization():
     assert instructions == expected_program
 
 
+def test_fused_normalization():
+    from xotl.ql.revenge.scanners import InstructionSetBuilder, label
+    from xotl.ql.revenge.scanners import Normalizer, single_return_pass
+    from xotl.ql.revenge.scanners import Instruction as BaseInstruction
+    from xotl.ql.revenge.scanners import getscanner
+
+    normalizer = Normalizer(single_return_pass)
+
+    @normalizer.register
+    def without_a(instructions):
+        # Replace the load of 'a' with a NOP, the relocation step must remove
+        # it and update the jumps.
+        return [
+            BaseInstruction(opname='NOP', arg=None, offset=i.offset)
+            if i.argval == 'a' else i
+            for i in instructions
+        ]
+
+    builder = InstructionSetBuilder()
+    with builder() as Instruction:
+        Instruction(opname='LOAD_NAME', arg=0, argval='x', argrepr='x',
+                    starts_line=1)
+        Instruction(opname='POP_JUMP_IF_FALSE', arg=label('else y'))
+        Instruction(opname='JUMP_FORWARD', arg=label('return'))
+        Instruction(label='else y',
+                    opname='LOAD_NAME', arg=2, argval='y', argrepr='y')
+        Instruction(label='return',
+                    opname='RETURN_VALUE', arg=None, argval=None, argrepr='')
+    expected_program = list(builder)
+    scanner = getscanner()
+    tokens, customize = scanner.disassemble(
+        compile('a if x else y', '', 'eval'),
+        normalize=normalizer
+    )
+    instructions = [token.instruction for token in tokens if token.instruction]
+    assert instructions == expected_program
+
+
 def test_conditional_a_la_pypy():
     from xotl.ql import qst
     # >>> dis.dis(compile('x and a or y', '', 'eval'))
@@ -699,3 +701,64 @@ def test_regression_listcomp_as_elt():
     q = get_query_object([child for child in parent.children]
                          for parent in this)
     assert isinstance(q.qst.body.elt, ast.ListComp)
+
+
+def test_inner_functions_are_decompiled_once():
+    from xotl.ql.revenge import Uncompyled, get_qst
+    this = iter([])
+
+    def query():
+        return (sorted(y, key=lambda x: x.age) for y in this)
+
+    first = Uncompyled(query()).qst
+    before = get_qst.cache_info()
+    second = Uncompyled(query()).qst
+    after = get_qst.cache_info()
+    assert after.hits > before.hits
+    assert after.misses == before.misses
+    assert first == second
+
+    # Each caller gets its own copy of the QST.
+    code = next(c for c in query().gi_code.co_consts
+                if getattr(c, 'co_name', None) == '<lambda>')
+    assert get_qst(code, islambda=True) == get_qst(code, islambda=True)
+    assert get_qst(code, islambda=True) is not get_qst(code, islambda=True)
+
+
+def test_qst_disk_cache(tmpdir):
+    from xotl.ql.core import this
+    from xotl.ql.revenge import Uncompyled, get_qst, set_qst_cache
+    from xotl.ql.revenge.cache import QSTCache
+
+    def queries():
+        return [
+            (x.age for x in this if x.name in ('a', 'b')),
+            (y.age for y in this if y.name in ('a', 'b')),
+        ]
+
+    first, second = (q.gi_code for q in queries())
+    cache = QSTCache(str(tmpdir))
+    assert cache.get(first) is None
+    qst = Uncompyled(first).qst
+    cache.put(first, qst)
+    assert cache.get(first) == qst
+    assert cache.get(second) is None
+
+    # Another process (another cache) reads the same file.
+    other = QSTCache(str(tmpdir))
+    previous = set_qst_cache(other)
+    try:
+        get_qst.cache_clear()
+        assert get_qst(first) == qst
+        assert get_qst(second) == Uncompyled(second).qst
+        assert (other.hits, other.misses) == (1, 1)
+        get_qst.cache_clear()
+        assert get_qst(second) == Uncompyled(second).qst
+        assert other.hits == 2
+        assert cache.get(second) is not None
+    finally:
+        set_qst_cache(previous)
+        get_qst.cache_clear()
+    cache.clear()
+    assert cache.get(first) is None
+    cache.close()
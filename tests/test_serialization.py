@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+import ast
+import pickle
+
+import pytest
+
+from xotl.ql.core import (
+    this,
+    get_query_object,
+    get_predicate_object,
+    PartionableQueryObject,
+)
+from xotl.ql.revenge.qst import parse
+from xotl.ql.serialization import dumps, loads, dump_qst, load_qst
+from xotl.ql.translation.aggregates import count
+from xotl.ql.translation.py import NaivePythonExecutionPlan
+
+
+numbers = [1, 2, 3, 4, 5]
+
+
+def run(query, **kwargs):
+    return list(NaivePythonExecutionPlan(query)(**kwargs))
+
+
+def test_qst_roundtrip():
+    tree = parse("((x, -1.5, b'a', 'b', 1j, None) for x in this "
+                 "if x > 10 ** 30 and x not in (1, 2) and not x.y[1:2])")
+    data = dump_qst(tree)
+    assert load_qst(data) == tree
+    assert len(data) < len(ast.dump(tree))
+
+    with pytest.raises(ValueError):
+        load_qst(data[:-1])
+    with pytest.raises(ValueError):
+        loads(b'XQL\xff')
+    with pytest.raises(ValueError):
+        loads(b'not a query')
+
+
+def test_query_roundtrip():
+    def make():
+        return get_query_object(
+            ((x, y) for x in numbers for y in numbers if x < y
+             if y > least),
+            query_type=PartionableQueryObject,
+            params=('least', ),
+            order=lambda r, factor=-1: r[0] * factor,
+        )
+
+    query = loads(dumps(make()))
+    assert type(query) is PartionableQueryObject
+    assert query.params == ('least', )
+    assert query.expression is None
+    assert run(query, least=3) == run(make(), least=3)
+
+    query = pickle.loads(pickle.dumps(make().bind(least=3).limit_by(2)))
+    assert run(query) == [(4, 5), (3, 4)]
+
+    query = loads(dumps(get_predicate_object(
+        lambda: count(x for x in (y for y in numbers if y > 2))
+    )))
+    assert NaivePythonExecutionPlan(query)() == 3
+    assert loads(dumps(get_query_object(x for x in this))).locals['.0'] \
+        is this
+
+
+def _generate():
+    yield from numbers
+
+
+def test_copies_dont_serialize():
+    import copy
+    query = get_query_object(x for x in _generate() if x > 2)
+    shallow = copy.copy(query)
+    assert shallow.qst is query.qst
+    assert shallow.locals is query.locals
+    deep = copy.deepcopy(query)
+    assert deep.qst == query.qst and deep.qst is not query.qst
+    assert deep.expression is query.expression
+    assert run(deep) == [3, 4, 5]
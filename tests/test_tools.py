@@ -67,3 +67,8 @@ def _obvious_findlast(lst, which):
         if lst[i] == which:
             return i
     raise ValueError
+
+
+def test_freenames_detection_3():
+    assert detect_names('{k: v for k, v in this if p(k)}') == {'this', 'p'}
+    assert detect_names('lambda *args, **kwargs: f(args, kwargs)') == {'f'}
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Compare the columnar plan with the Python plans over 10^7 rows.
+
+This is not part of the test suite, and it requires NumPy.  Run it with::
+
+    python -m tests.translation.benchmark_columnar
+
+The Python plans run over a list of objects with the same data; they're only
+run over the first `python_size` rows (and the time is extrapolated) since
+they're much slower.
+
+'''
+
+import timeit
+from types import SimpleNamespace
+
+import numpy
+
+from xotl.ql.core import get_query_object, get_predicate_object
+from xotl.ql.translation.columnar import Columns, ColumnarExecutionPlan
+from xotl.ql.translation.py import GeneratorPythonExecutionPlan
+
+
+def get_queries(sales):
+    '''Get the queries to benchmark over the `sales`.
+
+    Return pairs of names and functions that build the query.
+
+    '''
+    return [
+        ('filter', lambda: get_query_object(
+            r.price for r in sales if r.quantity > 50 and r.price < 10
+        )),
+        ('projection', lambda: get_query_object(
+            (r.price * r.quantity, r.quantity % 7) for r in sales
+        )),
+        ('aggregate', lambda: get_predicate_object(
+            lambda: sum(r.price * r.quantity for r in sales
+                        if r.quantity > 50)
+        )),
+        ('fallback', lambda: get_query_object(
+            round(r.price) for r in sales if r.quantity > 98
+        )),
+    ]
+
+
+def run(plan):
+    result = plan()
+    return result if isinstance(result, (int, float)) else list(result)
+
+
+def main(size=10 ** 7, python_size=10 ** 5, number=1):
+    random = numpy.random.RandomState(0)
+    columns = Columns({
+        'price': random.uniform(0, 100, size),
+        'quantity': random.randint(0, 100, size),
+    })
+    objects = [
+        SimpleNamespace(price=price, quantity=quantity)
+        for price, quantity in zip(
+            columns.arrays['price'][:python_size].tolist(),
+            columns.arrays['quantity'][:python_size].tolist()
+        )
+    ]
+    benchmarks = zip(get_queries(columns), get_queries(objects))
+    for (name, build), (_, build_python) in benchmarks:
+        time = min(timeit.repeat(
+            lambda: run(ColumnarExecutionPlan(build())),
+            number=number, repeat=3
+        ))
+        python = min(timeit.repeat(
+            lambda: run(GeneratorPythonExecutionPlan(build_python())),
+            number=number, repeat=3
+        )) * size / python_size
+        print('%-12s %10.2f ms  python %10.2f ms  x%.1f' % (
+            name, time / number * 1000, python / number * 1000,
+            python / time
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Compare the execution plans of the `xotl.ql.translation.py` module.
+
+This is not part of the test suite.  Run it with::
+
+    python -m tests.translation.benchmark_py
+
+The last benchmark runs a CPU-bound query with an increasing number of
+processes (see `xotl.ql.translation.parallel`:mod:).
+
+'''
+
+import timeit
+from functools import partial
+
+from xotl.ql.core import get_query_object
+from xotl.ql.translation.py import (
+    NaivePythonExecutionPlan,
+    GeneratorPythonExecutionPlan,
+)
+from xotl.ql.translation.parallel import ProcessPool
+
+
+PLANS = (
+    ('NaivePythonExecutionPlan', NaivePythonExecutionPlan),
+    ('batch_size=1000', partial(NaivePythonExecutionPlan, batch_size=1000)),
+    ('GeneratorPythonExecutionPlan', GeneratorPythonExecutionPlan),
+)
+
+
+def get_queries(size):
+    '''Get the queries to benchmark over collections of `size` items.
+
+    Return pairs of names and functions that build the query.  The outermost
+    iterable of a generator expression is consumed by running the query, so
+    we need a new query object for each run.
+
+    '''
+    numbers = list(range(size))
+    small = list(range(size // 10000 or 1))
+    return [
+        ('filter', lambda: get_query_object(
+            x for x in numbers if x % 3 == 0
+        )),
+        ('projection', lambda: get_query_object(
+            (x, x * x) for x in numbers
+        )),
+        ('nested', lambda: get_query_object(
+            (x, y) for x in numbers if x % 2 for y in small if y < x
+        )),
+    ]
+
+
+def is_prime(n):
+    # Deliberately slow.
+    return n > 1 and all(n % d for d in range(2, n))
+
+
+def parallel(size=20000, number=1):
+    numbers = list(range(size))
+    serial = None
+    for processes in (None, 1, 2, 4, 8):
+        pool = ProcessPool(processes, chunksize=500) if processes else None
+        time = min(timeit.repeat(
+            lambda: list(GeneratorPythonExecutionPlan(
+                get_query_object(x for x in numbers if is_prime(x)),
+                parallel=pool
+            )()),
+            number=number, repeat=3
+        ))
+        serial = serial or time
+        print('%-12s %-32s %8.2f ms  x%.2f' % (
+            'cpu-bound',
+            '%s processes' % processes if processes else 'serial',
+            time / number * 1000,
+            serial / time
+        ))
+
+
+def main(size=100000, number=10):
+    for name, build in get_queries(size):
+        for plan_name, Plan in PLANS:
+            time = min(timeit.repeat(lambda: list(Plan(build())()),
+                                     number=number, repeat=3))
+            print('%-12s %-32s %8.2f ms' % (name, plan_name,
+                                            time / number * 1000))
+    parallel()
+
+
+if __name__ == '__main__':
+    main()
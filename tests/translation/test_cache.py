@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+import pytest
+
+from xotl.ql.core import get_predicate_object
+from xotl.ql.translation.py import NaivePythonExecutionPlan
+from xotl.ql.translation.cache import ResultCache
+
+
+numbers = [1, 2, 3, 4, 5, 6]
+others = [10, 20]
+
+
+runs = []
+
+
+def _track(x):
+    runs.append(x)
+    return x
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hits_and_invalidation(capsys):
+    cache = ResultCache()
+    query = get_predicate_object(
+        lambda: (_track(x) for x in numbers if x > least),
+        params=('least', )
+    )
+    plan = cache(NaivePythonExecutionPlan(query.bind(least=3)))
+    del runs[:]
+    assert list(plan()) == [4, 5, 6]
+    assert list(plan()) == [4, 5, 6]
+    assert runs == [4, 5, 6]
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.size) == (1, 1, 1)
+    assert info.memory > 0
+
+    # The same query structure from another plan hits the cache, other
+    # values of the free names don't.
+    other = cache(NaivePythonExecutionPlan(query))
+    assert list(other(least=3)) == [4, 5, 6]
+    assert list(other(least=5)) == [6]
+    assert cache.cache_info().hits == 2
+
+    # Changes in the sources are seen after the invalidation.
+    numbers.append(7)
+    try:
+        assert list(plan()) == [4, 5, 6]
+        cache.invalidate(others)
+        assert list(plan()) == [4, 5, 6]
+        cache.invalidate(numbers)
+        assert list(plan()) == [4, 5, 6, 7]
+    finally:
+        numbers.pop()
+    assert cache.cache_info().invalidations == 2
+
+    # Aggregates and groups are cached too.
+    plan = cache(NaivePythonExecutionPlan(get_predicate_object(
+        lambda: sum(x for x in numbers), groups=lambda x: x % 2
+    )))
+    assert plan() == {0: 12, 1: 9}
+    plan()[0] = 0
+    assert plan() == {0: 12, 1: 9}
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'CacheInfo(hits=' in out
+
+    cache.invalidate()
+    assert cache.cache_info().size == 0
+
+
+def test_query_expressions():
+    from xotl.ql.core import get_query_object
+    cache = ResultCache()
+    least = 4
+    plan = cache(NaivePythonExecutionPlan(
+        get_query_object(x for x in numbers if x > least)
+    ))
+    assert list(plan()) == [5, 6]
+    numbers.append(9)
+    try:
+        assert list(plan()) == [5, 6]
+        cache.invalidate(numbers)
+        assert list(plan()) == [5, 6, 9]
+    finally:
+        numbers.pop()
+
+    # Iterators that are consumed by the query are not cached.
+    def generate():
+        yield from numbers
+
+    plan = cache(NaivePythonExecutionPlan(
+        get_query_object(x for x in generate() if x > least)
+    ))
+    size = cache.cache_info().size
+    assert list(plan()) == [5, 6]
+    assert cache.cache_info().size == size
+
+
+def test_eviction():
+    clock = Clock()
+    cache = ResultCache(maxsize=2, ttl=10, timer=clock)
+
+    plan = cache(NaivePythonExecutionPlan(get_predicate_object(
+        lambda: (x for x in numbers if x < limit), params=('limit', )
+    )))
+    for value in (2, 3, 2, 4):
+        list(plan(limit=value))
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.size) == \
+        (1, 3, 1, 2)
+    list(plan(limit=3))
+    assert cache.cache_info().misses == 4
+
+    clock.now = 100
+    list(plan(limit=4))
+    assert cache.cache_info().misses == 5
+    with pytest.raises(ValueError):
+        ResultCache(maxsize=0)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from xotl.ql.core import get_query_object, get_predicate_object  # noqa
+from xotl.ql.translation import TranslationError  # noqa
+from xotl.ql.translation.aggregates import count, avg  # noqa
+from xotl.ql.translation.columnar import Columns, ColumnarExecutionPlan  # noqa
+
+
+sales = Columns({
+    'code': ['a', 'b', 'c', 'd'],
+    'price': numpy.array([1.0, 2.5, 3.0, 10.0]),
+    'quantity': numpy.array([5, 20, 11, 1]),
+})
+
+
+def test_vectorized_plans(capsys):
+    least = 10
+    query = get_query_object(r.price * r.quantity for r in sales
+                             if r.quantity > least)
+    plan = ColumnarExecutionPlan(query)
+    assert list(plan()) == [50.0, 33.0]
+    assert list(ColumnarExecutionPlan(query.bind(least=1))()) == \
+        [5.0, 50.0, 33.0]
+
+    plan = ColumnarExecutionPlan(get_query_object(
+        (r.code, abs(r.quantity - 10), 1 if r.price > 2 else 0)
+        for r in sales if r.code in ('a', 'c') or not 2 < r.price < 20
+    ))
+    assert list(plan()) == [('a', 5, 0), ('c', 1, 1)]
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'row by row' not in out
+
+    records = numpy.array([(1, 2.0), (2, 4.0)],
+                          dtype=[('id', int), ('price', float)])
+    plan = ColumnarExecutionPlan(get_query_object(
+        r for r in Columns(records) if numpy.sqrt(r.price) > 1.5
+    ))
+    assert [(r.id, r.price) for r in plan()] == [(2, 4.0)]
+
+    with pytest.raises(TranslationError):
+        ColumnarExecutionPlan(get_query_object(
+            (r, s) for r in sales for s in sales
+        ))
+    with pytest.raises(TranslationError):
+        ColumnarExecutionPlan(get_query_object(
+            r for r in [1, 2]
+        ))()
+
+
+def test_row_by_row_fallback(capsys):
+    plan = ColumnarExecutionPlan(get_query_object(
+        r.code.upper() for r in sales
+        if r.quantity > 2 and not r.code.startswith('b')
+    ))
+    assert list(plan()) == ['A', 'C']
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'r.quantity > 2 (vectorized)' in out
+    assert 'r.code.upper() (1 row by row)' in out
+
+    # Guarded expressions are evaluated only where the guard holds
+    names = Columns({'name': numpy.array(['a', None, 'c'], dtype=object),
+                     'size': numpy.array([1, 0, 2])})
+    plan = ColumnarExecutionPlan(get_query_object(
+        (r.name.upper() if r.name is not None else '', r.size > 0 and
+         len(r.name)) for r in names
+    ))
+    assert list(plan()) == [('A', 1), ('', False), ('C', 1)]
+    plan = ColumnarExecutionPlan(get_query_object(
+        r.size for r in names if r.name is None or r.name.islower()
+    ))
+    assert list(plan()) == [1, 0, 2]
+
+    # Conditions are evaluated in order, only for the rows matching the
+    # previous ones.
+    values = Columns({'a': numpy.array([None, 1, 5, None, 7], dtype=object)})
+    plan = ColumnarExecutionPlan(get_query_object(
+        r.a for r in values if r.a is not None and r.a > 3
+    ))
+    assert list(plan()) == [5, 7]
+    plan = ColumnarExecutionPlan(get_query_object(
+        r.a for r in values if r.a is not None if r.a > 3
+    ))
+    assert list(plan()) == [5, 7]
+    plan = ColumnarExecutionPlan(get_query_object(
+        r.a for r in values if r.a is not None and str(r.a) != '1' and r.a > 3
+    ))
+    assert list(plan()) == [5, 7]
+
+
+def test_partitions_and_aggregates():
+    from xotl.ql.core import PartionableQueryObject
+    query = get_query_object((r.code for r in sales),
+                             query_type=PartionableQueryObject)
+    assert list(ColumnarExecutionPlan(query.limit_by(2).offset(1))()) == \
+        ['b', 'c']
+    plan = ColumnarExecutionPlan(
+        query.order_by(lambda code: code, reverse=True).limit_by(2)
+    )
+    assert list(plan()) == ['d', 'c']
+
+    def aggregate(function):
+        return ColumnarExecutionPlan(get_predicate_object(function))()
+
+    assert aggregate(lambda: count(r for r in sales if r.price > 2)) == 3
+    assert aggregate(lambda: sum(r.quantity for r in sales)) == 37
+    assert aggregate(lambda: avg(r.price for r in sales)) == 4.125
+    assert aggregate(lambda: max(r.code for r in sales)) == 'd'
+    assert aggregate(lambda: any(r.quantity > 19 for r in sales)) is True
+    assert aggregate(lambda: sum(r.quantity for r in sales
+                                 if r.price > 100)) == 0
+    with pytest.raises(ValueError):
+        aggregate(lambda: min(r.quantity for r in sales if r.price > 100))
+    with pytest.raises(TranslationError):
+        ColumnarExecutionPlan(get_predicate_object(
+            lambda: sum(r.quantity for r in sales), groups=lambda r: r.code
+        ))
@@ -181,3 +181,760 @@ def test_itertools_with_this():
     )
     result = set(enumerated)
     assert result
+
+
+def test_query_templates():
+    from xotl.ql.core import get_query_object
+    min_age = 0
+    query = get_query_object(
+        (who for who in Person if who.age > min_age),
+        params=('min_age', )
+    )
+    plan = translate(query)
+    elders = set(plan(min_age=60))
+    assert elsa in elders and papi in elders
+    assert manu not in elders
+    assert set(plan(min_age=30)) > elders
+    assert manolito in set(plan())   # falls back to the frame's value
+
+    with pytest.raises(TypeError):
+        plan(max_age=10)
+
+    # Binding values without a translator
+    bound = query.bind(min_age=60)
+    assert bound.qst is query.qst
+    assert bound.params == ()
+    assert bound.get_value('min_age') == 60
+    assert query.get_value('min_age') == 0
+    assert set(translate(bound)) == elders
+
+    # Parameters reach sub-queries
+    query = get_query_object(
+        (who for who in (x for x in this
+                         if isinstance(x, Person) and x.age > min_age)),
+        params=('min_age', )
+    )
+    plan = translate(query)
+    assert set(plan(min_age=60)) == elders
+
+
+def test_query_templates_are_reusable():
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import TranslationError
+    limit = 0
+    query = get_query_object((x for x in range(6) if x > limit),
+                             params=('limit', ))
+    plan = translate(query)
+    assert list(plan(limit=3)) == [4, 5]
+    assert list(plan(limit=1)) == [2, 3, 4, 5]
+    assert list(translate(query.bind(limit=4))) == [5]
+
+    def numbers():
+        yield from range(6)
+
+    query = get_query_object((x for x in numbers() if x > limit),
+                             params=('limit', ))
+    plan = translate(query)
+    assert list(plan(limit=3)) == [4, 5]
+    with pytest.raises(TranslationError):
+        plan(limit=1)
+
+
+def test_generator_plan(capsys):
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation.py import GeneratorPythonExecutionPlan
+    min_age = 0
+    queries = [
+        (who for who in Person if who.age > 30),
+        ((parent, child)
+         for parent in Person
+         if parent.children
+         for child in parent.children
+         if child.age < 40),
+        (who.name
+         for who in (x for x in this if isinstance(x, Person))
+         if any(child.age > 30 for child in who.children)),
+        (who for who in Person if who.name[:6] == 'Manuel'),
+    ]
+    for query in queries:
+        plan = GeneratorPythonExecutionPlan(query)
+        assert list(plan()) == list(translate(query)())
+        assert list(plan()) == list(plan), 'Plan should be reusable'
+
+    query = get_query_object(
+        (who for who in Person if who.age > min_age),
+        params=('min_age', )
+    )
+    plan = GeneratorPythonExecutionPlan(query)
+    assert set(plan(min_age=60)) == {elsa, papi}
+
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'Generator plan' in out
+    assert '    for who in %s(.0):' % plan.iter in out
+    assert '        if who.age > min_age:' in out
+    assert '            yield who' in out
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_hash_joins(Plan, capsys):
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import py
+    from xotl.ql.translation.optimizations import HashJoin, NestedLoop
+    Plan = getattr(py, Plan)
+    cities = [dict(id=i, name='city%d' % i) for i in range(5)]
+    cities.append(dict(id=[1], name='unhashable'))
+    people = [dict(name='person%d' % i, city=i % 7) for i in range(20)]
+    people.append(dict(name='weird', city=[1]))
+
+    def query():
+        return get_query_object(
+            (p['name'], c['name'])
+            for p in people
+            for c in cities
+            if c['name'] != 'city0'
+            if p['city'] == c['id']
+        )
+
+    plan = Plan(query())
+    assert [type(strategy) for strategy in plan.strategies] == [NestedLoop,
+                                                                HashJoin]
+    result = list(plan())
+    assert result == list(Plan(query(), optimize=False)())
+    assert ('weird', 'unhashable') in result
+    assert ('person1', 'city1') in result
+    assert not any(city == 'city0' for _, city in result)
+
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert ("for c in cities if c['name'] != 'city0': "
+            "hash join by c['id'] == p['city']") in out
+
+    # The collection depends on the previous generator: no join.
+    plan = Plan(
+        (parent, child)
+        for parent in Person
+        for child in parent.children
+        if child.mother == parent
+    )
+    assert not any(isinstance(strategy, HashJoin)
+                   for strategy in plan.strategies)
+    assert (elsa, manu) in set(plan())
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_push_down_conditions(Plan, capsys):
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import py
+    Plan = getattr(py, Plan)
+    calls = []
+
+    def even(x):
+        calls.append(x)
+        return x % 2 == 0
+
+    def query():
+        return get_query_object(
+            (x, y)
+            for x in range(10)
+            for y in range(10)
+            if even(x) and y < x
+        )
+
+    plan = Plan(query())
+    assert [str(pushed) for pushed in plan.pushed] == [
+        'if even(x): moved to for x in .0'
+    ]
+    result = list(plan())
+    assert len(calls) == 10
+    del calls[:]
+    assert result == list(Plan(query(), optimize=False)())
+    assert len(calls) == 100
+
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'Pushed conditions' in out
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_hoist_invariants(Plan, capsys):
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import py
+    from xotl.ql.translation.optimizations import PURE_FUNCTIONS
+    Plan = getattr(py, Plan)
+    calls = []
+
+    def offset(days):
+        calls.append(days)
+        return days * 2
+
+    limit = 10
+
+    def query():
+        return get_query_object(
+            (x, y)
+            for x in range(20)
+            if x < limit + offset(2)
+            for y in [x + offset(1)]
+        )
+
+    # Only the calls to pure functions are hoisted.
+    plan = Plan(query())
+    assert not plan.hoisted
+    assert list(plan()) == [(x, x + 2) for x in range(14)]
+    assert len(calls) == 20 + 14
+    del calls[:]
+
+    PURE_FUNCTIONS.add(offset)
+    try:
+        plan = Plan(query())
+    finally:
+        PURE_FUNCTIONS.discard(offset)
+    assert [str(hoisted.node.__class__.__name__)
+            for hoisted in plan.hoisted] == ['BinOp', 'Call']
+    result = list(plan())
+    assert calls == [2, 1]
+    assert result == [(x, x + 2) for x in range(14)]
+
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'Hoisted expressions' in out
+    assert str(plan.hoisted[0]) in out
+    assert str(plan.hoisted[0]).endswith(' = (limit + offset(2))')
+
+    # If a hoisted expression fails, the query runs without hoisting.
+    zero = 0
+    plan = Plan(get_query_object(x for x in [] if x > 1 / zero))
+    assert plan.hoisted
+    assert list(plan()) == []
+    plan = Plan(get_query_object(x for x in [1] if x > 1 / zero))
+    with pytest.raises(ZeroDivisionError):
+        list(plan())
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_hoist_only_pure_expressions(Plan):
+    import ast
+    import random
+    from itertools import count
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import py
+    Plan = getattr(py, Plan)
+    xs = [1, 2, 3]
+    plan = Plan(get_query_object((x, []) for x in xs))
+    assert not plan.hoisted
+    rows = list(plan())
+    rows[0][1].append(1)
+    assert rows == [(1, [1]), (2, []), (3, [])]
+
+    counter = count()
+    plan = Plan(get_query_object((x, next(counter)) for x in xs))
+    assert not plan.hoisted
+    assert list(plan()) == [(1, 0), (2, 1), (3, 2)]
+
+    generator = random.Random(0)
+    plan = Plan(get_query_object(x for x in range(20)
+                                 if generator.random() < 0.5))
+    # The method may be hoisted, but not its call.
+    assert not any(isinstance(hoisted.node, ast.Call)
+                   for hoisted in plan.hoisted)
+    assert 0 < len(list(plan())) < 20
+
+    plan = Plan(get_query_object(x for x in xs if x < len(xs) + xs[0]))
+    assert [str(hoisted) for hoisted in plan.hoisted] == [
+        '%s = (len(xs) + xs[0])' % plan.hoisted[0].name
+    ]
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_partitions(Plan, capsys):
+    from xotl.ql.core import get_query_object, PartionableQueryObject
+    from xotl.ql.translation import py
+    Plan = getattr(py, Plan)
+    produced = []
+
+    def naturals():
+        n = 0
+        while True:
+            produced.append(n)
+            yield n
+            n += 1
+
+    def query(collection):
+        return get_query_object((x for x in collection if x % 2),
+                                query_type=PartionableQueryObject)
+
+    assert list(Plan(query(naturals()).limit_by(3))()) == [1, 3, 5]
+    assert len(produced) == 6
+    del produced[:]
+    plan = Plan(query(naturals()).limit_by(3).offset(2))
+    assert list(plan()) == [5, 7, 9]
+    assert len(produced) == 10
+
+    # Negative indexes are also allowed
+    assert list(Plan(query(range(10)).offset(-2))()) == [7, 9]
+
+    # Top-k
+    plan = Plan(query(range(100)).limit_by(3, key=lambda x: x % 10))
+    assert list(plan()) == [1, 11, 21]
+    plan = Plan(query(range(100)).limit_by(3, key=abs, reverse=True))
+    assert list(plan()) == [99, 97, 95]
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'top-k by' in out
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_aggregates(Plan, capsys):
+    from xotl.ql.core import get_predicate_object
+    from xotl.ql.translation import py
+    from xotl.ql.translation.aggregates import avg, count
+    Plan = getattr(py, Plan)
+
+    def aggregate(query, **kwargs):
+        return Plan(get_predicate_object(query, **kwargs))()
+
+    ages = [who.age for who in (elsa, papi, manu, manolito, denia, pedro)]
+    assert aggregate(lambda: count(x for x in this if isinstance(x, Person)
+                                   if x.age > 40)) == 4
+    assert aggregate(lambda: max(x.age for x in this
+                                 if isinstance(x, Person))) == 65
+    assert aggregate(lambda: sum(x.age for x in this
+                                 if isinstance(x, Person))) >= sum(ages)
+    assert aggregate(lambda: avg(x for x in [1, 2, 3, 4])) == 2.5
+    with pytest.raises(ValueError):
+        aggregate(lambda: min(x for x in []))
+
+    # any/all stop as soon as the result is known
+    seen = []
+
+    def naturals():
+        n = 0
+        while True:
+            seen.append(n)
+            yield n
+            n += 1
+
+    assert aggregate(lambda: any(x > 10 for x in naturals()))
+    assert len(seen) == 12
+    assert not aggregate(lambda: all(x < 10 for x in naturals()))
+
+    # Group by key
+    parents = aggregate(
+        lambda: count(child for parent in this if isinstance(parent, Person)
+                      for child in parent.children),
+        groups=lambda parent, child: parent
+    )
+    assert parents[elsa] == 1
+    assert manolito not in parents
+    assert aggregate(lambda: sum(n for n in range(10)),
+                     groups=lambda n: n % 2) == {0: 20, 1: 25}
+    plan = Plan(get_predicate_object(lambda: all(n for n in range(10)),
+                                     groups=lambda n: n % 2))
+    assert plan() == {0: False, 1: True}
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'all grouped by' in out
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_hash_aggregation(Plan, tmpdir, capsys):
+    from xotl.ql.core import get_predicate_object, get_query_object
+    from xotl.ql.translation import py, TranslationError
+    from xotl.ql.translation.aggregates import (
+        HashAggregation, avg, count, collect, get_aggregate,
+    )
+    Plan = getattr(py, Plan)
+
+    # Groups without an aggregate collect the values in lists
+    query = get_query_object(n for n in range(10))
+    assert Plan(query.group_by(lambda n: n % 3))() == {
+        0: [0, 3, 6, 9], 1: [1, 4, 7], 2: [2, 5, 8]
+    }
+
+    # Dictionary comprehensions keep the last value of each key
+    query = get_predicate_object(lambda: {n % 3: n for n in range(10)})
+    assert Plan(query)() == {0: 9, 1: 7, 2: 8}
+    plan = Plan(get_predicate_object(lambda: {n % 3: n for n in range(10)}),
+                max_groups=2)
+    assert plan() == {0: 9, 1: 7, 2: 8}
+    assert sorted(plan.iter_groups()) == [(0, 9), (1, 7), (2, 8)]
+    with pytest.raises(TranslationError):
+        Plan(get_query_object(n for n in range(10))).iter_groups()
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'last grouped by the keys' in out
+    assert 'at most 2 groups' in out
+    with pytest.raises(TypeError):
+        Plan(get_predicate_object(lambda: {n: n for n in range(10)},
+                                  groups=lambda n: n))
+
+    # Spilling to disk gives the same results
+    plan = Plan(get_predicate_object(lambda: sum(n for n in range(1000)),
+                                     groups=lambda n: n % 100),
+                max_groups=7)
+    assert plan() == {k: sum(range(k, 1000, 100)) for k in range(100)}
+    pairs = [(n % 50, n) for n in range(500)]
+    for aggregate in (count, avg, collect, sum, min, max, any, all):
+        aggregate = get_aggregate(aggregate) or aggregate
+        expected = dict(HashAggregation(aggregate)(pairs))
+        spilled = HashAggregation(aggregate, max_groups=3, partitions=2,
+                                  dir=str(tmpdir))
+        assert dict(spilled(pairs)) == expected
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_grouped_partitions(Plan, capsys):
+    from xotl.ql.core import (
+        get_query_object, get_predicate_object, PartionableQueryObject,
+    )
+    from xotl.ql.translation import py
+    Plan = getattr(py, Plan)
+    query = get_query_object(
+        (n for n in range(10)),
+        query_type=PartionableQueryObject
+    ).group_by(lambda n: n % 3)
+
+    # The partition is a slice of the groups, not of the items
+    plan = Plan(query.limit_by(2))
+    assert plan() == {0: [0, 3, 6, 9], 1: [1, 4, 7]}
+    assert Plan(query.offset(1))() == {1: [1, 4, 7], 2: [2, 5, 8]}
+    assert len(Plan(query.limit_by(2), max_groups=1)()) == 2
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'of the groups' in out
+
+    # The ordering sorts the groups by their keys
+    plan = Plan(query.order_by(lambda n: -n))
+    assert list(plan().items()) == [
+        (2, [2, 5, 8]), (1, [1, 4, 7]), (0, [0, 3, 6, 9])
+    ]
+    plan = Plan(query.limit_by(2, key=lambda n: -n))
+    assert list(plan()) == [2, 1]
+    plan = Plan(query.order_by(reverse=True).offset(1), max_groups=1,
+                max_sorted=1)
+    assert list(plan.iter_groups()) == [(1, [1, 4, 7]), (0, [0, 3, 6, 9])]
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'sorted by None of the keys of the groups (reversed)' in out
+    query = get_predicate_object(lambda: {n % 3: n for n in range(10)},
+                                 order=lambda n: -n)
+    assert list(Plan(query)().items()) == [(2, 8), (1, 7), (0, 9)]
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_external_sort(Plan, tmpdir, capsys):
+    import random
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import py
+    from xotl.ql.translation.sorting import ExternalSort
+    Plan = getattr(py, Plan)
+
+    def query(collection, **kwargs):
+        return get_query_object((x for x in collection), **kwargs)
+
+    numbers = [random.randrange(100) for _ in range(1000)]
+    assert list(Plan(query(numbers).order_by())()) == sorted(numbers)
+    assert list(Plan(query(numbers, order=(abs, True)))()) == \
+        sorted(numbers, reverse=True)
+    plan = Plan(query(numbers).order_by(lambda x: -x), max_sorted=30)
+    assert list(plan()) == sorted(numbers, reverse=True)
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'at most 30 items sorted' in out
+
+    # The sort is stable, with and without spilling
+    pairs = [(random.randrange(10), n) for n in range(500)]
+    for reverse in (False, True):
+        expected = sorted(pairs, key=lambda p: p[0], reverse=reverse)
+        for max_items in (None, 1, 7, 500, 1000):
+            sort = ExternalSort(key=lambda p: p[0], reverse=reverse,
+                                max_items=max_items, fanin=3,
+                                dir=str(tmpdir))
+            assert list(sort(pairs)) == expected
+    assert not tmpdir.listdir()
+    with pytest.raises(ValueError):
+        ExternalSort(max_items=0)
+
+    # At most max_items items are kept in memory
+    _Tracked.alive = _Tracked.peak = 0
+    sort = ExternalSort(key=lambda item: item.value, max_items=10, fanin=2,
+                        dir=str(tmpdir))
+    items = (_Tracked(n) for n in numbers)
+    assert [item.value for item in sort(items)] == sorted(numbers)
+    assert _Tracked.peak <= 10
+
+
+class _Tracked:
+    # An object that counts how many instances are alive.
+    alive = peak = 0
+
+    def __new__(cls, *args):
+        cls.alive += 1
+        cls.peak = max(cls.peak, cls.alive)
+        return super().__new__(cls)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __del__(self):
+        type(self).alive -= 1
+
+
+def _square(x):
+    return x * x
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_process_pool(Plan, capsys):
+    from xotl.ql.core import get_query_object, get_predicate_object
+    from xotl.ql.translation import py
+    from xotl.ql.translation.parallel import ProcessPool, dumps, loads
+    Plan = getattr(py, Plan)
+    numbers = list(range(100))
+    others = list(range(5))
+
+    def query():
+        return get_query_object(
+            (x, _square(y)) for x in numbers if x % 3 for y in others
+            if y == x % 5
+        )
+
+    expected = list(Plan(query())())
+    plan = Plan(query(), parallel=ProcessPool(2, chunksize=7))
+    assert list(plan()) == expected
+    plan = Plan(query(), parallel=ProcessPool(2, chunksize=7, ordered=False))
+    assert sorted(plan()) == sorted(expected)
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'process pool of 2 processes, chunks of 7 items' in out
+
+    # Aggregates are merged in this process
+    plan = Plan(get_predicate_object(lambda: sum(_square(x) for x in numbers)),
+                parallel=ProcessPool(2, chunksize=30))
+    assert plan() == sum(x * x for x in numbers)
+
+    # Plans that can't be pickled run in this process
+    def identity(x):
+        return x
+
+    plan = Plan(get_query_object(x for x in numbers if identity(x) > 97),
+                parallel=ProcessPool(2))
+    assert list(plan()) == [98, 99]
+
+    code = compile('x + 1', '', 'eval')
+    run, loaded, namespace = loads(dumps(eval, code, {'x': 1}))
+    assert run(loaded, namespace) == 2
+
+
+@pytest.mark.parametrize('Plan', ['NaivePythonExecutionPlan',
+                                  'GeneratorPythonExecutionPlan'])
+def test_thread_pool(Plan, capsys):
+    import threading
+    from xotl.ql.core import get_query_object
+    from xotl.ql.translation import py
+    from xotl.ql.translation.parallel import ThreadPool
+    Plan = getattr(py, Plan)
+
+    # The lookups wait until 4 of them run at the same time.
+    lock = threading.Lock()
+    concurrent = threading.Event()
+    active = [0, 0]   # the lookups running now, and the peak
+
+    def lookup(x):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+            if active[1] >= 4:
+                concurrent.set()
+        try:
+            assert concurrent.wait(10), 'The lookups are not concurrent'
+        finally:
+            with lock:
+                active[0] -= 1
+        return x * 10
+
+    def query(collection):
+        return get_query_object(lookup(x) for x in collection
+                                if lookup(x) % 20)
+
+    plan = Plan(query(range(20)), parallel=ThreadPool(20))
+    assert list(plan()) == [x * 10 for x in range(1, 20, 2)]
+    assert active[0] == 0 and active[1] >= 4
+    plan = Plan(query(range(20)), parallel=ThreadPool(4, ordered=False))
+    assert sorted(plan()) == [x * 10 for x in range(1, 20, 2)]
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'thread pool of 4 threads' in out
+
+    # Back-pressure: only a few chunks are read ahead.
+    read = []
+
+    def naturals():
+        n = 0
+        while True:
+            read.append(n)
+            yield n
+            n += 1
+
+    plan = Plan(query(naturals()),
+                parallel=ThreadPool(2, chunksize=3, max_pending=2))
+    results = plan()
+    assert next(results) == 10
+    results.close()
+    assert len(read) <= 3 * 3
+
+
+_pending = []
+
+
+async def _lookup(x):
+    import asyncio
+    _pending.append(x)
+    await asyncio.sleep(0.01)
+    result = (x, len(_pending))
+    _pending.remove(x)
+    return result
+
+
+async def _odd(x):
+    return x % 2
+
+
+def test_async_plan(capsys):
+    import asyncio
+    from xotl.ql.core import get_predicate_object, PartionableQueryObject
+    from xotl.ql.translation.py import AsyncPythonExecutionPlan
+    from xotl.ql.translation import TranslationError
+
+    class Feed:
+        def __init__(self, count):
+            self.count = count
+            self.read = 0
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.read >= self.count:
+                raise StopAsyncIteration
+            await asyncio.sleep(0)
+            self.read += 1
+            return self.read - 1
+
+    async def collect(results):
+        items = []
+        async for result in results:
+            items.append(result)
+        return items
+
+    def run(coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    feed = Feed(20)
+    plan = AsyncPythonExecutionPlan(
+        get_predicate_object(lambda: (_lookup(x) for x in feed if _odd(x)
+                                      for y in [1, 2] if y < x)),
+        concurrency=3
+    )
+    results = run(collect(plan))
+    assert [x for x, _ in results] == [x for x in range(3, 20, 2)
+                                       for _ in (1, 2)]
+    assert max(count for _, count in results) == 3
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'at most 3 concurrent tasks' in out
+
+    # Slices stop reading the source
+    feed = Feed(1000)
+    query = get_predicate_object(lambda: (x for x in feed),
+                                 predicate_type=PartionableQueryObject)
+    plan = AsyncPythonExecutionPlan(query.limit_by(3).offset(2),
+                                    concurrency=2)
+    assert run(collect(plan)) == [2, 3, 4]
+    assert feed.read < 10
+
+    # Errors are raised by the iterator
+    plan = AsyncPythonExecutionPlan(
+        get_predicate_object(lambda: (1 // (x - 3) for x in range(5)))
+    )
+    with pytest.raises(ZeroDivisionError):
+        run(collect(plan))
+    with pytest.raises(TypeError):
+        list(plan)
+
+    with pytest.raises(TranslationError):
+        AsyncPythonExecutionPlan(
+            get_predicate_object(lambda: sum(x for x in range(5)))
+        )
+
+
+def test_batched_plan(capsys):
+    from xotl.ql.core import (
+        get_query_object, get_predicate_object, PartionableQueryObject
+    )
+    from xotl.ql.translation import TranslationError
+    from xotl.ql.translation.optimizations import get_source
+    from xotl.ql.translation.py import NaivePythonExecutionPlan as Plan
+    numbers = list(range(20))
+    others = [3, 4, 5]
+
+    def queries():
+        return [
+            get_query_object(x for x in numbers),
+            get_query_object(x * 2 for x in numbers if x % 3 if x > 4),
+            get_query_object((x, y) for x in numbers if x > 2
+                             for y in others if (x + y) % 4 == 0),
+            get_query_object(x for x in numbers if x in others),
+        ]
+
+    for query, batched in zip(queries(), queries()):
+        expected = list(Plan(query)())
+        plan = Plan(batched, batch_size=4)
+        assert list(plan()) == expected
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'batches of 4 items' in out
+    assert 'for x in __x_batch' in get_source(plan.plan.body)
+
+    # The loops and conditions are merged in a single comprehension.
+    plan = Plan(get_query_object((x, y) for x in numbers if x > 2
+                                 for y in others if x < y),
+                batch_size=4, optimize=False)
+    assert list(plan()) == [(3, 4), (3, 5), (4, 5)]
+    assert plan.plan.body.func.func.id == plan.select
+
+    # Slices stop the query after the batch with the last item.
+    read = []
+
+    def naturals():
+        n = 0
+        while True:
+            read.append(n)
+            yield n
+            n += 1
+
+    query = get_query_object((n for n in naturals() if n % 2),
+                             query_type=PartionableQueryObject)
+    plan = Plan(query.limit_by(3), batch_size=5)
+    assert list(plan()) == [1, 3, 5]
+    assert len(read) == 10
+
+    plan = Plan(get_predicate_object(lambda: sum(x for x in numbers)),
+                batch_size=3)
+    assert plan() == sum(numbers)
+    with pytest.raises(ValueError):
+        Plan(get_query_object(x for x in numbers), batch_size=0)
+    with pytest.raises(TranslationError):
+        Plan(get_query_object(x for x in numbers), batch_size=3,
+             use_own_monads=True)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+import sqlite3
+
+import pytest
+
+from xotl.ql.core import this, get_query_object, get_predicate_object
+from xotl.ql.translation import TranslationError
+from xotl.ql.translation.aggregates import count, avg
+from xotl.ql.translation.sql import Table, SQLTranslator
+
+
+class Person:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+people = Table('person', ['id', 'name', 'age', 'city'], factory=Person)
+cities = Table('city', {'id': 'id', 'title': 'name'})
+
+
+@pytest.fixture
+def translate():
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE person (id INTEGER, name TEXT, '
+                       'age INTEGER, city INTEGER)')
+    connection.execute('CREATE TABLE city (id INTEGER, name TEXT)')
+    connection.executemany('INSERT INTO person VALUES (?, ?, ?, ?)', [
+        (1, 'ana', 30, 1),
+        (2, 'bob', 45, 2),
+        (3, 'carl', 60, 1),
+        (4, 'dan', 12, None),
+    ])
+    connection.executemany('INSERT INTO city VALUES (?, ?)', [
+        (1, 'Havana'),
+        (2, 'Paris'),
+    ])
+    yield SQLTranslator({Person: people}, connection)
+    connection.close()
+
+
+def test_filters_and_projections(translate, capsys):
+    limit = 40
+    query = get_query_object(p for p in people if p.age > limit)
+    plan = translate(query)
+    assert [p.name for p in plan()] == ['bob', 'carl']
+    assert '"p"."age" > ?' in plan.sql
+    plan = translate(query.bind(limit=10))
+    assert [p.name for p in plan()] == ['ana', 'bob', 'carl', 'dan']
+
+    plan = translate(get_query_object(
+        (p.name.upper(), p.age / 2) for p in this if isinstance(p, Person)
+        if p.city is not None and p.id in (1, 2, 4)
+    ))
+    assert list(plan()) == [('ANA', 15.0), ('BOB', 22.5)]
+    plan.explain()
+    out, _ = capsys.readouterr()
+    assert 'FROM "person" AS "p"' in out
+    assert '(1, 2, 4)' in out
+
+    query = get_query_object((p.name for p in people if p.age > top),
+                             params=('top', ))
+    plan = translate(query)
+    assert list(plan(top=50)) == ['carl']
+
+    with pytest.raises(TranslationError):
+        translate(get_query_object(p.name for p in people if p.age // 2))
+    with pytest.raises(TranslationError):
+        translate(get_query_object(x for x in range(10)))
+
+
+def test_joins(translate):
+    plan = translate(get_query_object(
+        (p.name, c.title) for p in people for c in cities
+        if p.city == c.id if c.title != 'Paris'
+    ))
+    assert list(plan()) == [('ana', 'Havana'), ('carl', 'Havana')]
+    assert '"c"."name" <> ?' in plan.sql
+
+
+def test_ordering_and_partitions(translate):
+    from xotl.ql.core import PartionableQueryObject
+    query = get_query_object((p.name for p in people),
+                             query_type=PartionableQueryObject)
+    plan = translate(query.order_by(lambda name: len(name), reverse=True))
+    assert list(plan()) == ['carl', 'ana', 'bob', 'dan']
+    plan = translate(query.order_by().limit_by(2).offset(1))
+    assert list(plan()) == ['bob', 'carl']
+    assert plan.sql.endswith('LIMIT 2 OFFSET 1')
+    plan = translate(query.offset(3))
+    assert list(plan()) == ['dan']
+    with pytest.raises(TranslationError):
+        translate(query.offset(-1))
+
+    query = get_query_object(((p.age, p.name) for p in people),
+                             order=lambda r: -r[0])
+    assert [name for _, name in translate(query)()] == \
+        ['carl', 'bob', 'ana', 'dan']
+
+
+def test_aggregates(translate):
+    def aggregate(function, **kwargs):
+        return translate(get_predicate_object(function, **kwargs))()
+
+    assert aggregate(lambda: count(p for p in people if p.age > 20)) == 3
+    assert aggregate(lambda: avg(p.age for p in people)) == 36.75
+    assert aggregate(lambda: sum(p.age for p in people if p.age > 100)) == 0
+    assert aggregate(lambda: any(p.age > 50 for p in people)) is True
+    assert aggregate(lambda: all(p.age > 50 for p in people)) is False
+    with pytest.raises(ValueError):
+        aggregate(lambda: max(p.age for p in people if p.age > 100))
+    assert aggregate(lambda: sum(p.age for p in people),
+                     groups=lambda p: p.city) == {None: 12, 1: 90, 2: 45}
+    assert aggregate(lambda: count(c for p in people for c in cities
+                                   if p.city == c.id),
+                     groups=lambda p, c: (c.title, p.age > 40)) == {
+        ('Havana', False): 1, ('Havana', True): 1, ('Paris', True): 1,
+    }
+    with pytest.raises(TranslationError):
+        aggregate(lambda: list(p for p in people), groups=lambda p: p.city)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from xotl.ql.core import this, get_query_object, get_predicate_object
+from xotl.ql.translation import TranslationError
+from xotl.ql.translation.aggregates import count
+from xotl.ql.translation.py import PythonObjectsCollection
+from xotl.ql.translation.views import ObservableCollection, MaterializedView
+
+
+class Counted:
+    # An object that counts how many times its `key` is read.
+    reads = 0
+
+    def __init__(self, key):
+        self._key = key
+
+    @property
+    def key(self):
+        Counted.reads += 1
+        return self._key
+
+
+people = ObservableCollection([
+    SimpleNamespace(name='ana', age=30),
+    SimpleNamespace(name='bob', age=50),
+])
+pairs = ObservableCollection([(1, 2), (3, 4)])
+cities = ObservableCollection([Counted(1), Counted(2)])
+residents = ObservableCollection([
+    SimpleNamespace(name='ana', city=1),
+    SimpleNamespace(name='bob', city=2),
+])
+ages = ObservableCollection(SimpleNamespace(age=age) for age in range(5))
+objects = PythonObjectsCollection()
+
+
+def test_filters_and_projections():
+    view = MaterializedView(get_query_object(p.name for p in people
+                                             if p.age > 40))
+    assert list(view) == ['bob']
+    carl = SimpleNamespace(name='carl', age=60)
+    people.add(carl)
+    people.add(SimpleNamespace(name='dan', age=10))
+    assert list(view) == ['bob', 'carl']
+    people.remove(carl)
+    assert list(view) == ['bob']
+
+    total = MaterializedView(get_predicate_object(
+        lambda: sum(a for a, b in pairs if b > 2)
+    ))
+    assert total.value == 3
+    pairs.add((5, 6))
+    assert total.value == 8
+
+    view.close()
+    people.add(carl)
+    assert list(view) == ['bob']
+
+    with pytest.raises(TranslationError):
+        MaterializedView(get_query_object(x for x in [1, 2]))
+    with pytest.raises(TranslationError):
+        MaterializedView(get_predicate_object(
+            lambda: max(p.age for p in people)
+        ))
+
+
+def test_unobservable_sources():
+    with pytest.raises(TranslationError):
+        MaterializedView(get_query_object(x for x in this))
+    with pytest.raises(TranslationError):
+        MaterializedView(get_predicate_object(
+            lambda: ((p.name, x) for p in people for x in this)
+        ))
+    with pytest.raises(TranslationError):
+        MaterializedView(get_predicate_object(
+            lambda: ((p.name, x) for p in people for x in objects)
+        ))
+
+
+def test_joins():
+    view = MaterializedView(get_predicate_object(
+        lambda: ((p.name, c.key) for p in residents for c in cities
+                 if p.city == c.key)
+    ))
+    assert sorted(view) == [('ana', 1), ('bob', 2)]
+
+    # The join uses an index: adding a resident doesn't read all the cities.
+    for key in range(10, 110):
+        cities.add(Counted(key))
+    Counted.reads = 0
+    residents.add(SimpleNamespace(name='carl', city=50))
+    assert sorted(view) == [('ana', 1), ('bob', 2), ('carl', 50)]
+    assert Counted.reads < 5
+
+    city = next(c for c in cities if c.key == 50)
+    cities.remove(city)
+    assert sorted(view) == [('ana', 1), ('bob', 2)]
+    cities.add(city)
+    assert sorted(view) == [('ana', 1), ('bob', 2), ('carl', 50)]
+
+
+def test_self_joins_and_counts():
+    view = MaterializedView(get_predicate_object(
+        lambda: count((p, q) for p in ages for q in ages if p.age < q.age)
+    ))
+    assert view.value == 10
+    alive = list(ages)
+    rnd = random.Random(0)
+    for _ in range(100):
+        if alive and rnd.random() < 0.5:
+            ages.remove(alive.pop(rnd.randrange(len(alive))))
+        else:
+            person = SimpleNamespace(age=rnd.randrange(10))
+            alive.append(person)
+            ages.add(person)
+        assert view.value == len(view) == sum(
+            1 for p in ages for q in ages if p.age < q.age
+        )
@@ -15,7 +15,7 @@ import ast
 import types
 from xoutil.symbols import Unset
 from xoutil.objects import memoized_property
-from collections import MappingView, Mapping
+from collections import MappingView, Mapping, Iterator
 
 from xoutil.decorator.meta import decorator
 
@@ -62,14 +62,68 @@ class QueryObject:
     frame_type = 'xotl.ql.core.Frame'
 
     def __init__(self, qst, _frame, **kwargs):
-        self.qst = qst
+        if qst is not None:
+            self.qst = qst
         self._frame = _frame
+        self.groups = kwargs.pop('groups', None)
+        self.ordering = _get_ordering(kwargs.pop('order', None),
+                                      kwargs.pop('ordering', None))
         if any(name in RESERVED_ARGUMENTS for name in kwargs):
             raise TypeError('Invalid keyword argument')
         self.expression = kwargs.pop('expression', None)
+        self.params = tuple(kwargs.pop('params', ()))
         for attr, val in kwargs.items():
             setattr(self, attr, val)
 
+    def bind(self, **values):
+        '''Return a query object where the given names take new values.
+
+        The new query object shares the QST of this one, so it's not
+        decompiled again.  Names given in `values` shadow both the locals and
+        the globals of the query.  They are removed from the `params` of the
+        result.
+
+        '''
+        from xoutil.future.collections import ChainMap
+        frame = self._frame
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        for attr in ('locals', 'globals'):
+            result.__dict__.pop(attr, None)
+        result.qst = self.qst
+        result._frame = Frame(
+            ChainMap(values, frame.f_locals),
+            ChainMap(values, frame.f_globals),
+            auto_expand_subqueries=getattr(frame, 'auto_expand_subqueries',
+                                           True)
+        )
+        result.params = tuple(p for p in self.params if p not in values)
+        return result
+
+    def group_by(self, key):
+        '''Return a query object whose results are grouped by `key`.
+
+        The `key` is called with the values of the targets of the generators,
+        in order, and gives the key of the group.  See `groups`:attr:.
+
+        '''
+        return self._replace(groups=key)
+
+    def order_by(self, key=None, reverse=False):
+        '''Return a query object whose results are sorted by `key`.
+
+        Without `key` the results themselves are compared.  See
+        `ordering`:attr:.
+
+        '''
+        return self._replace(ordering=(key, reverse))
+
+    def _replace(self, **attrs):
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        result.__dict__.update(attrs)
+        return result
+
     def get_value(self, name, only_globals=False):
         if not only_globals:
             res = self._frame.f_locals.get(name, Unset)
@@ -82,6 +136,17 @@ class QueryObject:
         else:
             raise NameError(name)
 
+    @memoized_property
+    def qst(self):
+        '''The Query Syntax Tree.
+
+        If the query object was created without a QST, it's obtained from the
+        `expression` the first time it's needed.
+
+        '''
+        from xotl.ql.revenge import Uncompyled, get_qst
+        return get_qst(Uncompyled._extract_code(self.expression))
+
     @memoized_property
     def locals(self):
         return self._frame.f_locals
@@ -95,26 +160,116 @@ class QueryObject:
         builder = SourceBuilder()
         return builder.get_source(self.qst)
 
+    def __reduce__(self):
+        # Query objects are pickled in the format of xotl.ql.serialization,
+        # which doesn't need the frame.
+        from xotl.ql.serialization import dumps, loads
+        return loads, (dumps(self), )
+
+    def __copy__(self):
+        return self._replace()
+
+    def __deepcopy__(self, memo):
+        # The QST is copied, but the frame (a view of the names of the
+        # query) and the query expression are shared.
+        from copy import deepcopy
+        result = self._replace()
+        if 'qst' in self.__dict__:
+            result.qst = deepcopy(self.qst, memo)
+        return result
+
+
+class PartionableQueryObject(QueryObject):
+    '''A query object that retrieves only a slice of its results.
+
+    Instances of this class implement the interface
+    `xotl.ql.interfaces.PartionableQueryObject`:class:.  The keyword argument
+    `partition` gives the slice and `ordering` (a pair of a key function and
+    the `reverse` flag) the order of the results before slicing.
+
+    '''
+    def __init__(self, qst, _frame, **kwargs):
+        partition = kwargs.pop('partition', None)
+        if partition is not None and not isinstance(partition, slice):
+            raise TypeError('The partition must be a slice')
+        self.partition = partition
+        super().__init__(qst, _frame, **kwargs)
+
+    def limit_by(self, limit, key=None, reverse=False):
+        '''Return a new query object limited by `limit`.
+
+        If this query object already has a limit it will be ignored.  The
+        offset is kept.
+
+        If `key` is given, the new query object retrieves the `limit` results
+        with the least key (the greatest, if `reverse` is True) in that order.
+        Translators should do that without sorting all the results.
+
+        '''
+        start, _, step = self._get_partition()
+        result = self._replace(
+            partition=slice(start, (start or 0) + limit, step)
+        )
+        if key is not None:
+            result.ordering = (key, reverse)
+        return result
+
+    def offset(self, offset):
+        '''Return a new query object with a new offset.
+
+        The limit, if any, is kept: the new query object retrieves the same
+        amount of results starting at `offset`.
+
+        '''
+        start, stop, step = self._get_partition()
+        if stop is not None:
+            stop = offset + stop - (start or 0)
+        return self._replace(partition=slice(offset, stop, step))
+
+    def _get_partition(self):
+        partition = self.partition
+        if partition is None:
+            return None, None, None
+        else:
+            return partition.start, partition.stop, partition.step
+
+
+def _get_ordering(order, ordering):
+    # The `order` argument of query objects is either a key function or a
+    # pair of the key and the `reverse` flag, like the `ordering`.
+    if order is None:
+        return ordering
+    elif isinstance(order, tuple):
+        key, reverse = order
+        return key, reverse
+    else:
+        return order, False
+
 
 def get_query_object(generator,
                      query_type='xotl.ql.core.QueryObject',
                      frame_type=None,
+                     only_free_names=False,
                      **kwargs):
     '''Get the query object from a query expression.
 
     '''
     from xoutil.objects import import_object
-    from xotl.ql.revenge import Uncompyled
-    uncompiled = Uncompyled(generator)
+    from xotl.ql.revenge import Uncompyled, get_qst
+    code = Uncompyled._extract_code(generator)
     gi_frame = generator.gi_frame
     QueryObjectType = import_object(query_type)
     FrameType = import_object(frame_type or QueryObjectType.frame_type)
-    return QueryObjectType(
-        uncompiled.qst,
-        FrameType(gi_frame.f_locals, gi_frame.f_globals),
-        expression=generator,
-        **kwargs
-    )
+    qst = get_qst(code)
+    if only_free_names:
+        from xotl.ql.tools import detect_names
+        frame = FrameType(gi_frame.f_locals, gi_frame.f_globals,
+                          names=detect_names(qst))
+        expression = None
+    else:
+        frame = FrameType(gi_frame.f_locals, gi_frame.f_globals)
+        expression = generator
+    return QueryObjectType(qst, frame, expression=expression, **kwargs)
 
 
 # Alias to the old API.
@@ -122,21 +277,25 @@ these = get_query_object
 
 
 def get_predicate_object(func, predicate_type='xotl.ql.core.QueryObject',
-                         frame_type=None, **kwargs):
+                         frame_type=None, only_free_names=False, **kwargs):
     '''Get a predicate object from a predicate expression.
 
     '''
     from xoutil.objects import import_object
-    from .revenge import Uncompyled
-    uncompiled = Uncompyled(func)
+    from .revenge import Uncompyled, get_qst
+    code = Uncompyled._extract_code(func)
     PredicateClass = import_object(predicate_type)
     FrameClass = import_object(frame_type or PredicateClass.frame_type)
-    return PredicateClass(
-        uncompiled.qst,
-        FrameClass(_get_closure(func), func.__globals__),
-        predicate=func,
-        **kwargs
-    )
+    qst = get_qst(code)
+    if only_free_names:
+        from xotl.ql.tools import detect_names
+        frame = FrameClass(_get_closure(func), func.__globals__,
+                           names=detect_names(qst))
+        predicate = None
+    else:
+        frame = FrameClass(_get_closure(func), func.__globals__)
+        predicate = func
+    return PredicateClass(qst, frame, predicate=predicate, **kwargs)
 
 
 def normalize_query(which, **kwargs):
@@ -230,12 +389,21 @@ class Frame:
     def __init__(self, locals, globals, **kwargs):
         self.auto_expand_subqueries = kwargs.pop('auto_expand_subqueries',
                                                  True)
+        names = kwargs.pop('names', None)
+        if names is not None:
+            locals = _bind_names(locals, names)
+            globals = _bind_names(globals, names)
         self.f_locals = _FrameView(locals)
         self.f_globals = _FrameView(globals)
         self.f_locals.owner = self.f_globals.owner = self
 
 
 class _FrameView(MappingView, Mapping):
+    def __init__(self, mapping):
+        super().__init__(mapping)
+        # Sub-queries already expanded: key -> (value, query object)
+        self._expanded = {}
+
     def __contains__(self, key):
         try:
             self[key]
@@ -247,21 +415,49 @@ class _FrameView(MappingView, Mapping):
     def __getitem__(self, key):
         res = self._mapping[key]
         if self.owner.auto_expand_subqueries and key == '.0':
-            return sub_query_or_value(res)
+            return self._expand(key, res)
         else:
             return res
 
     def get(self, key, default=None):
         res = self._mapping.get(key, default)
         if self.owner.auto_expand_subqueries and key == '.0':
-            return sub_query_or_value(res)
+            return self._expand(key, res)
         else:
             return res
 
+    def _expand(self, key, value):
+        expanded = self._expanded.get(key)
+        if expanded is None or expanded[0] is not value:
+            expanded = self._expanded[key] = (value, sub_query_or_value(value))
+        return expanded[1]
+
     def __iter__(self):
         return iter(self._mapping)
 
 
+def _bind_names(mapping, names):
+    '''Return an immutable mapping with the values of `names` in `mapping`.
+
+    Names missing in `mapping` are ignored.  Sub-queries are captured the same
+    way, so that no frame is kept alive by the result.
+
+    '''
+    from types import MappingProxyType
+    return MappingProxyType({
+        name: _bind_value(mapping[name])
+        for name in names
+        if name in mapping
+    })
+
+
+def _bind_value(v):
+    if isinstance(v, types.GeneratorType) and v.gi_code.co_name == '<genexpr>':
+        return get_query_object(v, only_free_names=True)
+    else:
+        return v
+
+
 def _get_closure(obj):
     assert isinstance(obj, types.FunctionType)
     if obj.__closure__:
@@ -274,12 +470,46 @@ def _get_closure(obj):
 
 
 def sub_query_or_value(v):
+    '''Return a query object if `v` is a query expression, else `v`.
+
+    The QST of the query object is not computed until it's accessed.
+
+    If `v` is an iterator over a list, a tuple, a range, a string or bytes
+    which has not started, return the sequence instead.  This is the case of
+    the collection of the first generator of queries like ``(x for x in
+    items)``: the query can be executed again (see `QueryObject.bind`:meth:
+    and `QueryObject.params`:attr:).
+
+    '''
     if isinstance(v, types.GeneratorType) and v.gi_code.co_name == '<genexpr>':
-        return get_query_object(v)
+        gi_frame = v.gi_frame
+        return QueryObject(
+            None,
+            Frame(gi_frame.f_locals, gi_frame.f_globals),
+            expression=v
+        )
+    elif type(v) in _SEQUENCE_ITERATORS:
+        _, (sequence, ), *state = v.__reduce__()
+        return sequence if state == [0] else v
     else:
         return v
 
 
+# The types of the iterators over sequences.  The sequence of an iterator can
+# be obtained from its ``__reduce__()``.
+_SEQUENCE_ITERATORS = tuple(
+    type(iter(sequence))
+    for sequence in ([], (), range(0), '', b'', bytearray())
+)
+
+
+def _is_single_use(value):
+    # True if `value` is a built-in iterator (a generator, a map object,
+    # etc.): queries over it can be executed only once.
+    return (isinstance(value, Iterator) and
+            type(value).__module__ == 'builtins')
+
+
 class SourceBuilder(ast.NodeVisitor):
     def get_source(self, node):
         stack = self.stack = []
@@ -355,6 +585,9 @@ class SourceBuilder(ast.NodeVisitor):
     def visit_Num(self, node):
         self.stack.append('%s' % node.n)
 
+    def visit_NameConstant(self, node):
+        self.stack.append('%s' % node.value)
+
     def visit_UnaryOp(self, node):
         stack = self.stack
         self.visit(node.op)
@@ -385,11 +618,19 @@ class SourceBuilder(ast.NodeVisitor):
         self.stack.append('(%s if %s else %s)' % (body, test, orelse))
 
     def visit_Lambda(self, node):
-        raise NotImplementedError()
+        arguments = node.args
+        if (arguments.vararg or arguments.kwarg or arguments.defaults or
+                arguments.kwonlyargs):
+            raise NotImplementedError()
+        self.visit(node.body)
+        args = ', '.join(arg.arg for arg in arguments.args)
+        self.stack.append(
+            '(lambda%s: %s)' % (' ' + args if args else '', self.stack.pop(-1))
+        )
 
     def visit_Dict(self, node):
         # order does not really matter but I'm picky
-        for k, v in reversed(zip(node.keys, node.values)):
+        for k, v in reversed(list(zip(node.keys, node.values))):
             self.visit(v)
             self.visit(k)
         dictbody = ', '.join(
@@ -483,7 +724,7 @@ class SourceBuilder(ast.NodeVisitor):
 
     def visit_Compare(self, node):
         self.visit(node.left)
-        for op, expr in reversed(zip(node.ops, node.comparators)):
+        for op, expr in reversed(list(zip(node.ops, node.comparators))):
             self.visit(expr)
             self.visit(op)
         right = ''.join(
@@ -494,10 +735,14 @@ class SourceBuilder(ast.NodeVisitor):
         self.stack.append('%s%s' % (self.stack.pop(-1), right))
 
     def visit_Call(self, node):
-        if node.kwargs:
-            self.visit(node.kwargs)
-        if node.starargs:
-            self.visit(node.starargs)
+        # Python 3.5+ has neither `starargs` nor `kwargs`, those are in the
+        # `args` and `keywords`.
+        starargs = getattr(node, 'starargs', None)
+        kwargs = getattr(node, 'kwargs', None)
+        if kwargs:
+            self.visit(kwargs)
+        if starargs:
+            self.visit(starargs)
         for kw in reversed(node.keywords):
             self.visit(kw.value)
             self.stack.append(kw.arg)
@@ -510,8 +755,8 @@ class SourceBuilder(ast.NodeVisitor):
             (self.stack.pop(-1), self.stack.pop(-1))
             for _ in range(len(node.keywords))
         ]
-        starargs = self.stack.pop(-1) if node.starargs else ''
-        kwargs = self.stack.pop(-1) if node.kwargs else ''
+        starargs = self.stack.pop(-1) if starargs else ''
+        kwargs = self.stack.pop(-1) if kwargs else ''
         call = ', '.join(args)
         if keywords:
             if call:
@@ -548,17 +793,23 @@ class SourceBuilder(ast.NodeVisitor):
         self.stack.append('...')
 
     def visit_Slice(self, node):
-        if node.step:
+        from xotl.ql.revenge.qst import LOAD_NONE
+
+        # The decompiler gives the missing bounds as a load of None.
+        def given(bound):
+            return bound is not None and not bound == LOAD_NONE
+
+        if given(node.step):
             self.visit(node.step)
             step = self.stack.pop(-1)
         else:
             step = None
-        if node.upper:
+        if given(node.upper):
             self.visit(node.upper)
             upper = self.stack.pop(-1)
         else:
             upper = None
-        if node.lower:
+        if given(node.lower):
             self.visit(node.lower)
             lower = self.stack.pop(-1)
         else:
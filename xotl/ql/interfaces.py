@@ -186,6 +186,38 @@ class QueryExecutionPlan(Interface):
         return self()
 
 
+class AsyncQueryExecutionPlan(Interface):
+    '''Interface for query execution plans that run asynchronously.
+
+    Like a `QueryExecutionPlan`:class:, but the results are retrieved with
+    ``async for`` so that the plan can wait for its sources without blocking
+    the event loop.
+
+    '''
+    query = Attribute(
+        'query',
+        'The original query object this plan was built from.'
+    )
+
+    def __call__(self, **kwargs):
+        '''Execution plans are callable.
+
+        Return an asynchronous iterator (it has the ``__anext__`` method)
+        which produces the objects retrieved from the query.  The same rules
+        about arguments of `QueryExecutionPlan.__call__`:meth: apply.
+
+        '''
+
+    def __aiter__(self):
+        '''Asynchronous execution plans are asynchronous iterables.
+
+        This is exactly the same as calling the plan without any arguments:
+        ``plan()``.
+
+        '''
+        return self()
+
+
 class QueryTranslator(Interface):
     '''A query translator.
 
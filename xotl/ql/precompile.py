@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Decompile the queries of packages ahead of time.
+
+Run it when the packages are built or deployed::
+
+    python -m xotl.ql.precompile mypackage [otherpackage ...]
+
+This imports each package and its modules, and finds the query expressions
+and predicates given to `~xotl.ql.core.get_query_object`:func: (or
+`~xotl.ql.core.these`:func:, `~xotl.ql.core.normalize_query`:func:) and
+`~xotl.ql.core.get_predicate_object`:func: in their source.  Their QSTs are
+written to the file ``qst.<interpreter>.cache`` in the ``__pycache__``
+directory of the module, where `xotl.ql.revenge.get_qst`:func: finds them:
+the query objects created at runtime don't decompile those queries.
+
+Each query is also translated with
+`~xotl.ql.translation.py.NaivePythonExecutionPlan`:class: (with the globals
+of its module) to report the queries which can't be translated.  The plans
+themselves are not kept: they depend on the values of the names of the query
+when it runs.
+
+The exit status is 1 if a module couldn't be imported or a query couldn't be
+decompiled or translated.
+
+'''
+
+import argparse
+import ast
+import importlib
+import os
+import pkgutil
+import sys
+import types
+
+
+#: The names of the functions whose first argument is a query expression.
+QUERY_FUNCTIONS = ('get_query_object', 'these', 'normalize_query')
+
+#: The names of the functions whose first argument is a predicate.
+PREDICATE_FUNCTIONS = ('get_predicate_object', )
+
+
+def precompile(packages, translate=True, out=None, err=None):
+    '''Decompile the queries of the `packages` (names of packages or
+    modules).
+
+    Write a line to `out` (the standard output by default) for each module
+    with queries, and the errors to `err` (the standard error).  Return the
+    number of errors.
+
+    '''
+    out = out or sys.stdout
+    err = err or sys.stderr
+    errors = 0
+    caches = {}
+    for module, error in _get_modules(packages):
+        if error is not None:
+            print('%s: cannot import: %s' % (module, error), file=err)
+            errors += 1
+            continue
+        filename = getattr(module, '__file__', None) or ''
+        if not filename.endswith('.py'):
+            continue
+        with open(filename, 'rb') as file:
+            source = file.read()
+        count = 0
+        for code in find_queries(source, filename):
+            count += 1
+            error = _precompile(code, module, translate, caches)
+            if error is not None:
+                print('%s:%d: %s' % (filename, code.co_firstlineno, error),
+                      file=err)
+                errors += 1
+        if count:
+            print('%s: %d queries' % (module.__name__, count), file=out)
+    for cache in caches.values():
+        cache.close()
+    return errors
+
+
+def find_queries(source, filename='<unknown>'):
+    '''Return the code objects of the queries in the `source` of a module.
+
+    The queries are the generator expressions and lambdas in the first
+    argument of calls to the functions in `QUERY_FUNCTIONS`:data: and
+    `PREDICATE_FUNCTIONS`:data:, respectively.
+
+    '''
+    lines = {'<genexpr>': set(), '<lambda>': set()}
+    for node in ast.walk(ast.parse(source, filename)):
+        if isinstance(node, ast.Call) and node.args:
+            name = _get_name(node.func)
+            arg = node.args[0]
+            if name in QUERY_FUNCTIONS and \
+                    isinstance(arg, ast.GeneratorExp):
+                lines['<genexpr>'].add(arg.lineno)
+            elif name in PREDICATE_FUNCTIONS and \
+                    isinstance(arg, ast.Lambda):
+                lines['<lambda>'].add(arg.lineno)
+    # Several queries in the same line can't be told apart from the other
+    # generator expressions (or lambdas) of the line; they are all taken.
+    return [
+        code
+        for code in _get_codes(compile(source, filename, 'exec'))
+        if code.co_firstlineno in lines.get(code.co_name, ())
+    ]
+
+
+def _precompile(code, module, translate, caches):
+    # Decompile the `code` and add its QST to the cache of its directory.
+    # Return the error, if any.
+    from xotl.ql.core import QueryObject, Frame
+    from xotl.ql.revenge import Uncompyled
+    from xotl.ql.revenge.cache import QSTCache
+    try:
+        qst = Uncompyled(code).qst
+    except Exception as error:
+        return 'cannot decompile: %r' % error
+    directory = os.path.join(os.path.dirname(code.co_filename),
+                             '__pycache__')
+    cache = caches.get(directory)
+    if cache is None:
+        cache = caches[directory] = QSTCache(directory)
+        cache.clear()
+    cache.put(code, qst)
+    if translate:
+        from xotl.ql.translation.py import NaivePythonExecutionPlan
+        query = QueryObject(qst, Frame({}, vars(module)))
+        try:
+            NaivePythonExecutionPlan(query)
+        except Exception as error:
+            return 'cannot translate: %r' % error
+    return None
+
+
+def _get_modules(names):
+    # Import the modules and the packages in `names` and all the modules of
+    # the packages.  Yield pairs of the module (or its name, if it failed)
+    # and the error.
+    for name in names:
+        try:
+            module = importlib.import_module(name)
+        except Exception as error:
+            yield name, error
+            continue
+        yield module, None
+        path = getattr(module, '__path__', None)
+        if path is not None:
+            errors = []
+            for _, name, _ in pkgutil.walk_packages(path, name + '.',
+                                                    onerror=errors.append):
+                try:
+                    module = importlib.import_module(name)
+                except Exception as error:
+                    yield name, error
+                else:
+                    yield module, None
+            for name in errors:
+                yield name, 'cannot import the package'
+
+
+def _get_codes(code):
+    # The code objects nested in `code`.
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield const
+            yield from _get_codes(const)
+
+
+def _get_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        return node.attr
+    else:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m xotl.ql.precompile',
+        description='Decompile the queries of packages ahead of time.'
+    )
+    parser.add_argument('packages', nargs='+', metavar='package',
+                        help='a package or module to import')
+    parser.add_argument('--no-translate', dest='translate',
+                        action='store_false',
+                        help="don't translate the queries")
+    args = parser.parse_args(argv)
+    return 1 if precompile(args.packages, translate=args.translate) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
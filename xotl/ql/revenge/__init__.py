@@ -15,12 +15,21 @@
 #
 #
 
+import os
 import types
+from functools import lru_cache
 from xoutil.objects import memoized_property
 
-from . import scanners, walkers
-from .scanners import getscanner   # noqa:  exported
-from .parsers import ParserError
+# The scanners, the parsers and the walkers (and the grammar of the parser)
+# are imported when the first code object is decompiled, so that importing
+# the package is fast.
+from .exceptions import ParserError
+
+
+def getscanner(*args, **kwargs):
+    '''Return a scanner (see `xotl.ql.revenge.scanners.getscanner`).'''
+    from .scanners import getscanner
+    return getscanner(*args, **kwargs)
 
 
 class Uncompyled:
@@ -28,6 +37,7 @@ class Uncompyled:
     '''
     def __init__(self, obj, version=None, get_current_thread=None,
                  islambda=False, hasnone=False):
+        from . import scanners, walkers
         code = self._extract_code(obj)
         self.code = code
         if get_current_thread:
@@ -108,3 +118,85 @@ class Uncompyled:
             return obj.__code__
         else:
             raise TypeError('Invalid code object')
+
+
+# The maximum number of code objects kept by `get_qst`:func:.
+QST_CACHE_SIZE = 1024
+
+
+def get_qst(code, islambda=False):
+    '''Return the QST of the `code` object.
+
+    Results are memoized by code object, so that lambdas and comprehensions
+    which appear in many queries are decompiled once per process.  Each call
+    returns a fresh copy of the QST, the caller may modify it.
+
+    The QST is read from the on-disk cache (see `set_qst_cache`:func:) or
+    from the QSTs precompiled for the module of the code (see
+    `xotl.ql.precompile`:mod:) when they have it.
+
+    '''
+    from copy import deepcopy
+    return deepcopy(_get_shared_qst(code, islambda))
+
+
+@lru_cache(maxsize=QST_CACHE_SIZE)
+def _get_shared_qst(code, islambda):
+    # The returned QST is shared between callers; don't modify it.
+    cache = _qst_cache
+    for source in (cache, _get_precompiled(code)):
+        if source is not None:
+            result = source.get(code, islambda)
+            if result is not None:
+                return result
+    hasnone = 'None' in code.co_names
+    result = Uncompyled(code, islambda=islambda, hasnone=hasnone).qst
+    if cache is not None:
+        cache.put(code, result, islambda)
+    return result
+
+
+get_qst.cache_info = _get_shared_qst.cache_info
+get_qst.cache_clear = _get_shared_qst.cache_clear
+
+
+# The on-disk cache used by `get_qst`:func:.
+_qst_cache = None
+
+
+def set_qst_cache(cache):
+    '''Set the on-disk cache of QSTs used by `get_qst`:func:.
+
+    `cache` is a `~xotl.ql.revenge.cache.QSTCache`:class: or the name of its
+    directory.  If None, the on-disk cache is not used.  Return the previous
+    cache.
+
+    '''
+    global _qst_cache
+    from .cache import QSTCache
+    if cache is not None and not isinstance(cache, QSTCache):
+        cache = QSTCache(cache)
+    result, _qst_cache = _qst_cache, cache
+    return result
+
+
+# The caches written by xotl.ql.precompile, by directory (None if the
+# directory has none).
+_precompiled = {}
+
+
+def _get_precompiled(code):
+    # The cache of the QSTs precompiled for the module of `code`.
+    filename = code.co_filename
+    if not os.path.isabs(filename):
+        return None
+    directory = os.path.join(os.path.dirname(filename), '__pycache__')
+    try:
+        return _precompiled[directory]
+    except KeyError:
+        from .cache import QSTCache
+        cache = QSTCache(directory)
+        if not os.path.exists(cache.path):
+            cache = None
+        _precompiled[directory] = cache
+        return cache
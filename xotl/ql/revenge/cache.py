@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''An on-disk cache of the QST of code objects.
+
+Processes that start often decompile the same queries every time.  A
+`QSTCache`:class: keeps the QSTs in a directory (like ``__pycache__`` keeps
+byte-code), so that other processes read them instead::
+
+    from xotl.ql.revenge import set_qst_cache
+    set_qst_cache('/var/cache/myapp/queries')
+
+The QSTs are keyed by a hash of the code object (its byte-code, constants,
+names and arguments), the version of the interpreter and of this package.
+All the QSTs of an interpreter are in a single file where new QSTs are
+appended; the file is mapped in memory (see `mmap`:mod:) and indexed the
+first time it's needed.
+
+'''
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import types
+
+
+# Each record in the file is the key, the length of the QST and the QST (in
+# the format of xotl.ql.serialization.dump_qst).
+_KEY_SIZE = hashlib.sha256().digest_size
+_LENGTH = struct.Struct('<I')
+_HEADER_SIZE = _KEY_SIZE + _LENGTH.size
+
+
+class QSTCache:
+    '''A cache of QSTs in the `directory`.
+
+    Several processes can share the directory.  The directory is created if
+    needed.  Errors writing to the cache are ignored, so a read-only cache
+    can be used too.
+
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(
+            directory,
+            'qst.%s.cache' % sys.implementation.cache_tag
+        )
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._index = {}
+        self._map = None
+        self._size = 0
+
+    def get(self, code, islambda=False):
+        '''Return the QST of the `code` object, or None if not cached.'''
+        from xotl.ql.serialization import load_qst
+        key = get_key(code, islambda)
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                self._refresh()
+                location = self._index.get(key)
+            if location is not None:
+                start, end = location
+                data = self._map[start:end]
+            else:
+                data = None
+        if data is not None:
+            try:
+                result = load_qst(data)
+            except ValueError:
+                result = None
+        else:
+            result = None
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, code, qst, islambda=False):
+        '''Add the `qst` of the `code` object to the cache.'''
+        from xotl.ql.serialization import dump_qst
+        data = dump_qst(qst)
+        record = get_key(code, islambda) + _LENGTH.pack(len(data)) + data
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # A single write in append mode, so that the records of
+            # concurrent processes are not mixed.
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def clear(self):
+        '''Remove all the QSTs of the cache.'''
+        with self._lock:
+            self._reset()
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        '''Release the memory map of the file.'''
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._index = {}
+        self._size = 0
+
+    def _refresh(self):
+        # Map the file again if it grew (other processes add QSTs) and index
+        # the new records.  An incomplete record at the end is skipped until
+        # it's complete.
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self._size:
+            self._reset()   # The file was replaced.
+        if size <= self._size or size < _HEADER_SIZE:
+            return
+        with open(self.path, 'rb') as file:
+            map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map is not None:
+            self._map.close()
+        self._map = map
+        size = len(map)
+        position = self._size
+        while position + _HEADER_SIZE <= size:
+            start = position + _HEADER_SIZE
+            key = map[position:position + _KEY_SIZE]
+            length, = _LENGTH.unpack(map[start - _LENGTH.size:start])
+            if start + length > size:
+                break
+            self._index[key] = (start, start + length)
+            position = start + length
+        self._size = position
+
+
+def get_key(code, islambda=False):
+    '''Return the key of the QST of the `code` object.
+
+    The key is a hash of everything the decompiler uses: the byte-code, the
+    constants (including nested code objects), the names and the arguments
+    of `code`; the version of the interpreter and the version of this
+    package and of the format of the QST.
+
+    '''
+    from xotl.ql.release import VERSION
+    from xotl.ql.serialization import VERSION as FORMAT
+    hasher = hashlib.sha256()
+    hasher.update(('%s %s %s %d\0' % (sys.version, VERSION, FORMAT,
+                                      islambda)).encode('utf-8'))
+    _update(hasher, code)
+    return hasher.digest()
+
+
+def _update(hasher, value):
+    # Feed the `value` to the `hasher` in a form which doesn't depend on the
+    # process (the order of frozensets depends on the hash of its items).
+    if isinstance(value, types.CodeType):
+        hasher.update(b'C')
+        hasher.update(value.co_code)
+        for attr in ('co_names', 'co_varnames', 'co_freevars',
+                     'co_cellvars', 'co_argcount', 'co_kwonlyargcount',
+                     'co_flags', 'co_consts'):
+            _update(hasher, getattr(value, attr))
+    elif isinstance(value, (tuple, frozenset)):
+        items = value
+        if isinstance(value, frozenset):
+            items = sorted(value, key=repr)
+        hasher.update(b'(' if isinstance(value, tuple) else b'{')
+        for item in items:
+            _update(hasher, item)
+        hasher.update(b')')
+    else:
+        hasher.update(('%s:%r\0' % (type(value).__name__,
+                                    value)).encode('utf-8',
+                                                   'surrogatepass'))
@@ -211,21 +211,21 @@ class InstructionSetBuilder:
 
     def _resolve(self):
         instrs = self.instructions
-        targets = []
+        targets = set()
         for instr in instrs:
             if instr.opcode in dis.hasjabs and isinstance(instr.arg, label):
                 arg = instr.arg = instrs[self.labels[instr.arg]].offset
                 instr.argval = arg
                 instr.argrepr = ''
-                targets.append(arg)
+                targets.add(arg)
             elif instr.opcode in dis.hasjrel and isinstance(instr.arg, label):
                 target = instrs[self.labels[instr.arg]]
                 instr.arg = arg = target.offset - instr.size - instr.offset
                 instr.argval = target.offset
                 instr.argrepr = 'to %d' % target.offset
-                targets.append(target)
+                targets.add(target.offset)
             elif instr.opcode in dis.hasjrel or instr.opcode in dis.hasjabs:
-                targets.append(instr.target)
+                targets.add(instr.target)
         for instr in instrs:
             instr.is_jump_target = instr.offset in targets
 
@@ -491,14 +491,20 @@ class Scanner:
         self.setTokenClass()
 
     def disassemble(self, co, normalize=True):
-        'Produce the tokens for the code.'
+        '''Produce the tokens for the code.
+
+        :keyword normalize: If True, use the default `normalizer`:obj:.  If
+                 False don't normalize the byte-code.  It may also be a
+                 `Normalizer`:class: or a sequence of passes which are
+                 composed like functions: the last one is applied first.
+
+        '''
         if normalize is True:
-            normalize = keep_single_return
+            normalize = normalizer
         elif normalize is False:
-            normalize = lambda x: x
-        else:
-            from xoutil.fp.tools import compose
-            normalize = compose(*normalize)
+            normalize = lambda x: [Instruction(i) for i in x]
+        elif not isinstance(normalize, Normalizer):
+            normalize = Normalizer(*reversed(normalize))
         result = []
         customizations = {}
         # The 'jumps' is filled by the `detect_structure` closure function
@@ -651,7 +657,7 @@ class Scanner:
             customizations[opname] = arg
             instruction.opname = opname
 
-        instructions = list(normalize(Instruction(i) for i in Bytecode(co)))
+        instructions = normalize(Bytecode(co))
         targets = find_jump_targets(instructions)
         for index, instruction in enumerate(instructions):
             opcode = instruction.opcode
@@ -842,6 +848,143 @@ def getscanner(version=None, get_current_thread=get_ident):
     return result
 
 
+class Normalizer:
+    '''A fused pipeline of byte-code normalization passes.
+
+    A normalizer is a callable that takes an iterable of `instructions
+    <Instruction>`:class: and returns the list of normalized instructions.
+    The instructions are copied exactly once, then each registered pass is
+    applied in order and, at the very end, offsets and jumps are relocated in
+    a single step.
+
+    A *pass* is any callable that takes the list of instructions and returns
+    an iterable of instructions (it may return the same list after
+    modifying it in place).  Passes don't need to recompute offsets: every
+    instruction should keep the offset it had when the pass received it and
+    jumps must keep their target (the `argval`) in the same coordinates.  An
+    instruction that replaces another takes its offset.  NOPs are removed
+    during the relocation step, so a pass can simply drop an instruction or
+    replace it with a NOP.
+
+    Passes are registered with `register`:meth:, which may be used as a
+    decorator::
+
+        normalizer = Normalizer(single_return_pass)
+
+        @normalizer.register
+        def my_pass(instructions):
+            ...
+            return instructions
+
+    Since the old-style normalization functions (`keep_single_return`:func:,
+    etc.) also keep the offsets consistent with the targets, they are valid
+    passes, albeit not fused.
+
+    '''
+    def __init__(self, *passes):
+        self.passes = list(passes)
+
+    def register(self, pass_):
+        '''Register `pass_` at the end of the pipeline.'''
+        self.passes.append(pass_)
+        return pass_
+
+    def __call__(self, instructions):
+        instructions = [Instruction(i) for i in instructions]
+        for pass_ in self.passes:
+            instructions = pass_(instructions)
+        return _relocate(instructions)
+
+
+def _relocate(instructions):
+    '''Assign new offsets and update the jumps of `instructions`.
+
+    NOPs are removed; jumps to a NOP are redirected to the next instruction.
+
+    '''
+    # The relocation table maps the offset of each instruction (as seen by the
+    # passes) to its final offset.  If several instructions share an offset,
+    # the first one wins.
+    relocations = {}
+    removed = []
+    result = []
+    offset = oldend = 0
+    for instr in instructions:
+        oldend = instr.offset + instr.size
+        if instr.opcode == NOP:
+            removed.append(instr.offset)
+            continue
+        for old in removed:
+            relocations.setdefault(old, offset)
+        del removed[:]
+        relocations.setdefault(instr.offset, offset)
+        instr.offset = offset
+        offset += instr.size
+        result.append(instr)
+    end = offset
+    for old in removed:
+        relocations.setdefault(old, end)
+    relocations.setdefault(oldend, end)
+    targets = set()
+    for instr in result:
+        if instr.opcode in dis.hasjabs:
+            instr.arg = instr.argval = target = relocations.get(instr.argval,
+                                                                end)
+            instr.argrepr = ''
+            targets.add(target)
+        elif instr.opcode in dis.hasjrel:
+            target = relocations.get(instr.argval, end)
+            instr.arg = target - instr.offset - instr.size
+            instr.argval = target
+            instr.argrepr = 'to %d' % target
+            targets.add(target)
+    for instr in result:
+        instr.is_jump_target = instr.offset in targets
+    return result
+
+
+def single_return_pass(instructions):
+    '''Replace all but the last RETURN_VALUE with a jump to the last one.
+
+    This is the `pass <Normalizer>`:class: behind `keep_single_return`:func:.
+
+    '''
+    last = instructions[-1] if instructions else None
+    if last is not None and last.opcode == RETURN_VALUE:
+        for index, inst in enumerate(instructions[:-1]):
+            if inst.opcode == RETURN_VALUE:
+                instructions[index] = Instruction(
+                    opname='JUMP_FORWARD', opcode=JUMP_FORWARD,
+                    arg=last.offset, argval=last.offset, argrepr='',
+                    offset=inst.offset, starts_line=inst.starts_line
+                )
+    return instructions
+
+
+def pypy_conditional_pass(instructions):
+    '''Replace the jumps that target a RETURN_VALUE with a RETURN_VALUE.
+
+    This is the `pass <Normalizer>`:class: behind
+    `normalize_pypy_conditional`:func:.
+
+    '''
+    JUMP_ABS, JUMP_FWD = JUMP_ABSOLUTE, JUMP_FORWARD  # noqa
+    RET = RETURN_VALUE  # noqa
+    returns = {i.offset for i in instructions if i.opcode == RET}
+    for index, i in enumerate(instructions):
+        if i.opcode in (JUMP_ABS, JUMP_FWD) and i.argval in returns:
+            instructions[index] = Instruction(
+                opname='RETURN_VALUE', opcode=RET,
+                arg=None, argval=None, argrepr='',
+                offset=i.offset, starts_line=i.starts_line
+            )
+    return instructions
+
+
+# The normalizer used by `Scanner.disassemble` by default.
+normalizer = Normalizer(single_return_pass)
+
+
 def without_nops(instructions):
     '''Return the same instruction set with NOPs removed.
 
@@ -851,42 +994,10 @@ def without_nops(instructions):
 
     :param instructions:  An iterable of `instructions <Instruction>`:class:.
 
-    :return: A generator of instructions.
+    :return: A list of instructions.
 
     '''
-    # Builds a map from current offset to offsets discounting NOPs.
-    addrmap = []
-    nops = 0
-    instructions = list(instructions)   # Consume the iterator once.
-    for i in instructions:
-        addrmap[i.offset:i.offset + i.size] = list(range(i.offset - nops, i.offset + i.size - nops))
-        if i.opcode == NOP:
-            nops += 1
-    args = []
-    offset = 0
-    targets = []
-    for i in instructions:
-        vals = dict(i._asdict())
-        vals['offset'] = offset
-        if i.opcode in dis.hasjabs:
-            vals['arg'] = vals['argval'] = target = addrmap[i.arg]
-            targets.append(target)
-        elif i.opcode in dis.hasjrel:
-            offset = i.offset
-            size = i.size
-            target = offset + i.arg + size
-            newoffset = addrmap[offset]
-            newtarget = addrmap[target]
-            targets.append(newtarget)
-            vals['arg'] = vals['argval'] = newtarget - newoffset - size
-        if i.opcode != NOP:
-            args.append(vals)
-            offset += i.size
-    # Unfortunately we need a third pass to adjust the is_jump_target
-    for vals in args:
-        offset = vals['offset']
-        vals['is_jump_target'] = offset in targets
-        yield Instruction(**vals)
+    return Normalizer()(instructions)
 
 
 def keep_single_return(instructions):
@@ -907,36 +1018,7 @@ def keep_single_return(instructions):
     :rtype: list
 
     '''
-    instructions = list(instructions)
-    last = instructions[-1]
-    if last.opcode == RETURN_VALUE:
-        builder = InstructionSetBuilder()
-        lastlabel = label('previous-offset-%s' % last.offset)
-        l = len(instructions) - 1  # noqa: E741
-        with builder() as Instruction:
-            for index, inst in enumerate(instructions):
-                opname = inst.opname
-                opcode = inst.opcode
-                arg = inst.arg
-                argval = inst.argval
-                argrepr = inst.argrepr
-                starts_line = inst.starts_line
-                this = 'previous-offset-%s' % inst.offset
-                if opcode == RETURN_VALUE:
-                    if index != l:
-                        # Don't replace the last RETURN_VALUE, but when doing
-                        # it, make the jump go the last label.
-                        opcode = JUMP_FORWARD
-                        opname = 'JUMP_FORWARD'
-                        arg = lastlabel
-                elif opcode in ANY_JUMPs:
-                    arg = label('previous-offset-%s' % inst.target)
-                Instruction(label=this, opname=opname, opcode=opcode, arg=arg,
-                            argval=argval, argrepr=argrepr,
-                            starts_line=starts_line)
-        return list(builder)
-    else:
-        return instructions
+    return Normalizer(single_return_pass)(instructions)
 
 
 def normalize_pypy_conditional(instructions):
@@ -945,40 +1027,19 @@ def normalize_pypy_conditional(instructions):
     The pypy normalization rule states that:
 
       If the target of a ``JUMP_FORWARD`` (or ``JUMP_ABSOLUTE``) is a
-      ``RETURN_VALUE`` replace the JUMP with the following instructions::
-
-        RETURN_VALUE
-        NOP
-        NOP
+      ``RETURN_VALUE`` replace the JUMP with a ``RETURN_VALUE``.
 
     This rule does not only apply when using Pypy, the name simply comes
     because Pypy compiles conditional expressions using JUMPs.
 
+    Offsets and jump targets are updated.
+
     :param instructions:  An iterable of `instructions <Instruction>`:class:.
 
-    :return: A generator of instructions.
+    :return: A list of instructions.
 
     '''
-    JUMP_ABS, JUMP_FWD = JUMP_ABSOLUTE, JUMP_FORWARD  # noqa
-    RET = RETURN_VALUE  # noqa
-    instructions = list(instructions)  # Consume an iterator only once.
-    index = {i.offset: i for i in instructions}
-    for i in instructions:
-        fwdtarget = i.offset + i.arg + i.size if i.opcode == JUMP_FWD else None
-        if i.opcode == JUMP_ABS and index[i.arg].opcode == RET \
-           or i.opcode == JUMP_FWD and index[fwdtarget].opcode == RET:
-            yield Instruction(opname='RETURN_VALUE', opcode=RET,
-                              arg=None, argval=None, argrepr='',
-                              offset=i.offset, starts_line=i.starts_line,
-                              is_jump_target=i.is_jump_target)
-            yield Instruction(opname='NOP', opcode=NOP, arg=None, argval=None,
-                              argrepr='', offset=i.offset+1, starts_line=None,
-                              is_jump_target=False)
-            yield Instruction(opname='NOP', opcode=NOP, arg=None, argval=None,
-                              argrepr='', offset=i.offset+2, starts_line=None,
-                              is_jump_target=False)
-        else:
-            yield Instruction(i)
+    return Normalizer(pypy_conditional_pass)(instructions)
 
 
 def xdis(f, native=False, normalize=True):
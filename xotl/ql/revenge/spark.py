@@ -31,8 +31,8 @@ __version__ = 'SPARK-0.7 (pre-alpha-7) xotl.ql.revenge - 0.3.0'
 from xoutil.eight import range
 
 
-def _namelist(instance):
-    namelist, namedict, classlist = [], {}, [instance.__class__]
+def _namelist(cls):
+    namelist, namedict, classlist = [], {}, [cls]
     for c in classlist:
         for b in c.__bases__:
             classlist.append(b)
@@ -141,8 +141,12 @@ class GenericParser:
         return str('\n').join(result)
 
     def addRule(self, doc, func, _preprocess=1):
-        doc = self.strip_comments(doc)
-        fn = func
+        self._addRules(self.parse_rules(doc), func, _preprocess)
+
+    @classmethod
+    def parse_rules(cls, doc):
+        '''Return the list of the productions ``(lhs, rhs)`` in `doc`.'''
+        doc = cls.strip_comments(doc)
         rules = doc.split()
 
         # First, detect all lines where a new production is given.
@@ -154,17 +158,23 @@ class GenericParser:
 
         # Now process each rule add it the rules.  We take care of making of
         # splitting right hand sides with vertical bars into several rules.
+        result = []
         for i in range(len(index)-1):
             lhs = rules[index[i]]
             rhss = rules[index[i]+2:index[i+1]]
-            lhs_rules = self.rules.setdefault(lhs, [])
             for rhs in iter_rhss(rhss):
-                rule = (lhs, tuple(rhs))
-                if _preprocess:
-                    rule, fn = self.preprocess(rule, func)
-                lhs_rules.append(rule)
-                self.rule2func[rule] = fn
-                self.rule2name[rule] = func.__name__[2:]
+                result.append((lhs, tuple(rhs)))
+        return result
+
+    def _addRules(self, productions, func, _preprocess=1):
+        fn = func
+        name = func.__name__[2:]
+        for rule in productions:
+            if _preprocess:
+                rule, fn = self.preprocess(rule, func)
+            self.rules.setdefault(rule[0], []).append(rule)
+            self.rule2func[rule] = fn
+            self.rule2name[rule] = name
         self.ruleschanged = 1
 
     @classmethod
@@ -217,12 +227,27 @@ class GenericParser:
         return doc, rules
 
     def collectRules(self):
-        for name in _namelist(self):
-            if name[:2] == 'p_':
-                func = getattr(self, name)
-                doc = func.__doc__
-                _intro, rules = self.find_rules(doc)
-                self.addRule(rules, func)
+        for name, productions in self.get_grammar():
+            self._addRules(productions, getattr(self, name))
+
+    @classmethod
+    def get_grammar(cls):
+        '''Return the productions in the docstrings of the ``p_`` methods.
+
+        The docstrings are read only once per class (when the first parser is
+        created), the result is a list of pairs of the name of each method
+        and its productions.
+
+        '''
+        grammar = cls.__dict__.get('_grammar')
+        if grammar is None:
+            grammar = []
+            for name in _namelist(cls):
+                if name[:2] == 'p_':
+                    _intro, rules = cls.find_rules(getattr(cls, name).__doc__)
+                    grammar.append((name, cls.parse_rules(rules)))
+            cls._grammar = grammar
+        return grammar
 
     def augment(self, start):
         rule = '%s ::= %s %s' % (self._START, self._BOF, start)
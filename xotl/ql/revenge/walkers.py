@@ -70,16 +70,12 @@ class QstBuilder(GenericASTTraversal):
             # the vararg (or None), and the name of the kwarg (or None) of the
             # qst.Lambda, the values of the `defaults` are to be complete by
             # the n_mklamdbda_exit.
-            from . import Uncompyled
+            from . import get_qst
             load_lambda = node[0]
             code = load_lambda.argval
-            hasnone = 'None' in code.co_names
-            uncompyled = Uncompyled(code,
-                                    islambda=islambda,
-                                    hasnone=hasnone)
-            # XXX: uncompyled.qst will contain a qst.Expression, but we need
-            # to keep only the body.
-            self._stack.append(uncompyled.qst.body)
+            # XXX: get_qst will return a qst.Expression, but we need to keep
+            # only the body.
+            self._stack.append(get_qst(code, islambda=islambda).body)
             # Argument names are the first of co_varnames
             argcount = code.co_argcount
             varnames = code.co_varnames
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''A binary format for query objects.
+
+`dumps`:func: serializes a `query object`:term: (its QST, the values of its
+free names and its other attributes) without the frame that created it, so
+that the query can be cached on disk or sent to another process and run
+there without decompiling it again::
+
+    data = dumps(query)
+    query = loads(data)
+
+Query objects can be pickled too (which uses this format).
+
+The QST is written in a compact form which only depends on the names of the
+node types and their fields, so that it can be read by other versions of
+Python.  The values of the free names, and the other attributes of the query
+object, are pickled.  Functions given by lambdas (like the keys of the
+ordering) are written as their QST and the values of their free names.
+Sub-queries are written like the query.
+
+.. warning:: Like `pickle`:mod:, `loads`:func: can run arbitrary code.  Only
+   load data from trusted sources.
+
+'''
+
+import ast
+import io
+import pickle
+import struct
+import types
+
+from xoutil.objects import import_object
+from xoutil.symbols import Unset
+
+from xotl.ql.revenge import qst as _qst
+
+
+#: The version of the format written by `dumps`:func:.
+VERSION = 1
+
+_MAGIC = b'XQL'
+
+#: The versions of the format `loads`:func: can read.
+_SUPPORTED_VERSIONS = (1, )
+
+# The attributes of query objects which are not written: the frame and the
+# query expression (or the predicate) are replaced, and the others are
+# computed again.
+_FRAME_ATTRIBUTES = ('_frame', 'locals', 'globals', 'source')
+_EXPRESSION_ATTRIBUTES = ('expression', 'predicate')
+
+
+def dumps(obj):
+    '''Return the bytes of `obj`.
+
+    `obj` can be a query object, a QST node or any object which can be
+    pickled.  Values which can't be pickled raise the same errors as
+    `pickle.dumps`:func:.
+
+    '''
+    buffer = io.BytesIO()
+    buffer.write(_MAGIC + bytes([VERSION]))
+    _Pickler(buffer).dump(obj)
+    return buffer.getvalue()
+
+
+def loads(data):
+    '''Return the object in `data` (as written by `dumps`:func:).
+
+    Query objects are loaded with a frame that contains the values of their
+    free names.
+
+    Raise ValueError if `data` is not in the format, or in a version of the
+    format which is not supported.
+
+    '''
+    data = bytes(data)
+    if data[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('Not a serialized query')
+    version = data[len(_MAGIC)] if len(data) > len(_MAGIC) else None
+    if version not in _SUPPORTED_VERSIONS:
+        raise ValueError('Unsupported version of the format: %r' % version)
+    buffer = io.BytesIO(data)
+    buffer.seek(len(_MAGIC) + 1)
+    return _Unpickler(buffer).load()
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file, protocol=4)
+
+    def persistent_id(self, obj):
+        from xotl.ql.core import this
+        from xotl.ql.interfaces import QueryObject
+        if obj is this:
+            return ('this', )
+        elif isinstance(obj, ast.AST):
+            return ('qst', dump_qst(obj))
+        elif isinstance(obj, QueryObject) and hasattr(obj, '_frame'):
+            return ('query', type(obj)) + _get_query_state(obj)
+        elif isinstance(obj, types.FunctionType) and \
+                obj.__name__ == '<lambda>':
+            return ('lambda', ) + _get_lambda_state(obj)
+        else:
+            return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        kind, args = pid[0], pid[1:]
+        if kind == 'this':
+            from xotl.ql.core import this
+            return this
+        elif kind == 'qst':
+            return load_qst(*args)
+        elif kind == 'query':
+            return _make_query(*args)
+        elif kind == 'lambda':
+            return _make_lambda(*args)
+        else:
+            raise pickle.UnpicklingError('Unknown object: %r' % kind)
+
+
+def _get_query_state(query):
+    # The attributes and the values of the free names of the `query`.
+    from xotl.ql.tools import detect_names
+    qst = query.qst
+    attrs = {
+        attr: value
+        for attr, value in vars(query).items()
+        if attr not in _FRAME_ATTRIBUTES
+    }
+    attrs['qst'] = qst
+    for attr in _EXPRESSION_ATTRIBUTES:
+        if attr in attrs:
+            attrs[attr] = None
+    frame = query._frame
+    names = detect_names(qst)
+    return (
+        attrs,
+        _get_values(query.locals, names),
+        _get_values(query.globals, names),
+        getattr(frame, 'auto_expand_subqueries', True),
+    )
+
+
+def _make_query(cls, attrs, locals, globals, auto_expand_subqueries):
+    query = cls.__new__(cls)
+    vars(query).update(attrs)
+    FrameType = import_object(cls.frame_type)
+    query._frame = FrameType(locals, globals,
+                             auto_expand_subqueries=auto_expand_subqueries)
+    return query
+
+
+def _get_values(mapping, names):
+    result = {}
+    for name in names:
+        value = mapping.get(name, Unset)
+        if value is not Unset:
+            result[name] = value
+    return result
+
+
+def _get_lambda_state(function):
+    # Lambdas are written as their arguments, their QST and the values of
+    # their free names.
+    from xotl.ql.revenge import Uncompyled
+    from xotl.ql.tools import detect_names
+    code = function.__code__
+    if code.co_flags & (_CO_VARARGS | _CO_VARKEYWORDS) or \
+            code.co_kwonlyargcount:
+        raise pickle.PicklingError(
+            'Only lambdas with positional arguments can be serialized'
+        )
+    qst = Uncompyled(function).qst
+    args = code.co_varnames[:code.co_argcount]
+    closure = function.__closure__ or ()
+    namespace = dict(zip(code.co_freevars,
+                         (cell.cell_contents for cell in closure)))
+    values = _get_values(namespace, detect_names(qst) - set(args))
+    values.update(_get_values(function.__globals__,
+                              detect_names(qst) - set(args) - set(values)))
+    return args, function.__defaults__ or (), qst, values
+
+
+def _make_lambda(args, defaults, qst, values):
+    function = ast.parse('lambda: None', mode='eval').body
+    names = ['__x_default_%d' % i for i in range(len(defaults))]
+    function.args.args = [ast.arg(arg, None) for arg in args]
+    function.args.defaults = [ast.Name(name, ast.Load()) for name in names]
+    function.body = qst.body if isinstance(qst, ast.Expression) else qst
+    namespace = dict(values, **dict(zip(names, defaults)))
+    expression = ast.fix_missing_locations(ast.Expression(function))
+    return eval(compile(expression, '<lambda>', 'eval'), namespace)
+
+
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+
+# The compact format of the QST.  Each value is a tag byte followed by its
+# data.  Strings are written once: later occurrences refer to the first by
+# its index.  Nodes are written as the name of their type, the number of
+# fields and the pairs of the name and the value of each field.
+_NONE, _TRUE, _FALSE = b'N', b'T', b'F'
+_INT, _FLOAT, _COMPLEX = b'i', b'd', b'c'
+_STR, _STR_REF, _BYTES = b's', b'r', b'b'
+_LIST, _TUPLE, _NODE = b'l', b't', b'A'
+
+_DOUBLE = struct.Struct('<d')
+
+
+def dump_qst(node):
+    '''Return the bytes of the QST `node` in the compact format.'''
+    writer = _QSTWriter()
+    writer.write(node)
+    return bytes(writer.buffer)
+
+
+def load_qst(data):
+    '''Return the QST written by `dump_qst`:func: in `data`.
+
+    The nodes are instances of the classes in `xotl.ql.revenge.qst`:mod:.
+    Fields missing in `data` (written by another version of Python) get
+    their default value.
+
+    '''
+    return _QSTReader(data).read()
+
+
+class _QSTWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.strings = {}
+
+    def write(self, value):
+        buffer = self.buffer
+        if value is None:
+            buffer += _NONE
+        elif value is True:
+            buffer += _TRUE
+        elif value is False:
+            buffer += _FALSE
+        elif isinstance(value, int):
+            buffer += _INT
+            self.write_size(value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, float):
+            buffer += _FLOAT + _DOUBLE.pack(value)
+        elif isinstance(value, complex):
+            buffer += _COMPLEX + _DOUBLE.pack(value.real) + \
+                _DOUBLE.pack(value.imag)
+        elif isinstance(value, str):
+            self.write_str(value)
+        elif isinstance(value, bytes):
+            buffer += _BYTES
+            self.write_size(len(value))
+            buffer += value
+        elif isinstance(value, (list, tuple)):
+            buffer += _LIST if isinstance(value, list) else _TUPLE
+            self.write_size(len(value))
+            for item in value:
+                self.write(item)
+        elif isinstance(value, ast.AST):
+            fields = [field for field in value._fields
+                      if hasattr(value, field)]
+            buffer += _NODE
+            self.write_str(type(value).__name__)
+            self.write_size(len(fields))
+            for field in fields:
+                self.write_str(field)
+                self.write(getattr(value, field))
+        else:
+            raise TypeError('Invalid value in a QST: %r' % value)
+
+    def write_str(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            self.strings[value] = len(self.strings)
+            data = value.encode('utf-8', 'surrogatepass')
+            self.buffer += _STR
+            self.write_size(len(data))
+            self.buffer += data
+        else:
+            self.buffer += _STR_REF
+            self.write_size(index)
+
+    def write_size(self, value):
+        # An unsigned integer in groups of 7 bits, the least significant
+        # first; the high bit is set in all the bytes but the last.
+        buffer = self.buffer
+        while value > 0x7F:
+            buffer.append(value & 0x7F | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+
+class _QSTReader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.strings = []
+
+    def read(self):
+        tag = self.read_bytes(1)
+        if tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            value = self.read_size()
+            return value // 2 if not value & 1 else -(value + 1) // 2
+        elif tag == _FLOAT:
+            return _DOUBLE.unpack(self.read_bytes(8))[0]
+        elif tag == _COMPLEX:
+            real, = _DOUBLE.unpack(self.read_bytes(8))
+            imag, = _DOUBLE.unpack(self.read_bytes(8))
+            return complex(real, imag)
+        elif tag in (_STR, _STR_REF):
+            return self.read_str(tag)
+        elif tag == _BYTES:
+            return self.read_bytes(self.read_size())
+        elif tag in (_LIST, _TUPLE):
+            items = [self.read() for _ in range(self.read_size())]
+            return items if tag == _LIST else tuple(items)
+        elif tag == _NODE:
+            return self.read_node()
+        else:
+            raise ValueError('Invalid tag %r at %d' % (tag, self.position))
+
+    def read_node(self):
+        name = self.read_str()
+        cls = getattr(_qst, name, None)
+        if not isinstance(cls, type) or not issubclass(cls, ast.AST):
+            raise ValueError('Unknown QST node: %r' % name)
+        node = cls.__new__(cls)
+        for _ in range(self.read_size()):
+            field = self.read_str()
+            setattr(node, field, self.read())
+        for field in cls._fields:
+            if not hasattr(node, field):
+                setattr(node, field, _DEFAULTS.get(field))
+        return node
+
+    def read_str(self, tag=None):
+        if tag is None:
+            tag = self.read_bytes(1)
+        if tag == _STR:
+            data = self.read_bytes(self.read_size())
+            result = data.decode('utf-8', 'surrogatepass')
+            self.strings.append(result)
+            return result
+        elif tag == _STR_REF:
+            return self.strings[self.read_size()]
+        else:
+            raise ValueError('Expected a string at %d' % self.position)
+
+    def read_size(self):
+        result = shift = 0
+        while True:
+            byte = self.read_bytes(1)[0]
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    def read_bytes(self, size):
+        start = self.position
+        end = self.position = start + size
+        if end > len(self.data):
+            raise ValueError('Truncated QST')
+        return self.data[start:end]
+
+
+# The default values of fields which are not in every version of Python.
+_DEFAULTS = {'is_async': 0}
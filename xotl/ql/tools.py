@@ -128,7 +128,7 @@ class NameDetectorVisitor(ast.NodeVisitor):
 
     @_with_new_frame
     def visit_DictComp(self, node):
-        for comp in node.comprehesions:
+        for comp in node.generators:
             self.visit(comp)
         self.visit(node.key)
         self.visit(node.value)
@@ -149,7 +149,7 @@ class NameDetectorVisitor(ast.NodeVisitor):
         if node.vararg:
             visit(node.vararg)
         if node.kwarg:
-            visit(node.kwargs)
+            visit(node.kwarg)
         for arg in node.args:
             self.visit(arg)
         for arg in getattr(node, 'kwonlyargs', []):
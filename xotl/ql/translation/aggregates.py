@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Streaming aggregates.
+
+An aggregate consumes a stream of values in a single pass keeping only a
+small state: O(1) memory for a single aggregate, and O(groups) when the
+values are grouped by a key (see `HashAggregation`:class:).
+
+Translators recognize the functions `count`:func:, `avg`:func: and the
+builtins `sum`:func:, `min`:func:, `max`:func:, `any`:func: and `all`:func:
+applied to a query expression (see `get_aggregate`:func:).  The functions
+`count`:func: and `avg`:func: work as well in plain Python.
+
+'''
+
+import builtins
+import pickle
+import tempfile
+
+from xoutil.symbols import Unset
+
+
+class Aggregate:
+    '''The steps of a streaming aggregate.
+
+    The state starts as `start`:meth:, is updated by `step`:meth: for each
+    value and the result is given by `result`:meth:.  If `done`:meth: returns
+    True the result is known and no more values are needed.  The method
+    `merge`:meth: combines the states of two parts of the values (in
+    order).
+
+    '''
+    name = None
+
+    def start(self):
+        return Unset
+
+    def step(self, state, value):
+        raise NotImplementedError
+
+    def done(self, state):
+        return False
+
+    def merge(self, state, other):
+        raise NotImplementedError
+
+    def result(self, state):
+        return state
+
+    def __call__(self, iterable):
+        '''Aggregate all the values of `iterable`.'''
+        state = self.start()
+        for value in iterable:
+            state = self.step(state, value)
+            if self.done(state):
+                break
+        return self.result(state)
+
+    def groups(self, pairs):
+        '''Aggregate the values of `pairs` of keys and values by key.
+
+        Return a dictionary from each key to the result of the aggregate of
+        its values.
+
+        '''
+        return dict(HashAggregation(self)(pairs))
+
+    def __repr__(self):
+        return '<aggregate %s>' % self.name
+
+    def __reduce__(self):
+        # The aggregates of this module are pickled by reference, so that
+        # the queries loaded still use them (see `get_aggregate`).
+        for name, value in globals().items():
+            if value is self:
+                return name
+        return super().__reduce__()
+
+
+class Count(Aggregate):
+    name = 'count'
+
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        return state + 1
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Sum(Aggregate):
+    name = 'sum'
+
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        return state + value
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Min(Aggregate):
+    name = 'min'
+
+    def step(self, state, value):
+        return value if state is Unset or value < state else state
+
+    def merge(self, state, other):
+        return state if other is Unset else self.step(state, other)
+
+    def result(self, state):
+        if state is Unset:
+            raise ValueError('%s() arg is an empty sequence' % self.name)
+        return state
+
+
+class Max(Min):
+    name = 'max'
+
+    def step(self, state, value):
+        return value if state is Unset or value > state else state
+
+
+class Avg(Aggregate):
+    name = 'avg'
+
+    def start(self):
+        return 0, 0
+
+    def step(self, state, value):
+        total, count = state
+        return total + value, count + 1
+
+    def merge(self, state, other):
+        return state[0] + other[0], state[1] + other[1]
+
+    def result(self, state):
+        total, count = state
+        if not count:
+            raise ValueError('avg() arg is an empty sequence')
+        return total / count
+
+
+class Any(Aggregate):
+    name = 'any'
+
+    def start(self):
+        return False
+
+    def step(self, state, value):
+        return bool(value)
+
+    def done(self, state):
+        return state
+
+    def merge(self, state, other):
+        return state or other
+
+
+class All(Aggregate):
+    name = 'all'
+
+    def start(self):
+        return True
+
+    def step(self, state, value):
+        return bool(value)
+
+    def done(self, state):
+        return not state
+
+    def merge(self, state, other):
+        return state and other
+
+
+class Collect(Aggregate):
+    '''Collect the values in a list.'''
+    name = 'list'
+
+    def start(self):
+        return []
+
+    def step(self, state, value):
+        state.append(value)
+        return state
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Last(Aggregate):
+    '''Keep the last value, like the keys of a dictionary do.'''
+    name = 'last'
+
+    def step(self, state, value):
+        return value
+
+    def merge(self, state, other):
+        return other
+
+
+#: Count the values in an iterable.
+count = Count()
+
+#: The average (arithmetic mean) of the values in an iterable.
+avg = Avg()
+
+collect = Collect()
+last = Last()
+
+
+AGGREGATES = {
+    builtins.sum: Sum(),
+    builtins.min: Min(),
+    builtins.max: Max(),
+    builtins.any: Any(),
+    builtins.all: All(),
+    builtins.list: collect,
+    count: count,
+    avg: avg,
+}
+
+
+def get_aggregate(function):
+    '''Return the `Aggregate`:class: for `function`, or None.
+
+    '''
+    try:
+        return AGGREGATES.get(function)
+    except TypeError:  # unhashable
+        return None
+
+
+class HashAggregation:
+    '''Aggregate pairs of keys and values by key.
+
+    Calling the instance with an iterable of pairs returns an iterator over
+    the pairs of each key and the result of the `aggregate` of its values.
+
+    There's a state for each group in memory.  If `max_groups` is not None
+    and there are more groups, the states are spilled to `partitions`
+    temporary files (in `dir`) by the hash of the key.  At the end, the states
+    in each file are merged (see `Aggregate.merge`:meth:), one file at a
+    time.  A file with more than `max_groups` keys is partitioned again.
+
+    Keys and states must be picklable to be spilled.
+
+    '''
+    #: How many times a partition is partitioned again before giving up the
+    #: memory budget.
+    max_depth = 4
+
+    def __init__(self, aggregate, max_groups=None, partitions=8, dir=None):
+        self.aggregate = aggregate
+        self.max_groups = max_groups
+        self.partitions = partitions
+        self.dir = dir
+
+    def __call__(self, pairs):
+        aggregate = self.aggregate
+        begin, step, done = aggregate.start, aggregate.step, aggregate.done
+        return self._aggregate(
+            pairs,
+            lambda value: step(begin(), value),
+            lambda state, value: state if done(state) else step(state, value),
+            depth=0
+        )
+
+    def _aggregate(self, pairs, first, step, depth):
+        # Aggregate the `pairs`: `first` gives the state of the first value of
+        # a group and `step` the following.
+        max_groups = self.max_groups if depth < self.max_depth else None
+        files = None
+        states = {}
+        for key, value in pairs:
+            state = states.get(key, Unset)
+            if state is not Unset:
+                states[key] = step(state, value)
+            else:
+                if max_groups is not None and len(states) >= max_groups:
+                    if files is None:
+                        files = [tempfile.TemporaryFile(dir=self.dir)
+                                 for _ in range(self.partitions)]
+                    self._spill(states, files, depth)
+                    states.clear()
+                states[key] = first(value)
+        if files is None:
+            result = self.aggregate.result
+            for key, state in states.items():
+                yield key, result(state)
+        else:
+            self._spill(states, files, depth)
+            del states
+            for file in files:
+                with file:
+                    file.seek(0)
+                    yield from self._aggregate(
+                        _load(file),
+                        lambda state: state,
+                        self.aggregate.merge,
+                        depth + 1
+                    )
+
+    def _spill(self, states, files, depth):
+        partitions = self.partitions
+        for key, state in states.items():
+            index = hash(key) // partitions ** depth % partitions
+            pickle.dump((key, state), files[index], pickle.HIGHEST_PROTOCOL)
+
+
+def _load(file):
+    # Iterate over the objects pickled in `file`.
+    while True:
+        try:
+            yield pickle.load(file)
+        except EOFError:
+            return
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Batched operators for the monadic plans.
+
+The operators of the `~xotl.ql.translation.py.NaivePythonExecutionPlan`:class:
+work an item at a time: Map calls a function per item, Unit creates a
+collection per item and Join walks a generator per collection.  The
+operators in this module work over *batches* (lists of items) instead.
+
+Besides the batched Map, Join, Unit and Empty operators, `batch_plan`:func:
+rewrites the monadic plan with a Select operator: ``Select(f)(l)`` calls
+``f`` with each batch of ``l``, and ``f`` is a function that computes the
+results of a whole batch with a list comprehension.  For instance, the plan
+for the query ``(x.name for x in l if x.age > 30)``::
+
+    join(map(lambda x: unit(x.name) if x.age > 30 else zero())(l))
+
+is rewritten as::
+
+    select(lambda batch: [x.name for x in batch if x.age > 30])(l)
+
+The nested generators and the conditions of the query are merged into the
+comprehension, so most queries are a single Select.
+
+'''
+
+import ast
+from copy import deepcopy
+from itertools import islice
+
+
+class Batches:
+    '''A collection given by an iterator over its batches.
+
+    Iterating over the collection gives its items.  Like the iterators
+    returned by the other operators, it can only be iterated once.
+
+    '''
+    __slots__ = ('batches', )
+
+    def __init__(self, batches):
+        self.batches = batches
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield from batch
+
+
+def get_batches(collection, size):
+    '''Return an iterator over the batches of `collection`.
+
+    The batches of a `Batches`:class: are kept as they are.  Other
+    collections are split in lists of at most `size` items.
+
+    '''
+    if isinstance(collection, Batches):
+        return collection.batches
+    elif isinstance(collection, (list, tuple)) and len(collection) <= size:
+        return iter((collection, ) if collection else ())
+    else:
+        return _split(collection, size)
+
+
+def _split(collection, size):
+    iterator = iter(collection)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+class Select:
+    '''The Select operator: ``Select(f)(l)`` is the concatenation of
+    ``f(batch)`` for each batch of ``l``.
+
+    `do_plan` is applied to ``l`` first (it runs sub-queries).
+
+    '''
+    def __init__(self, size, do_plan):
+        self.size = size
+        self.do_plan = do_plan
+
+    def __call__(self, function):
+        size, do_plan = self.size, self.do_plan
+
+        def select(collection):
+            batches = get_batches(do_plan(collection), size)
+            return Batches(filter(None, map(function, batches)))
+
+        return select
+
+
+class BatchMap(Select):
+    '''The Map operator over batches: ``BatchMap(f)(l)`` applies ``f`` to
+    each item of ``l``.
+
+    '''
+    def __call__(self, function):
+        return super().__call__(
+            lambda batch: [function(item) for item in batch]
+        )
+
+
+class BatchJoin:
+    '''The Join operator over batches: the concatenation of the collections
+    in a collection.
+
+    '''
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, collections):
+        return Batches(self._join(collections))
+
+    def _join(self, collections):
+        size = self.size
+        result = []
+        for batch in get_batches(collections, size):
+            for collection in batch:
+                if isinstance(collection, Batches):
+                    for items in collection.batches:
+                        result.extend(items)
+                else:
+                    result.extend(collection)
+            if len(result) >= size:
+                yield result
+                result = []
+        if result:
+            yield result
+
+
+def unit(item):
+    '''The Unit operator over batches.'''
+    return [item]
+
+
+def zero():
+    '''The Empty operator over batches.'''
+    return ()
+
+
+def batch_plan(plan, map, join, unit, zero, select, each):
+    '''Rewrite the monadic `plan` to use the Select operator.
+
+    The other arguments are the names of the operators in the plan.  `each`
+    is the name of the function which is applied to the collections of the
+    nested generators merged into a Select (it runs sub-queries).
+
+    Return the rewritten plan.
+
+    '''
+    batcher = _Batcher(map, join, unit, zero, select, each)
+    return ast.fix_missing_locations(batcher.visit(deepcopy(plan)))
+
+
+class _Batcher(ast.NodeTransformer):
+    # Rewrite a monadic plan bottom-up:
+    #
+    #   map(lambda x: e)(l)  ->  select(lambda b: [e for x in b])(l)
+    #
+    #   join(select(lambda b: [e for ...])(l))  ->
+    #       select(lambda b: [e' for ... <loops and conditions of e>])(l)
+    #
+    # where e' is the item of the collection e.
+    def __init__(self, map, join, unit, zero, select, each):
+        self.map = map
+        self.join = join
+        self.unit = unit
+        self.zero = zero
+        self.select = select
+        self.each = each
+        self.names = 0
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        function = _get_operator(node.func)
+        if function == self.join and len(node.args) == 1:
+            selection = self._get_selection(node.args[0])
+            if selection is not None:
+                elt, generators, collection = selection
+                elt = self._flatten(elt, generators)
+                return self._build_select(elt, generators, collection)
+        elif isinstance(node.func, ast.Call) and len(node.args) == 1 and \
+                _get_operator(node.func.func) == self.map:
+            function = node.func.args[0] if len(node.func.args) == 1 \
+                else None
+            if isinstance(function, ast.Lambda) and \
+                    len(function.args.args) == 1:
+                target = ast.Name(function.args.args[0].arg, ast.Store())
+                generator = _comprehension(target, None, [])
+                return self._build_select(function.body, [generator],
+                                          node.args[0])
+        return node
+
+    def _flatten(self, elt, generators):
+        # Return the item of the collection `elt`, adding the loops and
+        # conditions needed to `generators`.
+        if isinstance(elt, ast.Call) and \
+                _get_operator(elt.func) == self.unit and len(elt.args) == 1:
+            return elt.args[0]
+        elif isinstance(elt, ast.IfExp) and self._is_zero(elt.orelse):
+            generators[-1].ifs.append(elt.test)
+            return self._flatten(elt.body, generators)
+        selection = self._get_selection(elt)
+        if selection is not None:
+            elt, inner, collection = selection
+            inner[0].iter = ast.Call(ast.Name(self.each, ast.Load()),
+                                     [collection], [])
+            generators.extend(inner)
+            return elt
+        self.names += 1
+        name = '__x_item_%d' % self.names
+        generators.append(_comprehension(ast.Name(name, ast.Store()), elt,
+                                         []))
+        return ast.Name(name, ast.Load())
+
+    def _is_zero(self, node):
+        return isinstance(node, ast.Call) and not node.args and \
+            _get_operator(node.func) == self.zero
+
+    def _get_selection(self, node):
+        # If `node` is a select built by this class, return its item, its
+        # generators and its collection.
+        if isinstance(node, ast.Call) and len(node.args) == 1 and \
+                isinstance(node.func, ast.Call) and \
+                _get_operator(node.func.func) == self.select:
+            comprehension = node.func.args[0].body
+            return (comprehension.elt, comprehension.generators,
+                    node.args[0])
+        else:
+            return None
+
+    def _build_select(self, elt, generators, collection):
+        function = ast.parse('lambda __x_batch: None', mode='eval').body
+        generators[0].iter = ast.Name('__x_batch', ast.Load())
+        function.body = ast.ListComp(elt, generators)
+        return ast.Call(
+            ast.Call(ast.Name(self.select, ast.Load()), [function], []),
+            [collection],
+            []
+        )
+
+
+def _get_operator(node):
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _comprehension(target, iter, ifs):
+    # A comprehension node valid for the running Python.
+    result = ast.parse('[None for _ in None]', mode='eval').body.generators[0]
+    result.target, result.iter, result.ifs = target, iter, ifs
+    return result
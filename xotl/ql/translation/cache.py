@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''A cache of the results of query execution plans.
+
+Queries run many times over collections that change slowly can reuse their
+results::
+
+    cache = ResultCache(maxsize=256, ttl=60)
+    plan = cache(py.NaivePythonExecutionPlan(query))
+    list(plan())   # runs the query
+    list(plan())   # uses the cached results
+
+    people.append(someone)
+    cache.invalidate(people)
+
+The results are keyed by the structure of the query (its QST, ordering,
+partition and groups) and the values of its free names.  Immutable values
+(numbers, strings, tuples of them, etc.) are part of the key.  Other values
+(like lists, or the |this| object) are taken by identity: they are the
+*sources* of the results, and the cache can't know when they change.  Call
+`ResultCache.invalidate`:meth: with the sources that changed.
+
+The source of a query expression like ``(p for p in people)`` is the list
+``people``, not the iterator Python creates for the generator expression.
+The results of queries over iterators that can be consumed only once (like
+generators) are not cached.
+
+.. |this| replace:: `~xotl.ql.core.this`:obj:
+
+'''
+
+import ast
+import builtins
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from xoutil.future.collections import ChainMap
+from xoutil.symbols import Unset
+
+from xotl.ql.core import _is_single_use
+from xotl.ql.interfaces import QueryObject
+from xotl.ql.tools import detect_names
+
+
+#: The statistics of a `ResultCache`:class: (see
+#: `ResultCache.cache_info`:meth:).  `memory` is an estimate of the bytes
+#: used by the cached results.
+CacheInfo = namedtuple(
+    'CacheInfo',
+    'hits misses evictions invalidations size maxsize memory'
+)
+
+
+class ResultCache:
+    '''A cache of the results of plans.
+
+    At most `maxsize` results are kept (the least recently used are evicted
+    first), each for at most `ttl` seconds if given.  `timer` gives the
+    current time in seconds.
+
+    Calling the cache with a plan returns a `CachedExecutionPlan`:class:.
+    Several plans can share a cache.
+
+    The results of a query are materialized (in a list) when cached, so
+    queries over infinite collections can't be cached.
+
+    '''
+    def __init__(self, maxsize=128, ttl=None, timer=time.monotonic):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._entries = OrderedDict()
+        self._dependents = {}
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.memory = 0
+
+    def __call__(self, plan):
+        return CachedExecutionPlan(plan, self)
+
+    def get(self, plan, kwargs):
+        '''Return the result of calling ``plan(**kwargs)``.
+
+        The result is taken from the cache if possible.
+
+        '''
+        key, sources = get_key(plan, kwargs)
+        if key is None:
+            with self._lock:
+                self.misses += 1
+            return plan(**kwargs)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None and \
+                    entry.expires <= self.timer():
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.get()
+            self.misses += 1
+        entry = _Entry(plan(**kwargs), sources)
+        if self.ttl is not None:
+            entry.expires = self.timer() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.memory += entry.memory
+            for source in sources:
+                self._dependents.setdefault(id(source), set()).add(key)
+            while self.maxsize is not None and \
+                    len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry.get()
+
+    def invalidate(self, *sources):
+        '''Remove the results that depend on any of the `sources`.
+
+        Without arguments remove all the results.
+
+        '''
+        with self._lock:
+            if not sources:
+                keys = list(self._entries)
+            else:
+                keys = {key for source in sources
+                        for key in self._dependents.get(id(source), ())}
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def cache_info(self):
+        '''Return the statistics of the cache as a `CacheInfo`:class:.'''
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.invalidations, len(self._entries),
+                             self.maxsize, self.memory)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.memory -= entry.memory
+        for source in entry.sources:
+            keys = self._dependents.get(id(source))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[id(source)]
+
+
+class CachedExecutionPlan:
+    '''A plan that caches the results of another `plan` in a `cache`.
+
+    Implements `xotl.ql.interfaces.QueryExecutionPlan`:class:.  The keyword
+    arguments of calls are passed to the `plan`, and are part of the key of
+    the cached results.
+
+    '''
+    def __init__(self, plan, cache):
+        self.plan = plan
+        self.cache = cache
+
+    @property
+    def query(self):
+        return self.plan.query
+
+    def __call__(self, **kwargs):
+        return self.cache.get(self.plan, kwargs)
+
+    def __iter__(self):
+        return self()
+
+    def explain(self):
+        '''Explain the `plan` and print the statistics of the cache.'''
+        explain = getattr(self.plan, 'explain', None)
+        if explain is not None:
+            explain()
+        print('\nCache')
+        print(str(self.cache.cache_info()))
+
+
+def get_key(plan, kwargs):
+    '''Return the key of the results of ``plan(**kwargs)`` and its sources.
+
+    The sources are the values taken by identity.  The query parameters in
+    `kwargs` are part of the key as the values of the free names of the
+    query.  If the results can't be cached (the query uses an iterator that
+    can be consumed only once), the key is None.
+
+    '''
+    sources = []
+    params = getattr(plan, 'params', ())
+    try:
+        key = (
+            type(plan),
+            _freeze_query(plan.query, kwargs, sources),
+            _freeze({name: value for name, value in kwargs.items()
+                     if name not in params}, sources),
+        )
+    except _Uncacheable:
+        return None, []
+    return key, sources
+
+
+def _freeze_query(query, kwargs, sources):
+    # The structural key of the `query`, where the names in `kwargs` shadow
+    # the names in the query's frame.
+    qst = query.qst
+    namespace = ChainMap(kwargs, query.locals, query.globals)
+    values = tuple(
+        (name, _freeze(namespace.get(name, getattr(builtins, name, Unset)),
+                       sources))
+        for name in sorted(detect_names(qst))
+    )
+    return (
+        ast.dump(qst),
+        values,
+        _freeze(getattr(query, 'partition', None), sources),
+        _freeze(getattr(query, 'ordering', None), sources),
+        _freeze(getattr(query, 'groups', None), sources),
+    )
+
+
+#: The types whose values are part of the keys (if their items are too).
+_VALUE_TYPES = (type(None), bool, int, float, complex, str, bytes, type,
+                type(Unset), type(len), type(_freeze_query))
+
+
+def _freeze(value, sources):
+    # A hashable key for `value`.  Values which are not immutable are taken
+    # by identity and added to the `sources`.
+    if isinstance(value, _VALUE_TYPES):
+        return value
+    elif isinstance(value, slice):
+        return ('slice', value.start, value.stop, value.step)
+    elif isinstance(value, (tuple, frozenset)):
+        return (type(value), tuple(_freeze(item, sources) for item in value))
+    elif isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            ((key, _freeze(item, sources)) for key, item in value.items()),
+            key=repr
+        )))
+    elif isinstance(value, QueryObject):
+        return ('query', _freeze_query(value, {}, sources))
+    elif _is_single_use(value):
+        # The results would change after the first execution, and the
+        # source of the iterator is not known.
+        raise _Uncacheable
+    else:
+        sources.append(value)
+        return ('id', id(value))
+
+
+class _Uncacheable(Exception):
+    # Raised by `_freeze` for values whose results can't be cached.
+    pass
+
+
+class _Entry:
+    # The result of a plan in the cache; iterators are materialized.  The
+    # entry keeps the sources alive so that their ids are not reused while
+    # the entry exists.
+    __slots__ = ('result', 'iterable', 'sources', 'expires', 'memory')
+
+    def __init__(self, result, sources):
+        self.iterable = hasattr(result, '__next__')
+        self.result = list(result) if self.iterable else result
+        self.sources = sources
+        self.expires = None
+        self.memory = _sizeof(self.result)
+
+    def get(self):
+        result = self.result
+        if self.iterable:
+            return iter(result)
+        elif isinstance(result, dict):
+            return dict(result)
+        else:
+            return result
+
+
+def _sizeof(result):
+    # An estimate of the memory used by the `result`: the container and its
+    # items (but not what the items refer to).
+    size = sys.getsizeof(result)
+    if isinstance(result, dict):
+        size += sum(sys.getsizeof(key) + sys.getsizeof(value)
+                    for key, value in result.items())
+    elif isinstance(result, list):
+        size += sum(sys.getsizeof(item) for item in result)
+    return size
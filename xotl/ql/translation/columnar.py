@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''A translator of queries over columns of NumPy arrays.
+
+Queries like::
+
+    (r.price * r.quantity for r in sales if r.quantity > 10)
+
+over `columns <Columns>`:class: are evaluated a whole column at a time: the
+conditions are compiled into boolean masks, the projection is evaluated over
+the columns gathered by the mask.  Sub-expressions which can't be vectorized
+are evaluated row by row in Python.
+
+This module requires NumPy.
+
+'''
+
+import ast
+import builtins
+from copy import deepcopy
+from types import SimpleNamespace
+
+import numpy
+from xoutil.future.collections import ChainMap
+
+from xotl.ql.core import normalize_query
+from xotl.ql.tools import detect_names
+
+from . import TranslationError
+from .aggregates import count, avg
+from .optimizations import get_source, _conjuncts
+from .py import _split_aggregate, _partition
+
+
+class Columns:
+    '''A collection of records stored by columns.
+
+    :param data: Either a mapping from the names of the attributes to arrays
+                 (or sequences) of the same length, or a NumPy structured
+                 array.
+
+    Columns can be used as the collection of the first generator of a query
+    expression (which Python iterates when the expression is created); but
+    the records are only retrieved by the plans.
+
+    '''
+    def __init__(self, data):
+        if isinstance(data, numpy.ndarray) and data.dtype.names:
+            data = {name: data[name] for name in data.dtype.names}
+        self.arrays = {name: numpy.asarray(array)
+                       for name, array in data.items()}
+        lengths = {len(array) for array in self.arrays.values()}
+        if len(lengths) > 1:
+            raise ValueError('The columns must have the same length')
+        self.length = lengths.pop() if lengths else 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        raise StopIteration
+
+    def __repr__(self):
+        return '<Columns %s>' % ', '.join(self.arrays)
+
+
+class ColumnarExecutionPlan:
+    '''The execution plan of a query over `columns <Columns>`:class:.
+
+    The query must have a single generator over a `Columns`:class:, a
+    mapping of arrays or a structured array; its target must be a name.
+
+    These expressions are vectorized: the attributes of the target, free
+    sub-expressions (evaluated once per execution), comparisons, ``in`` (if
+    the right operand is free), boolean operators, arithmetic, conditional
+    expressions, `abs`:func: and calls to NumPy ufuncs.  Other
+    sub-expressions that use the target are evaluated in Python for each row
+    (the attributes of the row are NumPy scalars).  Conditions joined by
+    ``and`` (or in several ``if`` clauses) are evaluated in order, each only
+    for the rows matching the previous ones.  Conditional expressions and
+    boolean operators are evaluated row by row if their branches (or
+    operands after the first) need it, so that they are evaluated only where
+    Python would.
+
+    The plan produces Python values.  Projecting the target itself produces
+    `types.SimpleNamespace`:class: objects.  The aggregates `count`,
+    `sum`:func:, `min`:func:, `max`:func:, `avg`, `any`:func: and
+    `all`:func: are computed with NumPy.
+
+    '''
+    def __init__(self, query):
+        self.query = query = normalize_query(query)
+        self.params = tuple(getattr(query, 'params', ()))
+        self.aggregate, qst, keyed = _split_aggregate(query)
+        if keyed or getattr(query, 'groups', None) is not None:
+            raise TranslationError('Groups are not supported by the columnar '
+                                   'translator')
+        if self.aggregate is not None and self.aggregate.name not in (
+                'count', 'sum', 'min', 'max', 'avg', 'any', 'all'):
+            raise TranslationError('The aggregate %s is not supported by the '
+                                   'columnar translator' %
+                                   self.aggregate.name)
+        node = qst.body if isinstance(qst, ast.Expression) else qst
+        if not isinstance(node, ast.GeneratorExp) or \
+                len(node.generators) != 1 or \
+                not isinstance(node.generators[0].target, ast.Name):
+            raise TranslationError('The columnar translator needs a single '
+                                   'generator whose target is a name')
+        comp = node.generators[0]
+        self.target = target = comp.target.id
+        self.source = _compile(comp.iter)
+        namespace = ChainMap(query.locals, query.globals)
+        # The conditions are kept in the order of the source: each one may
+        # guard the following ones.
+        self.conditions = [_Vectorized(cond, target, namespace)
+                           for test in comp.ifs
+                           for cond in _conjuncts(test)]
+        elt = node.elt
+        if isinstance(elt, ast.Name) and elt.id == target:
+            self.projection = None
+        elif isinstance(elt, ast.Tuple):
+            self.projection = [_Vectorized(item, target, namespace)
+                               for item in elt.elts]
+        else:
+            self.projection = _Vectorized(elt, target, namespace)
+
+    def explain(self):
+        '''Prints how the conditions and the projection are evaluated.'''
+        print('\nConditions')
+        for cond in self.conditions:
+            print(str(cond))
+        print('\nProjection')
+        if self.projection is None:
+            print('the records')
+        elif isinstance(self.projection, list):
+            for item in self.projection:
+                print(str(item))
+        else:
+            print(str(self.projection))
+        if self.aggregate is not None:
+            print('\nAggregate')
+            print(self.aggregate.name)
+
+    def __call__(self, **params):
+        '''Execute the plan.
+
+        Keyword arguments give the values of the query parameters (see
+        `xotl.ql.core.QueryObject.params`:attr:).
+
+        Return an iterator over the results; or the value of the aggregate.
+
+        '''
+        aggregate = self.aggregate
+        ordering = getattr(self.query, 'ordering', None)
+        vectorized = isinstance(self.projection, _Vectorized)
+        if aggregate is not None and vectorized and ordering is None:
+            return self._aggregate(self.evaluate(**params))
+        result = self.evaluate(**params)
+        if self.projection is None:
+            names = list(result)
+            result = (SimpleNamespace(**dict(zip(names, values)))
+                      for values in zip(*(result[name].tolist()
+                                          for name in names)))
+        elif vectorized:
+            result = iter(result.tolist())
+        else:
+            result = zip(*(array.tolist() for array in result))
+        if ordering is not None:
+            result = _partition(result,
+                                getattr(self.query, 'partition', None),
+                                ordering)
+        return result if aggregate is None else aggregate(result)
+
+    def __iter__(self):
+        return self()
+
+    def evaluate(self, **params):
+        '''Execute the plan and return the result as arrays.
+
+        Return an array; or a tuple of arrays if the projection is a tuple;
+        or a dictionary of arrays if the projection is the target.  The
+        partition of the query is applied, but not its ordering.
+
+        '''
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise TypeError(
+                'Unknown query parameters: %s' % ', '.join(sorted(unknown))
+            )
+        namespace = dict(ChainMap(params, self.query.locals,
+                                  self.query.globals))
+        columns = self._get_columns(eval(self.source, namespace))
+        namespace.update(_HELPERS)
+        # Each condition is evaluated only for the rows matching the
+        # previous ones (all the rows for the first one).
+        indices = None
+        for cond in self.conditions:
+            result = cond.evaluate(namespace, columns, indices)
+            if indices is None:
+                indices = numpy.flatnonzero(_as_mask(result, len(columns)))
+            else:
+                indices = indices[_as_mask(result, len(indices))]
+        if indices is None:
+            indices = numpy.arange(len(columns))
+        partition = getattr(self.query, 'partition', None)
+        if partition is not None and \
+                getattr(self.query, 'ordering', None) is None:
+            indices = indices[partition]
+        projection = self.projection
+        if projection is None:
+            return {name: array[indices]
+                    for name, array in columns.arrays.items()}
+        elif isinstance(projection, list):
+            return tuple(item.evaluate(namespace, columns, indices)
+                         for item in projection)
+        else:
+            return projection.evaluate(namespace, columns, indices)
+
+    def _get_columns(self, source):
+        if isinstance(source, Columns):
+            return source
+        elif isinstance(source, dict) or (isinstance(source, numpy.ndarray)
+                                          and source.dtype.names):
+            return Columns(source)
+        else:
+            raise TranslationError('The columnar translator needs columns, '
+                                   'not %r' % type(source))
+
+    def _aggregate(self, values):
+        # Compute the aggregate of an array of `values` with NumPy.
+        aggregate = self.aggregate
+        if aggregate is count:
+            return len(values)
+        elif not len(values):
+            return aggregate.result(aggregate.start())
+        elif values.dtype.kind not in 'biuf':
+            # Strings, objects, etc.
+            return aggregate(values.tolist())
+        elif aggregate is avg:
+            result = numpy.mean(values)
+        elif aggregate.name in ('any', 'all'):
+            result = getattr(numpy, aggregate.name)(values.astype(bool))
+        else:
+            result = getattr(numpy, aggregate.name)(values)
+        return result.item() if isinstance(result, numpy.generic) else result
+
+
+class _Vectorized:
+    # An expression over the `target` compiled to operate over the columns.
+    # The sub-expressions that cannot be vectorized are replaced by names
+    # bound to the arrays of their values computed row by row.
+    def __init__(self, node, target, namespace):
+        self.node = node
+        self.target = target
+        self.namespace = namespace
+        self.fallbacks = []
+        self.columns = set()
+        expression = _Vectorizer(self).visit(deepcopy(node))
+        self.code = _compile(expression)
+
+    def evaluate(self, namespace, columns, indices=None):
+        # Evaluate the expression for the rows at `indices` (all the rows if
+        # None).  Return an array with a value per row.
+        namespace = dict(namespace)
+        for attr in self.columns:
+            try:
+                array = columns.arrays[attr]
+            except KeyError:
+                raise AttributeError('The columns have no attribute %r' %
+                                     attr)
+            namespace[_column(attr)] = array if indices is None \
+                else array[indices]
+        if indices is None:
+            indices = numpy.arange(len(columns))
+        if self.fallbacks:
+            rows = [_Row(columns, index) for index in indices]
+            for name, code in self.fallbacks:
+                function = eval(code, namespace)
+                array = numpy.empty(len(rows), dtype=object)
+                array[:] = [function(row) for row in rows]
+                namespace[name] = array
+        result = eval(self.code, namespace)
+        return numpy.broadcast_to(result, indices.shape)
+
+    def __str__(self):
+        source = get_source(self.node)
+        if self.fallbacks:
+            return '%s (%d row by row)' % (source, len(self.fallbacks))
+        else:
+            return '%s (vectorized)' % source
+
+
+class _Vectorizer(ast.NodeTransformer):
+    # Rewrite an expression to operate over columns.
+    def __init__(self, vectorized):
+        self.vectorized = vectorized
+        self.target = vectorized.target
+
+    def visit(self, node):
+        if not isinstance(node, ast.expr):
+            return super().visit(node)
+        elif self.target not in detect_names(node):
+            return node  # Free, it broadcasts.
+        method = getattr(self, 'visit_' + type(node).__name__, None)
+        result = method(node) if method is not None else None
+        return self._fallback(node) if result is None else result
+
+    def visit_Attribute(self, node):
+        value = node.value
+        if isinstance(value, ast.Name) and value.id == self.target:
+            self.vectorized.columns.add(node.attr)
+            return _name(_column(node.attr))
+
+    def visit_Compare(self, node):
+        parts, left = [], node.left
+        for op, right in zip(node.ops, node.comparators):
+            name = type(op).__name__
+            if name in ('In', 'NotIn'):
+                if self.target in detect_names(right):
+                    return None
+                part = _numpy_call('isin', self.visit(deepcopy(left)),
+                                   ast.Call(_name('__x_list'), [right], []))
+                if name == 'NotIn':
+                    part = _numpy_call('logical_not', part)
+            elif name in ('Is', 'IsNot'):
+                return None
+            else:
+                part = ast.Compare(self.visit(deepcopy(left)), [op],
+                                   [self.visit(deepcopy(right))])
+            parts.append(part)
+            left = right
+        return _reduce('logical_and', parts)
+
+    def visit_BoolOp(self, node):
+        # Like Python, `a and b` is `b` where `a` is true, and `a` otherwise;
+        # but both operands are evaluated.  If the operands after the first
+        # need evaluation per row, the whole expression is evaluated row by
+        # row: they may fail for the rows where the first doesn't hold.
+        fallbacks = len(self.vectorized.fallbacks)
+        first = self.visit(node.values[0])
+        guarded = len(self.vectorized.fallbacks)
+        values = [first] + [self.visit(value) for value in node.values[1:]]
+        if len(self.vectorized.fallbacks) > guarded:
+            del self.vectorized.fallbacks[fallbacks:]
+            return None
+        result = values[-1]
+        for value in reversed(values[:-1]):
+            if type(node.op).__name__ == 'And':
+                result = _numpy_call('where', value, result, deepcopy(value))
+            else:
+                result = _numpy_call('where', value, deepcopy(value), result)
+        return result
+
+    def visit_UnaryOp(self, node):
+        if type(node.op).__name__ == 'Not':
+            return _numpy_call('logical_not', self.visit(node.operand))
+        else:
+            return ast.UnaryOp(node.op, self.visit(node.operand))
+
+    def visit_BinOp(self, node):
+        return ast.BinOp(self.visit(node.left), node.op,
+                         self.visit(node.right))
+
+    def visit_IfExp(self, node):
+        # Both branches are evaluated; unless they need evaluation per row
+        # (see `visit_BoolOp`).
+        fallbacks = len(self.vectorized.fallbacks)
+        test = self.visit(node.test)
+        guarded = len(self.vectorized.fallbacks)
+        body, orelse = self.visit(node.body), self.visit(node.orelse)
+        if len(self.vectorized.fallbacks) > guarded:
+            del self.vectorized.fallbacks[fallbacks:]
+            return None
+        return _numpy_call('where', test, body, orelse)
+
+    def visit_Call(self, node):
+        # Only calls to `abs` and NumPy ufuncs (known when the plan is
+        # created) are vectorized.
+        func = node.func
+        if node.keywords or self.target in detect_names(func) or \
+                any(isinstance(arg, ast.Starred) for arg in node.args):
+            return None
+        try:
+            function = eval(_compile(func), dict(self.vectorized.namespace))
+        except Exception:
+            return None
+        if function is builtins.abs:
+            func = _numpy_attribute('abs')
+        elif not isinstance(function, numpy.ufunc):
+            return None
+        return ast.Call(func, [self.visit(arg) for arg in node.args], [])
+
+    def _fallback(self, node):
+        fallbacks = self.vectorized.fallbacks
+        name = '__x_row_%d' % len(fallbacks)
+        fallbacks.append((name, _compile(ast.Lambda(
+            ast.arguments([ast.arg(self.target, None)], None, [], [], None,
+                          []),
+            deepcopy(node)
+        ))))
+        return _name(name)
+
+
+class _Row:
+    # A row of the columns, for the expressions evaluated row by row.
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getattr__(self, attr):
+        try:
+            return self._columns.arrays[attr][self._index]
+        except KeyError:
+            raise AttributeError(attr)
+
+
+def _column(attr):
+    return '__x_column_%s' % attr
+
+
+def _name(id):
+    return ast.Name(id, ast.Load())
+
+
+def _numpy_attribute(attr):
+    return ast.Attribute(_name('__x_numpy'), attr, ast.Load())
+
+
+def _numpy_call(function, *args):
+    return ast.Call(_numpy_attribute(function), list(args), [])
+
+
+def _reduce(function, parts):
+    result = parts[0]
+    for part in parts[1:]:
+        result = _numpy_call(function, result, part)
+    return result
+
+
+def _as_mask(values, length):
+    # The truth values of `values` (broadcast to `length`) as booleans.
+    values = numpy.broadcast_to(values, (length, ))
+    if values.dtype == object:
+        return numpy.array([bool(value) for value in values], dtype=bool)
+    else:
+        return values.astype(bool)
+
+
+def _compile(node):
+    expression = ast.fix_missing_locations(ast.Expression(deepcopy(node)))
+    return compile(expression, '', 'eval')
+
+
+_HELPERS = {'__x_numpy': numpy, '__x_list': list}
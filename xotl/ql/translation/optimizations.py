@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Optimizations over the `Query Syntax Tree`:term: of queries.
+
+The optimizations are functions that take the QST of a query and return a
+new QST (the original is never modified) and a report of what was done.
+Translators apply them before generating the execution plan.
+
+'''
+
+import ast
+import builtins
+import datetime
+import decimal
+import fractions
+from copy import deepcopy
+
+from xotl.ql.revenge import qst
+from xotl.ql.tools import detect_names
+
+
+def get_source(node):
+    '''Get the (approximate) source of an expression `node`.
+
+    Expressions the `~xotl.ql.core.SourceBuilder`:class: can't render are
+    shown as ``<...>``.
+
+    '''
+    from xotl.ql.core import SourceBuilder
+    try:
+        return SourceBuilder().get_source(node)
+    except Exception:
+        return '<...>'
+
+
+class NestedLoop:
+    '''The strategy of a generator which is iterated for each item of the
+    previous generators.
+
+    '''
+    def __init__(self, comprehension):
+        self.target = comprehension.target
+        self.iter = comprehension.iter
+
+    def __str__(self):
+        return 'for %s in %s: nested loop' % (get_source(self.target),
+                                              get_source(self.iter))
+
+
+class HashJoin:
+    '''The strategy of a generator joined by an equality to the previous
+    generators.
+
+    The items of the collection that pass the conditions `ifs` are traversed
+    once to build a dictionary from the values of `key` to the items.  Then,
+    for each item of the previous generators, the `value` is looked up in the
+    dictionary.
+
+    '''
+    def __init__(self, target, iter, ifs, key, value):
+        self.target = target
+        self.iter = iter
+        self.ifs = ifs
+        self.key = key
+        self.value = value
+
+    def __str__(self):
+        return 'for %s in %s%s: hash join by %s == %s' % (
+            get_source(self.target),
+            get_source(self.iter),
+            ''.join(' if %s' % get_source(test) for test in self.ifs),
+            get_source(self.key),
+            get_source(self.value),
+        )
+
+
+class PushedCondition:
+    '''A condition moved to an earlier generator.'''
+    def __init__(self, test, comprehension):
+        self.test = test
+        self.target = comprehension.target
+        self.iter = comprehension.iter
+
+    def __str__(self):
+        return 'if %s: moved to for %s in %s' % (get_source(self.test),
+                                                 get_source(self.target),
+                                                 get_source(self.iter))
+
+
+def push_down_conditions(query):
+    '''Move each condition to the earliest generator that binds its names.
+
+    In a query like::
+
+        ((p, c) for p in people for c in cities if p.age > 30)
+
+    the condition ``p.age > 30`` only depends on the first generator, but
+    it's written after the second one; so it's tested for every pair.  This
+    moves it to the first generator::
+
+        ((p, c) for p in people if p.age > 30 for c in cities)
+
+    Conditions joined by ``and`` are split first so that each one can be
+    moved on its own.  The relative order of the conditions in the same
+    generator is kept since a condition may guard the next ones (as in ``x
+    is not None and x.y``).
+
+    Return a pair with the new QST and a list of the `PushedCondition`:class:
+    objects.
+
+    '''
+    query = deepcopy(query)
+    node = query.body if isinstance(query, ast.Expression) else query
+    generators = getattr(node, 'generators', [])
+    pushed = []
+    for index, comp in enumerate(generators):
+        tests, comp.ifs = comp.ifs, []
+        for test in (cond for test in tests for cond in _conjuncts(test)):
+            names = detect_names(test)
+            where = next(
+                (i for i in range(index, 0, -1)
+                 if _get_targets(generators[i].target) & names),
+                0
+            )
+            generators[where].ifs.append(test)
+            if where != index:
+                pushed.append(PushedCondition(test, generators[where]))
+    return qst.ensure_compilable(query), pushed
+
+
+def hash_joins(query, operator):
+    '''Rewrite the equality joins between generators as hash joins.
+
+    A generator is joined if:
+
+    - its target is a single name,
+
+    - its collection doesn't depend on the previous generators, and
+
+    - one of its conditions is an equality ``value == key`` where `key`
+      depends on the target (and not on the previous generators) and `value`
+      depends on the previous generators (and not on the target).
+
+    The collection of a joined generator is replaced by a call to
+    `operator`::
+
+        operator(site, lambda: (target for target in collection if ...),
+                 lambda target: key, value)
+
+    which must return the items of the collection matching the `value`.  The
+    conditions of the generator which don't depend on the previous generators
+    are moved inside the first lambda.  The `site` is a number which
+    identifies the join in the query, so that the operator builds the
+    dictionary only once per execution.
+
+    Return a pair with the new QST and a list with the strategy
+    (`NestedLoop`:class: or `HashJoin`:class:) chosen for each generator.
+
+    '''
+    query = deepcopy(query)
+    node = query.body if isinstance(query, ast.Expression) else query
+    strategies = []
+    bound = set()
+    for comp in getattr(node, 'generators', ()):
+        join = _find_join(comp, bound) if bound else None
+        if join is None:
+            strategies.append(NestedLoop(comp))
+        else:
+            test, key, value = join
+            target = comp.target.id
+            comp.ifs.remove(test)
+            local = [cond for cond in comp.ifs
+                     if not detect_names(cond) & bound]
+            comp.ifs = [cond for cond in comp.ifs if cond not in local]
+            strategies.append(
+                HashJoin(comp.target, comp.iter, local, key, value)
+            )
+            if local:
+                collection = qst.GeneratorExp(
+                    qst.Name(target, qst.Load()),
+                    [qst.comprehension(qst.Name(target, qst.Store()),
+                                       comp.iter, local)]
+                )
+            else:
+                collection = comp.iter
+            comp.iter = qst.Call(
+                qst.Name(operator, qst.Load()),
+                [qst.Num(len(strategies) - 1),
+                 _lambda([], collection),
+                 _lambda([target], key),
+                 value],
+                []
+            )
+        bound |= _get_targets(comp.target)
+    return qst.ensure_compilable(query), strategies
+
+
+def _find_join(comp, bound):
+    # Find the condition of `comp` which joins it to the previous generators
+    # whose targets are `bound`.  Return the condition, and the key and value
+    # expressions.
+    if not isinstance(comp.target, ast.Name):
+        return None
+    if detect_names(comp.iter) & bound:
+        return None
+    target = {comp.target.id}
+    for test in comp.ifs:
+        if _is_equality(test):
+            left, right = test.left, test.comparators[0]
+            lnames, rnames = detect_names(left), detect_names(right)
+            for key, knames, value, vnames in ((left, lnames, right, rnames),
+                                               (right, rnames, left, lnames)):
+                if (knames & target and not knames & bound and
+                        vnames & bound and not vnames & target):
+                    return test, key, value
+    return None
+
+
+# The expressions which are not worth hoisting or can't be hoisted.  A
+# comprehension would be consumed by the first item.
+_NOT_HOISTED = tuple(
+    getattr(ast, name)
+    for name in ('Name', 'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis',
+                 'Constant', 'Starred', 'Lambda', 'GeneratorExp', 'ListComp',
+                 'SetComp', 'DictComp')
+    if hasattr(ast, name)
+)
+
+_COMPREHENSIONS = (ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)
+
+# The nodes of the expressions which are hoisted; they don't have side
+# effects.  Displays of lists, sets and dicts are not hoisted: the items would
+# share the object.  Calls are hoisted only if the function is one of the
+# `PURE_FUNCTIONS`.
+_PURE = tuple(
+    getattr(ast, name)
+    for name in ('Name', 'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis',
+                 'Constant', 'Attribute', 'Subscript', 'Index', 'Slice',
+                 'ExtSlice', 'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp',
+                 'Tuple', 'keyword', 'expr_context', 'operator', 'unaryop',
+                 'cmpop', 'boolop')
+    if hasattr(ast, name)
+)
+
+
+#: The functions whose calls can be hoisted by `hoist_invariants`:func:.
+#: They must not have side effects, and return immutable values (or values
+#: that are not modified by the queries).  Add other functions to this set to
+#: hoist their calls.
+PURE_FUNCTIONS = {
+    abs, bool, bytes, chr, complex, divmod, float, format, frozenset,
+    getattr, hasattr, hash, int, isinstance, issubclass, len, max, min, ord,
+    pow, repr, round, str, sum, tuple, type,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+    decimal.Decimal, fractions.Fraction,
+}
+
+
+def _get_bound_names(node):
+    # All the names bound anywhere inside `node`.
+    result = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.comprehension):
+            result |= _get_targets(child.target)
+        elif isinstance(child, ast.arg):
+            result.add(child.arg)
+        elif isinstance(child, ast.Name) and \
+                not isinstance(child.ctx, ast.Load):
+            result.add(child.id)
+    return result
+
+
+def _conjuncts(test):
+    # The conditions `test` is the conjunction of.
+    if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.And):
+        return [cond for value in test.values for cond in _conjuncts(value)]
+    else:
+        return [test]
+
+
+def _is_equality(node):
+    return (isinstance(node, ast.Compare) and len(node.ops) == 1 and
+            isinstance(node.ops[0], ast.Eq))
+
+
+def _get_targets(target):
+    # The names bound by the target of a comprehension.
+    if isinstance(target, ast.Name):
+        return {target.id}
+    elif isinstance(target, (ast.Tuple, ast.List)):
+        return set().union(*(_get_targets(elt) for elt in target.elts))
+    elif isinstance(target, ast.Starred):
+        return _get_targets(target.value)
+    else:
+        return set()
+
+
+def _lambda(args, body):
+    return qst.Lambda(
+        qst.arguments([qst.arg(arg, None) for arg in args],
+                      None, [], [], None, []),
+        body
+    )
+
+
+class Hoisted:
+    '''A loop-invariant expression which is evaluated once per execution.
+
+    The plan must bind `name` to the value of the `expression` (a
+    `qst.Expression`) before running the query.
+
+    '''
+    def __init__(self, name, node):
+        self.name = name
+        self.node = node
+        self.expression = qst.ensure_compilable(qst.Expression(node))
+
+    def __str__(self):
+        return '%s = %s' % (self.name, get_source(self.node))
+
+
+def hoist_invariants(query, prefix, get_value):
+    '''Hoist the sub-expressions that don't depend on the generators.
+
+    A sub-expression like ``today - timedelta(days=30)`` in::
+
+        (who for who in people if who.birthdate > today - timedelta(days=30))
+
+    has the same value for every item.  This replaces each maximal
+    sub-expression which only uses free names (or none at all) with a name
+    made from the `prefix`.
+
+    A name is free if `get_value` (usually `QueryObject.get_value
+    <xotl.ql.core.QueryObject.get_value>`:meth:) finds it, or if it's a
+    builtin; but names whose value is `~xotl.ql.core.this`:obj: or a query
+    object are left to the plan.  Names and constants are never hoisted.
+
+    Only expressions without side effects are hoisted: attributes,
+    subscripts, operators, tuples and calls to the `PURE_FUNCTIONS`:data:.
+    Calls to other functions (which could return a different value each
+    time), lambdas, comprehensions and displays of lists, sets or dicts
+    (each item gets a new one) are evaluated for each item.  If evaluating
+    the hoisted expressions fails, plans should run the query without
+    hoisting: the query might not evaluate them at all (e.g. if a collection
+    is empty).
+
+    Return a pair with the new QST and the list of `Hoisted`:class:
+    expressions.
+
+    '''
+    query = deepcopy(query)
+    node = query.body if isinstance(query, ast.Expression) else query
+    if not isinstance(node, _COMPREHENSIONS):
+        return query, []
+    bound = _get_bound_names(node)
+    hoisted = []
+
+    def isfree(name):
+        from xotl.ql.core import this
+        from xotl.ql.interfaces import QueryObject
+        if name in bound:
+            return False
+        try:
+            value = get_value(name)
+        except NameError:
+            return hasattr(builtins, name)
+        else:
+            return value is not this and not isinstance(value, QueryObject)
+
+    def function(node):
+        # The value of the function called in a Call node; None if it's
+        # not a (dotted) name.
+        if isinstance(node, ast.Name):
+            try:
+                return get_value(node.id)
+            except NameError:
+                return getattr(builtins, node.id, None)
+        elif isinstance(node, ast.Attribute):
+            return getattr(function(node.value), node.attr, None)
+        else:
+            return None
+
+    def ispure(expr):
+        for child in ast.walk(expr):
+            if isinstance(child, ast.Call):
+                try:
+                    if function(child.func) not in PURE_FUNCTIONS:
+                        return False
+                except TypeError:   # unhashable
+                    return False
+            elif not isinstance(child, _PURE):
+                return False
+        return True
+
+    def invariant(expr):
+        return (not isinstance(expr, _NOT_HOISTED) and
+                all(isfree(name) for name in detect_names(expr)) and
+                ispure(expr))
+
+    def hoist(parent):
+        for field, value in ast.iter_fields(parent):
+            if isinstance(value, list):
+                items = list(enumerate(value))
+            else:
+                items = [(None, value)]
+            for index, child in items:
+                if child is first:
+                    # The collection of the first generator is evaluated
+                    # only once.
+                    pass
+                elif isinstance(child, ast.expr) and invariant(child):
+                    name = qst.Name('%s%d' % (prefix, len(hoisted)),
+                                    qst.Load())
+                    hoisted.append(Hoisted(name.id, child))
+                    if index is None:
+                        setattr(parent, field, name)
+                    else:
+                        value[index] = name
+                elif isinstance(child, ast.AST):
+                    hoist(child)
+
+    first = node.generators[0].iter
+    hoist(node)
+    return qst.ensure_compilable(query), hoisted
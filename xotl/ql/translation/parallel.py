@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Parallel execution of query plans.
+
+A plan runs in parallel by splitting the collection of the first generator of
+the query in chunks, and running the rest of the query for each chunk.  The
+results of the chunks are merged into a single stream.
+
+Use a `ProcessPool`:class: for CPU-bound queries, and a `ThreadPool`:class:
+for queries that wait for I/O (like calling a remote service in the
+projection or the conditions).
+
+To run a chunk in another process the plan is serialized (see
+`dumps`:func:) as the code of the query and the values of the names it uses.
+Those values (and the results of the query) must be picklable.
+
+'''
+
+import builtins
+import marshal
+import pickle
+from collections import deque
+from itertools import islice
+
+
+#: The version of the format of serialized plans.  Workers refuse plans in
+#: other formats.
+VERSION = 1
+
+
+def dumps(run, code, namespace):
+    '''Serialize a plan.
+
+    :param run: A picklable function that runs the `code` in a namespace
+                like ``run(code, namespace)``, returning an iterable.
+
+    :param code: The code object of the plan.  It's serialized with
+                 `marshal`:mod:, so it's only valid for the same version of
+                 the interpreter.
+
+    :param namespace: A dictionary with the values of the names used by
+                      `code`.
+
+    Return the serialized plan as bytes.  Raise `pickle.PicklingError`:class:
+    (or TypeError) if any of the values can't be pickled.
+
+    '''
+    return pickle.dumps((VERSION, run, marshal.dumps(code), namespace),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+def loads(data):
+    '''Load a plan serialized with `dumps`:func:.
+
+    Return a tuple of the `run` function, the code object, and the namespace.
+
+    '''
+    version, run, code, namespace = pickle.loads(data)
+    if version != VERSION:
+        raise ValueError('Unsupported version of the plan: %r' % version)
+    return run, marshal.loads(code), namespace
+
+
+def get_names(code):
+    '''Return the set of global names used by `code` and its nested code.'''
+    result = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            result |= get_names(const)
+    return result
+
+
+class ProcessPool:
+    '''Run the plans in a pool of `processes` worker processes.
+
+    The collection of the first generator of the query is split in chunks of
+    `chunksize` items which are run by the workers.  If `ordered` is True
+    the results keep the order of the collection, otherwise the results of
+    each chunk are merged as soon as they are ready.
+
+    A new pool is started for each execution of the plan, so this only pays
+    off when the work per item is large (CPU-bound predicates, for
+    instance).
+
+    '''
+    #: The chunks are run in other processes, the plan must be serialized.
+    local = False
+
+    def __init__(self, processes=None, chunksize=1000, ordered=True):
+        if chunksize < 1:
+            raise ValueError('chunksize must be positive')
+        self.processes = processes
+        self.chunksize = chunksize
+        self.ordered = ordered
+
+    def __str__(self):
+        return 'process pool of %s processes, chunks of %d items%s' % (
+            self.processes or 'cpu_count()',
+            self.chunksize,
+            '' if self.ordered else ', unordered'
+        )
+
+    def map(self, run, code, namespace, name, collection):
+        '''Run the plan over the chunks of the `collection`.
+
+        The `code` is run with the name `name` bound to each chunk.  See
+        `dumps`:func: for the other arguments.
+
+        Return an iterator over the results, or None if the plan is not
+        picklable.  The items of the collection must be picklable too, but
+        that's only known when they are sent to the workers.
+
+        '''
+        try:
+            data = dumps(run, code, namespace)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return self._map(data, name, _chunks(collection, self.chunksize))
+
+    def _map(self, data, name, chunks):
+        from multiprocessing import Pool
+        with Pool(self.processes, _start, (data, name)) as pool:
+            imap = pool.imap if self.ordered else pool.imap_unordered
+            for results in imap(_run_chunk, chunks):
+                yield from results
+
+
+class ThreadPool:
+    '''Run the plans in a pool of `threads` threads.
+
+    The collection of the first generator of the query is split in chunks of
+    `chunksize` items, each chunk is run in one of the threads.  The results
+    are merged in the order of the collection if `ordered` is True, otherwise
+    as soon as they are ready.
+
+    At most `max_pending` chunks (twice the number of threads by default)
+    are read from the collection ahead of the results consumed; so that a
+    large (or infinite) collection is not read all at once.
+
+    The threads share the values of the names used by the query, which must
+    be safe to use from several threads.
+
+    '''
+    #: The chunks are run in this process with the namespace of the plan.
+    local = True
+
+    def __init__(self, threads=8, chunksize=1, ordered=True,
+                 max_pending=None):
+        if threads < 1 or chunksize < 1:
+            raise ValueError('threads and chunksize must be positive')
+        self.threads = threads
+        self.chunksize = chunksize
+        self.ordered = ordered
+        self.max_pending = max_pending or 2 * threads
+
+    def __str__(self):
+        return 'thread pool of %d threads, chunks of %d items%s, ' \
+            'at most %d pending' % (
+                self.threads,
+                self.chunksize,
+                '' if self.ordered else ', unordered',
+                self.max_pending
+            )
+
+    def map(self, run, code, namespace, name, collection):
+        '''Run the plan over the chunks of the `collection`.
+
+        Each thread runs the `code` (with ``run(code, namespace)``) in a
+        copy of the `namespace` where the name `name` is bound to each chunk.
+
+        Return an iterator over the results.
+
+        '''
+        import threading
+        local = threading.local()
+
+        def run_chunk(chunk):
+            chunk_namespace = getattr(local, 'namespace', None)
+            if chunk_namespace is None:
+                chunk_namespace = local.namespace = dict(namespace)
+            chunk_namespace[name] = chunk
+            return list(run(code, chunk_namespace))
+
+        return self._map(run_chunk, _chunks(collection, self.chunksize))
+
+    def _map(self, run_chunk, chunks):
+        from concurrent.futures import (
+            ThreadPoolExecutor, wait, FIRST_COMPLETED
+        )
+        pending = deque()
+
+        def results():
+            if self.ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                yield from future.result()
+
+        with ThreadPoolExecutor(self.threads) as executor:
+            try:
+                for chunk in chunks:
+                    if len(pending) >= self.max_pending:
+                        yield from results()
+                    pending.append(executor.submit(run_chunk, chunk))
+                while pending:
+                    yield from results()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def _chunks(collection, size):
+    iterator = iter(collection)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+# The plan loaded by each worker: the `run` function, the code, the namespace
+# and the name bound to the chunk.
+_plan = None
+
+
+def _start(data, name):
+    global _plan
+    run, code, namespace = loads(data)
+    namespace.setdefault('__builtins__', builtins)
+    _plan = run, code, namespace, name
+
+
+def _run_chunk(chunk):
+    run, code, namespace, name = _plan
+    namespace[name] = chunk
+    return list(run(code, namespace))
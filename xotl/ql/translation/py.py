@@ -7,12 +7,35 @@
 # This is free software; you can do what the LICENCE file allows you to.
 #
 
+import heapq
+from collections import OrderedDict
+from copy import deepcopy
+from itertools import islice
+from weakref import WeakKeyDictionary
+
 from xoutil.modules import modulemethod
+from xoutil.objects import memoized_property
 
 from xotl.ql.core import normalize_query
 from xotl.ql.interfaces import QueryObject
 
-from .monads import mcompile, LazyCons, Map, Unit, Join, Empty
+from . import TranslationError
+from .aggregates import get_aggregate, collect, last, HashAggregation
+from .sorting import ExternalSort
+from .parallel import get_names
+from . import batches
+from .optimizations import (
+    push_down_conditions,
+    hash_joins,
+    hoist_invariants,
+    get_source,
+    _get_targets,
+)
+
+
+# The keyword arguments of NaivePythonExecutionPlan.__call__ which are not
+# query parameters.
+_CALL_ARGUMENTS = ('modules', 'use_ignores')
 
 
 @modulemethod
@@ -33,29 +56,420 @@ def explain(self, query, **kwargs):
     self.NaivePythonExecutionPlan(query, **kwargs).explain()
 
 
-class NaivePythonExecutionPlan:
+class _PythonExecutionPlan:
+    # The parts shared by the plans that run queries over the Python objects
+    # in memory.  Subclasses must provide `_compile` and `_run`, and set the
+    # `plan` and the `compiled` code of the optimized `qst`.
+    use_own_monads = False
+
+    def __init__(self, query, optimize=True, max_groups=None,
+                 max_sorted=None, parallel=None):
+        self.query = query = normalize_query(query)
+        self.params = params = tuple(getattr(query, 'params', ()))
+        if any(param in _CALL_ARGUMENTS for param in params):
+            raise TranslationError(
+                'Query parameters cannot be named %s' % ' or '.join(
+                    repr(arg) for arg in _CALL_ARGUMENTS
+                )
+            )
+        self._subplans = WeakKeyDictionary()
+        self._consumed = None
+        self.aggregate, qst, self.keyed = _split_aggregate(query)
+        self.groups = getattr(query, 'groups', None)
+        self.max_groups = max_groups
+        self.max_sorted = max_sorted
+        self.parallel = parallel
+        if self.groups is not None:
+            if self.keyed:
+                raise TranslationError(
+                    'Dictionary comprehensions cannot have groups'
+                )
+            if self.aggregate is None:
+                self.aggregate = collect
+            qst = _with_targets(qst)
+        self.optimize = optimize
+        self.hashjoin = '__x_hashjoin_%s' % id(self)
+        self.qst, self.pushed, self.strategies = qst, [], []
+        self.hoisted = []
+        if optimize:
+            self._optimize(qst)
+        self._hoisted_code = [
+            (hoisted.name, compile(hoisted.expression, '', 'eval'))
+            for hoisted in self.hoisted
+        ]
+
+    def _optimize(self, qst):
+        # Apply the optimizations to the `qst`, and set the optimized `qst`
+        # and the reports of each optimization.
+        qst, self.pushed = push_down_conditions(qst)
+        qst, self.strategies = hash_joins(qst, self.hashjoin)
+        self.qst, self.hoisted = hoist_invariants(
+            qst,
+            '__x_hoisted_%s_' % id(self),
+            self.query.get_value
+        )
+        self._unhoisted_qst = qst
+
+    def _explain_optimizations(self):
+        if self.aggregate is not None:
+            print('\nAggregate')
+            if self.groups is not None:
+                print('%s grouped by %r' % (self.aggregate.name, self.groups))
+            elif self.keyed:
+                print('%s grouped by the keys' % self.aggregate.name)
+            else:
+                print(self.aggregate.name)
+            if self.max_groups is not None and (self.groups or self.keyed):
+                print('at most %d groups in memory' % self.max_groups)
+        if self.pushed:
+            print('\nPushed conditions')
+            for pushed in self.pushed:
+                print(str(pushed))
+        if self.strategies:
+            print('\nJoin strategies')
+            for strategy in self.strategies:
+                print(str(strategy))
+        if self.hoisted:
+            print('\nHoisted expressions')
+            for hoisted in self.hoisted:
+                print(str(hoisted))
+        partition = getattr(self.query, 'partition', None)
+        ordering = getattr(self.query, 'ordering', None)
+        if partition is not None or ordering is not None:
+            print('\nPartition')
+            if ordering is not None:
+                key, reverse = ordering
+                line = '%s by %r' % (
+                    'top-k' if _is_top(partition) else 'sorted',
+                    key
+                )
+                if self.grouped:
+                    line += ' of the keys of the groups'
+                print(line + (' (reversed)' if reverse else ''))
+                if self.max_sorted is not None and not _is_top(partition):
+                    print('at most %d items sorted in memory' %
+                          self.max_sorted)
+            if partition is not None:
+                print(repr(partition) +
+                      (' of the groups' if self.grouped else ''))
+        if self.parallel is not None:
+            print('\nParallel')
+            if self._parallel_plan is None:
+                print('not supported by the query')
+            else:
+                print(str(self.parallel))
+
+    @property
+    def grouped(self):
+        '''True if the results of the plan are groups.'''
+        return self.aggregate is not None and (self.groups is not None or
+                                               self.keyed)
+
+    @property
+    def operators(self):
+        return self._get_operators()
+
+    def _get_operators(self, modules=None, use_ignores=True, params=None):
+        def __do_plan(what):
+            return self._do_plan(what, modules, use_ignores, params)
+
+        return {self.hashjoin: _HashJoin(__do_plan)}
+
+    def _get_worker_operators(self):
+        # The operators for running the plan in another process.  They must
+        # be picklable; sub-queries are not supported.
+        return {self.hashjoin: _HashJoin(_identity)}
+
+    def _plan_dict_(self, other, modules=None, use_ignores=True):
+        from xotl.ql.core import this
+
+        def universe():
+            return PythonObjectsCollection(
+                modules,
+                use_ignores=use_ignores,
+                ascons=self.use_own_monads
+            )
+
+        return {
+            name: (val if val is not this else universe())
+            for name, val in other.items()
+        }
+
+    def __call__(self, modules=None, use_ignores=True, **params):
+        '''Execute the plan.
+
+        :param modules: If not None, only the objects of types defined in
+                        these modules are retrieved from `this`.
+
+        :param use_ignores: If True, ignore the objects of types defined in
+                            ``xotl.ql``, ``xoutil``, etc.
+
+        Any other keyword argument gives the value of a query parameter (see
+        `xotl.ql.core.QueryObject.params`:attr:).  Parameters not given take
+        the value they have in the query's frame.
+
+        If the query is an aggregate return its value instead of an iterator.
+
+        If the query has `groups` (or it's a dictionary comprehension) return
+        a dictionary from the keys of the groups to the value of the aggregate
+        in each group (see `iter_groups`:meth:); an ordered dictionary if the
+        query has an ordering.
+
+        '''
+        if self.grouped:
+            groups = self.iter_groups(modules, use_ignores, **params)
+            if getattr(self.query, 'ordering', None) is not None:
+                return OrderedDict(groups)
+            else:
+                return dict(groups)
+        self._check_params(params)
+        result = self._execute(modules, use_ignores, params)
+        if self.aggregate is None:
+            return result
+        else:
+            return self.aggregate(result)
+
+    def iter_groups(self, modules=None, use_ignores=True, **params):
+        '''Execute the plan of a query with groups.
+
+        Return an iterator over the pairs of the keys of the groups and the
+        values of the aggregate.  The ordering of the query sorts the groups:
+        its key function is called with the keys of the groups.  The
+        partition of the query is a slice of the groups.  The arguments are
+        the same of `__call__`:meth:.
+
+        If the plan was created with `max_groups`, the groups are spilled to
+        disk if there are more than `max_groups` (see
+        `xotl.ql.translation.aggregates.HashAggregation`:class:), and the
+        iterator doesn't keep all of them in memory.
+
+        '''
+        if not self.grouped:
+            raise TranslationError('The query has no groups')
+        self._check_params(params)
+        result = self._execute(modules, use_ignores, params)
+        if self.groups is not None:
+            groups = self.groups
+            pairs = ((groups(*targets), value) for targets, value in result)
+        else:
+            pairs = result
+        result = HashAggregation(self.aggregate,
+                                 max_groups=self.max_groups)(pairs)
+        ordering = getattr(self.query, 'ordering', None)
+        if ordering is not None:
+            key, reverse = ordering
+            ordering = (_by_group_key(key), reverse)
+        return _partition(result, getattr(self.query, 'partition', None),
+                          ordering, self.max_sorted)
+
+    def _check_params(self, params):
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise TypeError(
+                'Unknown query parameters: %s' % ', '.join(sorted(unknown))
+            )
+
+    def _execute(self, modules, use_ignores, params):
+        self._use_source()
+        namespace = self._get_namespace(modules, use_ignores, params)
+        compiled = self._hoist(namespace)
+        if self.parallel is not None and compiled is self.compiled and \
+                self._parallel_plan is not None:
+            result = self._run_parallel(namespace)
+        else:
+            result = self._run(compiled, namespace)
+        if self.grouped:
+            # The ordering and the partition are of the groups (see
+            # `iter_groups`).
+            return result
+        return _partition(
+            result,
+            getattr(self.query, 'partition', None),
+            getattr(self.query, 'ordering', None),
+            self.max_sorted
+        )
+
+    def _use_source(self):
+        # The collection of the first generator is iterated by each
+        # execution.  Sequences and sub-queries are iterated again, but
+        # other iterators are consumed by the first execution (see
+        # `xotl.ql.core.sub_query_or_value`).
+        from xotl.ql.core import _is_single_use
+        source = self.query.locals.get('.0')
+        if _is_single_use(source):
+            if source is self._consumed:
+                raise TranslationError(
+                    'The query was executed already and its collection is '
+                    'an iterator; use a sequence or a sub-query instead'
+                )
+            self._consumed = source
+
+    def _get_namespace(self, modules, use_ignores, params):
+        from xoutil.future.collections import ChainMap
+        return (
+            # Don't split the globals and locals... Why?
+            #
+            # When we parse the byte-code, opcodes like LOAD_NAME, LOAD_FAST,
+            # LOAD_DEREF, and LOAD_LOCAL are all cast to a the same QST
+            # `qst.Name(..., qst.Load())` where the local/global/cell
+            # distinction is lost.
+            #
+            # The 'core.py' treats the name '.0' specially since they're most
+            # likely subqueries.  But then, those subqueries carry their own
+            # local/global and the loss of context can lead to bad guesses.
+            #
+            # This is evident in the the implementation of `thesefy`, where
+            # the 'self' is confused with a global.
+            #
+            # Query parameters shadow the names in the frame, even in
+            # sub-queries.
+            #
+            dict(ChainMap(
+                self._plan_dict_(params, modules, use_ignores),
+                self._plan_dict_(self.query.locals, modules, use_ignores),
+                self._plan_dict_(self.query.globals, modules, use_ignores),
+                self._get_operators(modules, use_ignores, params)
+            ))
+        )
+
+    def _hoist(self, namespace):
+        # Bind the hoisted expressions in the namespace, and return the code
+        # to run.
+        try:
+            for name, code in self._hoisted_code:
+                namespace[name] = eval(code, namespace)
+        except Exception:
+            # The query might have never evaluated the failing expression.
+            return self._unhoisted_compiled
+        else:
+            return self.compiled
+
+    def _run_parallel(self, namespace):
+        # Evaluate the collection of the first generator and let the
+        # `parallel` strategy run the plan over it.  If it can't, run the
+        # plan here.  Sub-queries are not split, and the object space is not
+        # sent to other processes.
+        name, collection, compiled = self._parallel_plan
+        collection = eval(collection, namespace)
+        if isinstance(collection, QueryObject):
+            result = None
+        elif self.parallel.local:
+            result = self.parallel.map(self._run, compiled, namespace, name,
+                                       collection)
+        elif isinstance(collection, PythonObjectsCollection):
+            result = None
+        else:
+            operators = self._get_operators()
+            shipped = {
+                key: namespace[key]
+                for key in get_names(compiled)
+                if key in namespace and key not in operators
+            }
+            shipped.update(self._get_worker_operators())
+            result = self.parallel.map(type(self)._run, compiled, shipped,
+                                       name, collection)
+        if result is None:
+            namespace[name] = collection
+            result = self._run(compiled, namespace)
+        return result
+
+    @memoized_property
+    def _parallel_plan(self):
+        # The plan to run in parallel: the name that replaces the collection
+        # of the first generator, the code of that collection, and the code
+        # of the plan.
+        import ast
+        from xotl.ql.revenge import qst as _qst
+        qst = deepcopy(self.qst)
+        node = qst.body if isinstance(qst, ast.Expression) else qst
+        if not isinstance(node, ast.GeneratorExp):
+            return None
+        first = node.generators[0]
+        name = '__x_chunk_%s' % id(self)
+        collection = _qst.ensure_compilable(_qst.Expression(first.iter))
+        first.iter = _qst.Name(name, _qst.Load())
+        _, compiled = self._compile(_qst.ensure_compilable(qst))
+        return name, compile(collection, '', 'eval'), compiled
+
+    @memoized_property
+    def _unhoisted_compiled(self):
+        _, compiled = self._compile(self._unhoisted_qst)
+        return compiled
+
+    def _compile(self, qst):
+        raise NotImplementedError
+
+    @staticmethod
+    def _run(compiled, namespace):
+        raise NotImplementedError
+
+    def _do_plan(self, what, modules=None, use_ignores=True, params=None):
+        if isinstance(what, QueryObject):
+            # Sub-plans are translated once per sub-query object.
+            plan = self._subplans.get(what)
+            if plan is None:
+                plan = self._subplans[what] = self._get_subplan(what)
+            return plan._execute(modules, use_ignores, params or {})
+        else:
+            return what
+
+    def _get_subplan(self, query):
+        return type(self)(query, optimize=self.optimize)
+
+    def __iter__(self):
+        return self()
+
+
+class NaivePythonExecutionPlan(_PythonExecutionPlan):
+    '''The default plan: the query is compiled to the Map, Join, Unit and
+    Empty operators of a monad.
+
+    If `batch_size` is given, the operators work over batches of at most
+    `batch_size` items, and the loops and conditions of the query are
+    evaluated with a list comprehension per batch (see
+    `xotl.ql.translation.batches`:mod:).  The results are the same.
+
+    '''
     def __init__(self, query, map=None, join=None, zero=None, unit=None,
-                 use_own_monads=False):
+                 use_own_monads=False, batch_size=None, **kwargs):
         # The map, join, zero, and unit are provided for tests.
-        self.query = query = normalize_query(query)
+        if batch_size is not None:
+            if batch_size < 1:
+                raise ValueError('batch_size must be positive')
+            if use_own_monads:
+                raise TranslationError(
+                    'Batches are not supported with the own monads'
+                )
+        super().__init__(query, **kwargs)
         self.map = '__x_map_%s' % id(self) if not map else map
         self.join = '__x_join_%s' % id(self) if not join else join
         self.zero = '__x_zero_%s' % id(self) if not zero else zero
         self.unit = '__x_unit_%s' % id(self) if not unit else unit
+        self.select = '__x_select_%s' % id(self)
+        self.each = '__x_each_%s' % id(self)
         self.use_own_monads = use_own_monads
-        self.plan = plan = mcompile(
-            query.qst,
+        self.batch_size = batch_size
+        self.plan, self.compiled = self._compile(self.qst)
+
+    def _compile(self, qst):
+        from .monads import mcompile
+        plan = mcompile(
+            qst,
             map=self.map,
             join=self.join,
             zero=self.zero,
             unit=self.unit
         )
-        self.compiled = compile(plan, '', 'eval')
+        if self.batch_size is not None:
+            plan = batches.batch_plan(plan, self.map, self.join, self.unit,
+                                      self.zero, self.select, self.each)
+        return plan, compile(plan, '', 'eval')
 
     def explain(self):
         '''Prints information about how the query is going to be executed.
 
-        This prints the `Query Syntax Tree`:term:, the Syntax Tree of the
+        This prints the `Query Syntax Tree`:term:, the optimizations (see
+        `xotl.ql.translation.optimizations`:mod:), the Syntax Tree of the
         monad-based plan for executing the query, and the byte-code for the
         compile plan.
 
@@ -69,90 +483,700 @@ class NaivePythonExecutionPlan:
         import dis
         print('\nOriginal query QST')
         print(str(self.query.qst))
+        self._explain_optimizations()
+        if self.batch_size is not None:
+            print('\nBatches')
+            print('batches of %d items' % self.batch_size)
         print('\nMonadic plan')
         print(str(self.plan))
         print('\nCompiled')
         dis.dis(self.compiled)
 
-    @property
-    def operators(self):
+    def _get_operators(self, modules=None, use_ignores=True, params=None):
+        operators = super()._get_operators(modules, use_ignores, params)
         if self.use_own_monads:
-            return {
+            from .monads import Map, Join, Unit, Empty
+            operators.update({
                 self.map: Map,
                 self.join: Join,
                 self.unit: Unit,
                 self.zero: Empty,
-            }
+            })
+        elif self.batch_size is not None:
+            def __do_plan(what):
+                return self._do_plan(what, modules, use_ignores, params)
+
+            operators.update(self._get_batch_operators(__do_plan))
         else:
             # In the following we use a 'mathematical' notation for variable
             # names: `f` stands for function, `l` stands for list (or
             # collection), `lls` stands for list of lists and `x` any item in
             # a list.
-            __do_plan = self._do_plan
-            return {
+            def __do_plan(what):
+                return self._do_plan(what, modules, use_ignores, params)
+
+            operators.update({
                 # These functions must return iterators since the _mc uses
                 # results from
                 self.map: lambda f: lambda l: iter(f(x) for x in __do_plan(l)),
                 self.join: lambda lls: iter(x for l in lls for x in l),
                 self.unit: lambda x: iter([x]),
                 self.zero: lambda: iter([]),
-            }
+            })
+        return operators
 
-    def _plan_dict_(self, other, modules=None, use_ignores=True):
-        from xotl.ql.core import this
-
-        def universe():
-            return PythonObjectsCollection(
-                modules,
-                use_ignores=use_ignores,
-                ascons=self.use_own_monads
-            )
+    def _get_worker_operators(self):
+        operators = super()._get_worker_operators()
+        if self.use_own_monads:
+            from .monads import Map, Join, Unit, Empty
+            operators.update({
+                self.map: Map,
+                self.join: Join,
+                self.unit: Unit,
+                self.zero: Empty,
+            })
+        elif self.batch_size is not None:
+            operators.update(self._get_batch_operators(_identity))
+        else:
+            operators.update({
+                self.map: _map,
+                self.join: _join,
+                self.unit: _unit,
+                self.zero: _zero,
+            })
+        return operators
 
+    def _get_batch_operators(self, do_plan):
+        size = self.batch_size
         return {
-            name: (val if val is not this else universe())
-            for name, val in other.items()
+            self.map: batches.BatchMap(size, do_plan),
+            self.join: batches.BatchJoin(size),
+            self.unit: batches.unit,
+            self.zero: batches.zero,
+            self.select: batches.Select(size, do_plan),
+            self.each: do_plan,
         }
 
-    def __call__(self, modules=None, use_ignores=True):
-        from xoutil.future.collections import ChainMap
-        return eval(
-            self.compiled,
-            # Don't split the globals and locals... Why?
-            #
-            # When we parse the byte-code, opcodes like LOAD_NAME, LOAD_FAST,
-            # LOAD_DEREF, and LOAD_LOCAL are all cast to a the same QST
-            # `qst.Name(..., qst.Load())` where the local/global/cell
-            # distinction is lost.
-            #
-            # The 'core.py' treats the name '.0' specially since they're most
-            # likely subqueries.  But then, those subqueries carry their own
-            # local/global and the loss of context can lead to bad guesses.
-            #
-            # This is evident in the the implementation of `thesefy`, where
-            # the 'self' is confused with a global.
-            #
-            dict(ChainMap(
-                self._plan_dict_(self.query.locals, modules, use_ignores),
-                self._plan_dict_(self.query.globals, modules, use_ignores),
-                self.operators
-            ))
+    @staticmethod
+    def _run(compiled, namespace):
+        return iter(eval(compiled, namespace))
+
+    def _get_subplan(self, query):
+        return NaivePythonExecutionPlan(
+            query,
+            map=self.map,
+            join=self.join,
+            unit=self.unit,
+            zero=self.zero,
+            optimize=self.optimize,
+            batch_size=self.batch_size
         )
 
-    def _do_plan(self, what):
-        if isinstance(what, QueryObject):
-            return NaivePythonExecutionPlan(
-                what,
-                map=self.map,
-                join=self.join,
-                unit=self.unit,
-                zero=self.zero
+
+class GeneratorPythonExecutionPlan(_PythonExecutionPlan):
+    '''A plan that runs the query as a single generator function.
+
+    The query is compiled back into a flat Python generator function with a
+    ``for`` loop per generator and an ``if`` per condition.  For instance,
+    the query ``(x.name for x in this if x.age > 30)`` is executed by a
+    function like::
+
+        def __x_query_<id>():
+            for x in __x_iter_<id>(this):
+                if x.age > 30:
+                    yield x.name
+
+    where ``__x_iter_<id>`` is the identity, except for sub-queries which are
+    executed by its own generator plan.  Avoiding the nested calls to the
+    Map, Join, Unit and Empty operators makes this plan faster than the
+    `NaivePythonExecutionPlan`:class:.
+
+    '''
+    def __init__(self, query, **kwargs):
+        super().__init__(query, **kwargs)
+        self.name = '__x_query_%s' % id(self)
+        self.iter = '__x_iter_%s' % id(self)
+        self.plan, self.compiled = self._compile(self.qst)
+
+    def _compile(self, qst):
+        plan = _build_generator(qst, self.name, self.iter)
+        code = compile(plan, '', 'exec')
+        return plan, _get_function_code(code, self.name)
+
+    def explain(self):
+        '''Prints information about how the query is going to be executed.
+
+        This prints the `Query Syntax Tree`:term:, the optimizations, the
+        source of the generator function that executes the query, and its
+        byte-code.
+
+        The names of the generator function and of the function that iterates
+        over the sub-queries are 'randomized'.
+
+        '''
+        import dis
+        print('\nOriginal query QST')
+        print(str(self.query.qst))
+        self._explain_optimizations()
+        print('\nGenerator plan')
+        print(_get_function_source(self.plan))
+        print('\nCompiled')
+        dis.dis(self.compiled)
+
+    def _get_operators(self, modules=None, use_ignores=True, params=None):
+        def __iter(what):
+            return self._do_plan(what, modules, use_ignores, params)
+
+        operators = super()._get_operators(modules, use_ignores, params)
+        operators[self.iter] = __iter
+        return operators
+
+    def _get_worker_operators(self):
+        operators = super()._get_worker_operators()
+        operators[self.iter] = _identity
+        return operators
+
+    @staticmethod
+    def _run(compiled, namespace):
+        from types import FunctionType
+        return FunctionType(compiled, namespace)()
+
+
+class AsyncPythonExecutionPlan(_PythonExecutionPlan):
+    '''A plan that runs the query asynchronously.
+
+    Implements the interface
+    `xotl.ql.interfaces.AsyncQueryExecutionPlan`:class:.  Calling the plan
+    (or ``aiter(plan)``) returns an asynchronous iterator over the results::
+
+        async for result in plan:
+            ...
+
+    The collections of the generators may be asynchronous iterables (they
+    are consumed with ``async for``) or plain iterables.  Conditions that
+    return awaitables are awaited.  If the projection returns an awaitable,
+    it's scheduled as a task and its result is produced instead; at most
+    `concurrency` tasks run at any time, and the results keep the order of
+    the query.  The collections are read ahead of the consumer by at most
+    `concurrency` results.
+
+    Only the conditions are optimized (see
+    `~xotl.ql.translation.optimizations.push_down_conditions`:func:): hoisted
+    expressions and hash joins would consume awaitables or asynchronous
+    collections out of the event loop.  Aggregates, groups and ordered
+    queries are not supported.
+
+    '''
+    def __init__(self, query, concurrency=8, **kwargs):
+        if concurrency < 1:
+            raise ValueError('concurrency must be positive')
+        super().__init__(query, **kwargs)
+        if self.aggregate is not None or self.keyed:
+            raise TranslationError(
+                'Aggregates are not supported by asynchronous plans'
             )
-        else:
-            return what
+        if getattr(self.query, 'ordering', None) is not None:
+            raise TranslationError(
+                'Ordered queries are not supported by asynchronous plans'
+            )
+        partition = getattr(self.query, 'partition', None)
+        if partition is not None and _is_negative(partition):
+            raise TranslationError(
+                'Negative slices are not supported by asynchronous plans'
+            )
+        self.concurrency = concurrency
+        self.name = '__x_query_%s' % id(self)
+        self.iter = '__x_iter_%s' % id(self)
+        self.plan, self.compiled = self._compile(self.qst)
 
-    def __iter__(self):
+    def _optimize(self, qst):
+        self.qst, self.pushed = push_down_conditions(qst)
+
+    def _compile(self, qst):
+        import ast
+        from xotl.ql.revenge import qst as _qst
+        plan = _build_generator(qst, self.name, self.iter)
+        node = qst.body
+        bound, generators = [], []
+        for comp in node.generators:
+            names = sorted(_get_targets(comp.target))
+            if set(names) & set(bound):
+                raise TranslationError(
+                    'Asynchronous plans cannot bind %s again' % ', '.join(
+                        repr(name) for name in set(names) & set(bound)
+                    )
+                )
+            source = _qst.Call(_qst.Name(self.iter, _qst.Load()),
+                               [comp.iter], [])
+            iter = _compile_lambda(bound, source)
+            bind = ast.parse('lambda __x_item: [None for _ in [__x_item]][0]',
+                             mode='eval')
+            listcomp = bind.body.body.value
+            listcomp.elt = _qst.Tuple([_qst.Name(name, _qst.Load())
+                                       for name in names], _qst.Load())
+            listcomp.generators[0].target = deepcopy(comp.target)
+            bind = compile(ast.fix_missing_locations(bind), '', 'eval')
+            bound = bound + names
+            ifs = [_compile_lambda(bound, test) for test in comp.ifs]
+            generators.append((iter, bind, ifs))
+        return plan, (generators, _compile_lambda(bound, node.elt),
+                      self.concurrency)
+
+    def explain(self):
+        '''Prints information about how the query is going to be executed.
+
+        This prints the `Query Syntax Tree`:term:, the optimizations, and the
+        loops of the plan as a generator function.
+
+        '''
+        print('\nOriginal query QST')
+        print(str(self.query.qst))
+        self._explain_optimizations()
+        print('\nAsynchronous plan (at most %d concurrent tasks)' %
+              self.concurrency)
+        print(_get_function_source(self.plan))
+
+    def _get_operators(self, modules=None, use_ignores=True, params=None):
+        def __iter(what):
+            return self._do_plan(what, modules, use_ignores, params)
+
+        operators = super()._get_operators(modules, use_ignores, params)
+        operators[self.iter] = __iter
+        return operators
+
+    def _execute(self, modules, use_ignores, params):
+        self._use_source()
+        namespace = self._get_namespace(modules, use_ignores, params)
+        result = self._run(self.compiled, namespace)
+        partition = getattr(self.query, 'partition', None)
+        if partition is not None:
+            result = _AsyncSlice(result, partition)
+        return result
+
+    @staticmethod
+    def _run(compiled, namespace):
+        generators, elt, concurrency = compiled
+        return _AsyncQuery(
+            [(eval(iter, namespace), eval(bind, namespace),
+              [eval(test, namespace) for test in ifs])
+             for iter, bind, ifs in generators],
+            eval(elt, namespace),
+            concurrency
+        )
+
+    def __call__(self, modules=None, use_ignores=True, **params):
+        '''Execute the plan.
+
+        Return an asynchronous iterator over the results.  The arguments are
+        the same as `NaivePythonExecutionPlan.__call__`:meth:.
+
+        '''
+        return super().__call__(modules, use_ignores, **params)
+
+    def __aiter__(self):
         return self()
 
+    def __iter__(self):
+        raise TypeError('Asynchronous plans are iterated with "async for"')
+
+
+def _compile_lambda(args, body):
+    # Compile a lambda with the positional `args` and the `body`.  The lambda
+    # is parsed so that its arguments are valid for the running Python.
+    import ast
+    expression = ast.parse('lambda %s: None' % ', '.join(args), mode='eval')
+    expression.body.body = deepcopy(body)
+    return compile(ast.fix_missing_locations(expression), '', 'eval')
+
+
+class _AsyncQuery:
+    # The asynchronous iterator over the results of a query.  A task walks
+    # the loops of the query and puts the results (or the tasks that compute
+    # them) in a queue with room for `concurrency` items; so the loops wait
+    # for the consumer.  At most `concurrency` tasks run at once.
+    def __init__(self, generators, elt, concurrency):
+        self.generators = generators
+        self.elt = elt
+        self.concurrency = concurrency
+        self.queue = self.producer = self.slots = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        import asyncio
+        if self.producer is None:
+            self.queue = asyncio.Queue(self.concurrency)
+            self.slots = asyncio.Semaphore(self.concurrency)
+            self.producer = asyncio.ensure_future(self._produce())
+        item = await self.queue.get()
+        if item is _END:
+            self.queue.put_nowait(_END)
+            raise StopAsyncIteration
+        elif isinstance(item, _Failure):
+            self.queue.put_nowait(_END)
+            raise item.error
+        elif isinstance(item, asyncio.Future):
+            return await item
+        else:
+            return item
+
+    async def aclose(self):
+        '''Stop the query and cancel the pending results.'''
+        import asyncio
+        if self.producer is not None:
+            self.producer.cancel()
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if isinstance(item, asyncio.Future):
+                    item.cancel()
+            self.queue.put_nowait(_END)
+
+    async def _produce(self):
+        try:
+            await self._loop(0, ())
+        except Exception as error:
+            await self.queue.put(_Failure(error))
+        else:
+            await self.queue.put(_END)
+
+    async def _loop(self, index, values):
+        import asyncio
+        from inspect import isawaitable
+        if index == len(self.generators):
+            result = self.elt(*values)
+            if isawaitable(result):
+                await self.slots.acquire()
+                result = asyncio.ensure_future(result)
+                result.add_done_callback(lambda _: self.slots.release())
+            await self.queue.put(result)
+        else:
+            iter, bind, ifs = self.generators[index]
+            collection = iter(*values)
+            if hasattr(collection, '__aiter__'):
+                async for item in collection:
+                    await self._step(index, values + bind(item), ifs)
+            else:
+                for item in collection:
+                    await self._step(index, values + bind(item), ifs)
+
+    async def _step(self, index, values, ifs):
+        from inspect import isawaitable
+        for test in ifs:
+            result = test(*values)
+            if isawaitable(result):
+                result = await result
+            if not result:
+                return
+        await self._loop(index + 1, values)
+
+
+class _Failure:
+    # An error raised while running an asynchronous query.
+    def __init__(self, error):
+        self.error = error
+
+
+# The end of the results of an asynchronous query.
+_END = object()
+
+
+class _AsyncSlice:
+    # The slice of the results of an asynchronous query.
+    def __init__(self, results, partition):
+        self.results = results
+        self.start = partition.start or 0
+        self.stop = partition.stop
+        self.step = partition.step or 1
+        self.index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            index = self.index
+            if self.stop is not None and index >= self.stop:
+                await self.results.aclose()
+                raise StopAsyncIteration
+            result = await self.results.__anext__()
+            self.index += 1
+            if index >= self.start and not (index - self.start) % self.step:
+                return result
+
+    async def aclose(self):
+        await self.results.aclose()
+
+
+def _build_generator(qst, name, iter):
+    '''Build the module that defines the generator function `name`.
+
+    The generator function executes the query `qst`: there's a loop for each
+    generator and a nested ``if`` for each condition.  The iterable of each
+    loop is wrapped in a call to the function `iter`.
+
+    '''
+    import ast
+    from copy import deepcopy
+    from xotl.ql.revenge import qst as _qst
+
+    query = qst.body if isinstance(qst, _qst.Expression) else qst
+    if not isinstance(query, _qst.GeneratorExp):
+        raise TranslationError(
+            'Only generator expressions can be translated to a generator plan'
+        )
+    query = deepcopy(query)
+    # Parse a stub so that the signature of the function is valid for the
+    # running Python.
+    module = ast.parse('def %s():\n    pass' % name)
+    body = module.body[0].body = []
+    for comp in query.generators:
+        loop = ast.For(
+            target=comp.target,
+            iter=ast.Call(ast.Name(iter, ast.Load()), [comp.iter], []),
+            body=[],
+            orelse=[]
+        )
+        body.append(loop)
+        body = loop.body
+        for cond in comp.ifs:
+            test = ast.If(test=cond, body=[], orelse=[])
+            body.append(test)
+            body = test.body
+    body.append(ast.Expr(ast.Yield(query.elt)))
+    return ast.fix_missing_locations(module)
+
+
+def _get_function_code(code, name):
+    '''Get the code object of the function `name` defined by `code`.'''
+    from types import CodeType
+    return next(
+        const
+        for const in code.co_consts
+        if isinstance(const, CodeType) and const.co_name == name
+    )
+
+
+def _get_function_source(module):
+    '''Get the (approximate) source of the generator function in `module`.'''
+    import ast
+    function = module.body[0]
+    lines = ['def %s():' % function.name]
+    body, depth = function.body, 1
+    while body:
+        stmt, = body
+        indent = '    ' * depth
+        if isinstance(stmt, ast.For):
+            lines.append('%sfor %s in %s:' % (indent, get_source(stmt.target),
+                                              get_source(stmt.iter)))
+        elif isinstance(stmt, ast.If):
+            lines.append('%sif %s:' % (indent, get_source(stmt.test)))
+        else:
+            lines.append('%syield %s' % (indent,
+                                         get_source(stmt.value.value)))
+        body, depth = getattr(stmt, 'body', None), depth + 1
+    return '\n'.join(lines)
+
+
+def _split_aggregate(query):
+    '''Split an aggregate query in the aggregate and the QST of the query.
+
+    Aggregate queries are those like ``sum(x.age for x in this)`` (see
+    `xotl.ql.translation.aggregates`:mod:).  For other queries, the aggregate
+    is None.
+
+    Dictionary comprehensions are aggregates too: ``{k: v for ...}`` becomes
+    the query ``((k, v) for ...)`` where the last value of each key is kept.
+    The third item of the result tells if the query produces pairs of keys
+    and values.
+
+    '''
+    import ast
+    from xotl.ql.revenge import qst as _qst
+    tree = query.qst
+    node = tree.body if isinstance(tree, ast.Expression) else tree
+    if (isinstance(node, ast.Call) and len(node.args) == 1 and
+            not node.keywords and
+            isinstance(node.args[0], ast.GeneratorExp)):
+        aggregate = get_aggregate(_get_function(query, node.func))
+        if aggregate is not None:
+            body = deepcopy(node.args[0])
+            return (aggregate,
+                    _qst.ensure_compilable(_qst.Expression(body)),
+                    False)
+    elif isinstance(node, ast.DictComp):
+        node = deepcopy(node)
+        body = _qst.GeneratorExp(
+            _qst.Tuple([node.key, node.value], _qst.Load()),
+            node.generators
+        )
+        return last, _qst.ensure_compilable(_qst.Expression(body)), True
+    return None, tree, False
+
+
+def _get_function(query, node):
+    # The value of the function `node` (a name or an attribute of a name) in
+    # the query; None if it can't be found.
+    import ast
+    import builtins
+    if isinstance(node, ast.Name):
+        try:
+            return query.get_value(node.id)
+        except NameError:
+            return getattr(builtins, node.id, None)
+    elif isinstance(node, ast.Attribute):
+        return getattr(_get_function(query, node.value), node.attr, None)
+    else:
+        return None
+
+
+def _with_targets(tree):
+    '''Make the query produce pairs of the values of its targets and items.
+
+    The query ``(x.age for x in this for y in x.children)`` becomes
+    ``(((x, y), x.age) for x in this for y in x.children)``.
+
+    '''
+    from xotl.ql.revenge import qst as _qst
+    tree = deepcopy(tree)
+    node = tree.body
+    targets = [_as_load(deepcopy(comp.target)) for comp in node.generators]
+    node.elt = _qst.Tuple(
+        [_qst.Tuple(targets, _qst.Load()), node.elt],
+        _qst.Load()
+    )
+    return _qst.ensure_compilable(tree)
+
+
+def _as_load(target):
+    import ast
+    from xotl.ql.revenge import qst as _qst
+    for node in ast.walk(target):
+        if isinstance(node, (ast.Name, ast.Tuple, ast.List, ast.Starred)):
+            node.ctx = _qst.Load()
+    return target
+
+
+def _partition(result, partition, ordering, max_sorted=None):
+    '''Apply the `ordering` and the `partition` of a query to its `result`.
+
+    Without `ordering` the slice is taken lazily: the query stops as soon as
+    the slice is complete.  With both, and a non-negative slice, only the
+    first `partition.stop` items are kept in a heap instead of sorting the
+    whole result.  Otherwise, the result is sorted keeping at most
+    `max_sorted` items in memory (see
+    `xotl.ql.translation.sorting.ExternalSort`:class:).
+
+    '''
+    if ordering is not None:
+        key, reverse = ordering
+        if _is_top(partition):
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            result = _lazy(select, partition.stop, result, key=key)
+        else:
+            result = ExternalSort(key, reverse, max_sorted)(result)
+    if partition is None:
+        return result
+    elif _is_negative(partition):
+        return _lazy(lambda items: list(items)[partition], result)
+    else:
+        return islice(result, partition.start, partition.stop,
+                      partition.step)
+
+
+def _by_group_key(key):
+    # The key function of the pairs of keys and values of groups, for the
+    # `key` of the ordering of the query.
+    if key is None:
+        return lambda pair: pair[0]
+    else:
+        return lambda pair: key(pair[0])
+
+
+def _is_top(partition):
+    # True if the partition is the top-k of the ordered results.
+    return (partition is not None and partition.stop is not None and
+            not _is_negative(partition))
+
+
+def _is_negative(partition):
+    return any(index is not None and index < 0
+               for index in (partition.start, partition.stop, partition.step))
+
+
+def _lazy(function, *args, **kwargs):
+    # Iterate over the result of `function` which is called only when the
+    # first item is needed.
+    yield from function(*args, **kwargs)
+
+
+def _identity(what):
+    return what
+
+
+# The operators of the `NaivePythonExecutionPlan` in worker processes.
+def _map(f):
+    return lambda l: iter(f(x) for x in l)
+
+
+def _join(lls):
+    return iter(x for l in lls for x in l)
+
+
+def _unit(x):
+    return iter([x])
+
+
+def _zero():
+    return iter([])
+
+
+class _HashJoin:
+    # The operator of the hash joins (see
+    # `xotl.ql.translation.optimizations.hash_joins`).  There's an instance
+    # per execution of the plan, so the collections are indexed once per
+    # execution.
+    def __init__(self, do_plan):
+        self.do_plan = do_plan
+        self.indexes = {}
+
+    def __call__(self, site, collection, key, value):
+        index = self.indexes.get(site)
+        if index is None:
+            index = self.indexes[site] = _HashIndex(
+                self.do_plan(collection()),
+                key
+            )
+        return index.get(value)
+
+
+class _HashIndex:
+    # A dictionary from keys to the items with that key.  If the keys are not
+    # hashable we keep the pairs and look up by equality.
+    def __init__(self, items, key):
+        pairs = [(key(item), item) for item in items]
+        try:
+            index = {}
+            for k, item in pairs:
+                index.setdefault(k, []).append(item)
+        except TypeError:
+            self.index, self.pairs = None, pairs
+        else:
+            self.index, self.pairs = index, None
+
+    def get(self, value):
+        index = self.index
+        if index is not None:
+            try:
+                return index.get(value, ())
+            except TypeError:
+                # An unhashable value may still be equal to some key.
+                pairs = ((k, item) for k, items in index.items()
+                         for item in items)
+        else:
+            pairs = self.pairs
+        return [item for k, item in pairs if k == value]
+
 
 class _TestPlan(NaivePythonExecutionPlan):
     # A plan that fixes
@@ -184,6 +1208,7 @@ class PythonObjectsCollection:
         else:
             res = _iter_objects(use_ignores=self.use_ignores)
         if self.ascons:
+            from .monads import LazyCons, Empty
             try:
                 head = next(res)
             except StopIteration:
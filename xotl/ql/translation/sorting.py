@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Sorting of the results of queries within a memory budget.
+
+'''
+
+import heapq
+import pickle
+import tempfile
+from itertools import islice
+
+from .aggregates import _load
+
+
+class ExternalSort:
+    '''Sort the items of an iterable like `sorted`:func:.
+
+    Calling the instance with an iterable returns an iterator over its items
+    sorted by `key` (in `reverse` order if True).  The sort is stable.
+
+    If `max_items` is None all the items are sorted in memory.  Otherwise,
+    the items are read in chunks of `max_items`; each chunk is sorted and
+    spilled to a temporary file (in `dir`) as a sorted run, and the runs are
+    merged.  At most `fanin` runs are merged at once: if there are more runs
+    they're merged in several passes.  So at most `max_items` items are kept
+    in memory while reading, and one item per run while merging.
+
+    Items must be picklable to be spilled.
+
+    '''
+    def __init__(self, key=None, reverse=False, max_items=None, fanin=64,
+                 dir=None):
+        if max_items is not None and max_items < 1:
+            raise ValueError('max_items must be positive')
+        if fanin < 2:
+            raise ValueError('fanin must be at least 2')
+        self.key = key
+        self.reverse = reverse
+        self.max_items = max_items
+        self.fanin = fanin
+        self.dir = dir
+
+    def __call__(self, iterable):
+        key, reverse = self.key, self.reverse
+        if self.max_items is None:
+            yield from sorted(iterable, key=key, reverse=reverse)
+            return
+        iterator = iter(iterable)
+        runs = []
+        try:
+            while True:
+                chunk = list(islice(iterator, self.max_items))
+                last = len(chunk) < self.max_items
+                chunk.sort(key=key, reverse=reverse)
+                if last and not runs:
+                    # Everything fits in memory
+                    yield from chunk
+                    return
+                if chunk:
+                    runs.append(self._spill(chunk))
+                # Drop the chunk before reading the next one.
+                del chunk
+                if last:
+                    break
+            while len(runs) > self.fanin:
+                runs = [self._spill(self._merge(runs[i:i + self.fanin]))
+                        for i in range(0, len(runs), self.fanin)]
+            yield from self._merge(runs)
+        finally:
+            for run in runs:
+                run.close()
+
+    def _spill(self, items):
+        # Write the sorted `items` to a new run.
+        run = tempfile.TemporaryFile(dir=self.dir)
+        for item in items:
+            pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        return run
+
+    def _merge(self, runs):
+        # Merge the sorted `runs`; ties are taken from the earlier runs first
+        # so that the sort is stable.
+        try:
+            yield from heapq.merge(*(_load(run) for run in runs),
+                                   key=self.key, reverse=self.reverse)
+        finally:
+            for run in runs:
+                run.close()
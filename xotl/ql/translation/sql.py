@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''A translator of queries to SQL for SQLite.
+
+The collections of the generators of the query are mapped to tables (see
+`Table`:class:), and the query is translated to a single ``SELECT``
+statement so that the database does the filtering, joining, sorting and
+aggregation.
+
+The sub-expressions of the query that don't use the targets of the generators
+are evaluated in Python each time the plan is executed (in the frame of the
+query, shadowed by the query parameters), and their values are passed as
+parameters of the statement.
+
+'''
+
+import ast
+from copy import deepcopy
+from types import SimpleNamespace
+
+from xoutil.objects import memoized_property
+
+from xotl.ql.core import normalize_query, this, get_predicate_object
+from xotl.ql.tools import detect_names
+
+from . import TranslationError
+from .aggregates import count, avg
+from .optimizations import get_source
+
+
+class Table:
+    '''The mapping of a collection of objects to a table.
+
+    :param name: The name of the table.
+
+    :param columns: The names of the attributes of the objects; or a mapping
+                    from the names of the attributes to the names of the
+                    columns.
+
+    :param factory: A callable that builds the objects from the values of
+                    their attributes given as keyword arguments.  By default
+                    `types.SimpleNamespace`:class:.
+
+    '''
+    def __init__(self, name, columns, factory=SimpleNamespace):
+        self.name = name
+        if not isinstance(columns, dict):
+            columns = {attr: attr for attr in columns}
+        self.columns = columns
+        self.factory = factory
+
+    def load(self, values):
+        '''Build an object from the `values` of its columns.'''
+        return self.factory(**dict(zip(self.columns, values)))
+
+    def __iter__(self):
+        # Tables can be the collection of the first generator of a query
+        # expression, which Python iterates when the expression is created;
+        # but objects are only retrieved by the plans.  The iterator must be
+        # the table so that translators find it.
+        return self
+
+    def __next__(self):
+        raise StopIteration
+
+    def __repr__(self):
+        return '<Table %s>' % self.name
+
+
+class SQLTranslator:
+    '''A `query translator`:term: to SQL.
+
+    :param tables: A mapping from the values of the collections (e.g. the
+                   classes of the objects) to `tables <Table>`:class:.  A
+                   collection which is a `Table`:class: needs no mapping.
+
+    :param connection: The default connection (usually a
+                       `sqlite3.Connection`:class:) of the plans.
+
+    '''
+    def __init__(self, tables=None, connection=None):
+        self.tables = tables or {}
+        self.connection = connection
+
+    def __call__(self, query, **kwargs):
+        kwargs.setdefault('tables', self.tables)
+        kwargs.setdefault('connection', self.connection)
+        return SQLExecutionPlan(query, **kwargs)
+
+    def explain(self, query, **kwargs):
+        self(query, **kwargs).explain()
+
+
+class SQLExecutionPlan:
+    '''The execution plan of a query translated to SQL.
+
+    See `SQLTranslator`:class: for the arguments.
+
+    Supported queries are generator expressions whose generators range over
+    tables (or over |this| with a condition ``isinstance(target, Class)``
+    where `Class` is mapped to a table) and:
+
+    - conditions and projections using attributes of the targets, the
+      comparison, boolean and arithmetic operators, conditional expressions,
+      `len`:func: and `abs`:func:, and the methods ``lower()`` and
+      ``upper()``.  The right operand of ``in`` must not depend on the
+      targets;
+
+    - several generators, which are joined;
+
+    - the `~xotl.ql.core.PartionableQueryObject.partition`:attr: (without
+      negative indexes) and the `~xotl.ql.core.QueryObject.ordering`:attr:
+      of the query object, when the key is a lambda over the result;
+
+    - the aggregates `count`, `sum`:func:, `min`:func:, `max`:func:,
+      `avg`, `any`:func: and `all`:func:, optionally grouped by the
+      `~xotl.ql.core.QueryObject.groups`:attr: of the query object, when it
+      is a lambda.
+
+    Notice that the SQL semantics apply: for instance, ``+`` doesn't
+    concatenate strings and comparisons with NULL are never true.
+
+    '''
+    def __init__(self, query, tables=None, connection=None):
+        from .py import _split_aggregate
+        self.query = query = normalize_query(query)
+        self.tables = tables or {}
+        self.connection = connection
+        self.params = tuple(getattr(query, 'params', ()))
+        if 'connection' in self.params:
+            raise TranslationError('Query parameters cannot be named '
+                                   "'connection'")
+        self.aggregate, qst, keyed = _split_aggregate(query)
+        if keyed:
+            raise TranslationError('Dictionary comprehensions are not '
+                                   'supported by the SQL translator')
+        node = qst.body if isinstance(qst, ast.Expression) else qst
+        if not isinstance(node, ast.GeneratorExp):
+            raise TranslationError('Only generator expressions can be '
+                                   'translated to SQL')
+        self._aliases = {}
+        self._parameters = []
+        sources, conditions = self._translate_generators(node.generators)
+        self.groups = getattr(query, 'groups', None)
+        self.ordering = getattr(query, 'ordering', None)
+        self.partition = getattr(query, 'partition', None)
+        if self.aggregate is None:
+            if self.groups is not None:
+                raise TranslationError('Only aggregates can have groups in '
+                                       'the SQL translator')
+            columns, self._reader = self._translate_result(node.elt)
+        else:
+            if self.ordering is not None or self.partition is not None:
+                raise TranslationError('Aggregates cannot be ordered or '
+                                       'partitioned')
+            columns, self._reader = self._translate_aggregate(
+                node.elt,
+                [comp.target for comp in node.generators]
+            )
+        statement = ['SELECT ']
+        statement.extend(_join(', ', columns))
+        statement.append(' FROM ')
+        statement.append(', '.join(sources))
+        if conditions:
+            statement.append(' WHERE ')
+            statement.extend(_join(' AND ', conditions))
+        if self.groups is not None:
+            statement.append(' GROUP BY ')
+            statement.extend(_join(', ', self._group_by))
+        if self.ordering is not None:
+            statement.append(' ORDER BY ')
+            statement.extend(_join(', ', self._translate_ordering(node.elt)))
+        if self.partition is not None:
+            statement.extend(self._translate_partition(self.partition))
+        self.statement = statement
+
+    @property
+    def sql(self):
+        '''The SQL of the plan.
+
+        Parameters are shown as ``?`` (or ``(?, ...)`` for the values of the
+        right operand of ``in``).
+
+        '''
+        return ''.join(
+            fragment if isinstance(fragment, str) else fragment.placeholder
+            for fragment in self.statement
+        )
+
+    def explain(self):
+        '''Prints the SQL statement and the source of its parameters.'''
+        print('\nSQL')
+        print(self.sql)
+        if self._parameters:
+            print('\nParameters')
+            for index, parameter in enumerate(self._parameters, 1):
+                print('%d. %s' % (index, parameter))
+
+    def __call__(self, connection=None, **params):
+        '''Execute the plan.
+
+        :param connection: The connection to use instead of the default
+                           connection of the plan.
+
+        Any other keyword argument gives the value of a query parameter (see
+        `xotl.ql.core.QueryObject.params`:attr:).
+
+        Return an iterator over the results, which are fetched from the
+        database as they are consumed.  If the query is an aggregate return
+        its value instead; and if the query has groups return a dictionary
+        from the keys of the groups to the value of the aggregate.
+
+        '''
+        from xoutil.future.collections import ChainMap
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise TypeError(
+                'Unknown query parameters: %s' % ', '.join(sorted(unknown))
+            )
+        connection = connection or self.connection
+        if connection is None:
+            raise TypeError('No connection given to execute the plan')
+        namespace = dict(ChainMap(params, self.query.locals,
+                                  self.query.globals))
+        sql, values = [], []
+        for fragment in self.statement:
+            if isinstance(fragment, str):
+                sql.append(fragment)
+            else:
+                fragment.render(namespace, sql, values)
+        cursor = connection.execute(''.join(sql), values)
+        return self._reader(cursor)
+
+    def __iter__(self):
+        return self()
+
+    def _translate_generators(self, generators):
+        # Return the sources of the FROM clause and the conditions.
+        sources, conditions = [], []
+        for comp in generators:
+            if not isinstance(comp.target, ast.Name):
+                raise TranslationError('The targets of the generators must '
+                                       'be names in the SQL translator')
+            alias = comp.target.id
+            ifs = list(comp.ifs)
+            table = self._get_table(comp.iter, alias, ifs)
+            self._aliases[alias] = table
+            sources.append('%s AS %s' % (_quote(table.name), _quote(alias)))
+            conditions.extend(self._translate_condition(test) for test in ifs)
+        return sources, conditions
+
+    def _get_table(self, node, alias, ifs):
+        # Get the table of the collection `node`.  If the collection is
+        # `this`, the table is given by a condition `isinstance(alias, ...)`
+        # which is removed from `ifs`.
+        if detect_names(node) & set(self._aliases):
+            raise TranslationError('Generators cannot depend on previous '
+                                   'generators in the SQL translator: %s' %
+                                   get_source(node))
+        value = self._evaluate(node)
+        if value is this:
+            for test in ifs:
+                if _is_isinstance(test, alias):
+                    value = self._evaluate(test.args[1])
+                    ifs.remove(test)
+                    break
+            else:
+                raise TranslationError('Generators over `this` need a '
+                                       'condition isinstance(%s, ...)' %
+                                       alias)
+        if isinstance(value, Table):
+            return value
+        try:
+            return self.tables[value]
+        except (KeyError, TypeError):
+            raise TranslationError('No table for %s' % get_source(node))
+
+    def _evaluate(self, node):
+        # The value of an expression (without targets) in the query's frame.
+        code = compile(ast.fix_missing_locations(ast.Expression(node)),
+                       '', 'eval')
+        namespace = dict(self.query.globals)
+        namespace.update(self.query.locals)
+        try:
+            return eval(code, namespace)
+        except Exception:
+            raise TranslationError('Cannot evaluate %s' % get_source(node))
+
+    def _translate_result(self, elt):
+        # Return the columns of the projection, and the function that reads
+        # the results from a cursor.
+        columns, read = self._translate_projection(elt)
+
+        def reader(cursor):
+            for row in cursor:
+                yield read(row, 0)[0]
+
+        return columns, reader
+
+    def _translate_projection(self, node):
+        # Return the columns of the projection `node` and a function that
+        # reads the value from a row starting at an index; it returns the
+        # value and the next index.
+        if isinstance(node, ast.Name) and node.id in self._aliases:
+            table = self._aliases[node.id]
+            columns = [['%s.%s' % (_quote(node.id), _quote(column))]
+                       for column in table.columns.values()]
+            size = len(columns)
+
+            def read(row, index):
+                return table.load(row[index:index + size]), index + size
+
+            return columns, read
+        elif isinstance(node, ast.Tuple):
+            columns, reads = [], []
+            for elt in node.elts:
+                cols, read = self._translate_projection(elt)
+                columns.extend(cols)
+                reads.append(read)
+
+            def read(row, index):
+                result = []
+                for read in reads:
+                    value, index = read(row, index)
+                    result.append(value)
+                return tuple(result), index
+
+            return columns, read
+        else:
+            return [self._translate(node)], _read_column
+
+    def _translate_aggregate(self, elt, targets):
+        # Return the columns of an aggregate, and the function that reads
+        # its result (or the groups) from a cursor.
+        aggregate = self.aggregate
+        if aggregate is count:
+            column = ['COUNT(*)']
+        elif aggregate.name in ('sum', 'min', 'max') or aggregate is avg:
+            function = 'AVG' if aggregate is avg else aggregate.name.upper()
+            column = ['%s(' % function] + self._translate(elt) + [')']
+        elif aggregate.name in ('any', 'all'):
+            column = (
+                ['%s(CASE WHEN ' % ('MAX' if aggregate.name == 'any'
+                                    else 'MIN')] +
+                self._translate(elt) +
+                [' THEN 1 ELSE 0 END)']
+            )
+        else:
+            raise TranslationError('The aggregate %s is not supported by '
+                                   'the SQL translator' % aggregate.name)
+        empty = aggregate.result(aggregate.start()) \
+            if aggregate.name not in ('min', 'max', 'avg') else None
+        convert = bool if aggregate.name in ('any', 'all') else None
+
+        def value(result):
+            if result is None:
+                if empty is None:
+                    raise ValueError('%s() arg is an empty sequence' %
+                                     aggregate.name)
+                return empty
+            return convert(result) if convert else result
+
+        if self.groups is None:
+            def reader(cursor):
+                row, = cursor
+                return value(row[0])
+
+            return [column], reader
+        else:
+            keys, read_key = self._translate_groups(self.groups, targets)
+            self._group_by = keys
+
+            def reader(cursor):
+                result = {}
+                for row in cursor:
+                    key, index = read_key(row, 0)
+                    result[key] = value(row[index])
+                return result
+
+            return keys + [column], reader
+
+    def _translate_groups(self, groups, targets):
+        # Translate the key of the groups given by a lambda over the targets.
+        args, body = _get_lambda(groups)
+        if len(args) != len(targets):
+            raise TranslationError('The groups must take an argument per '
+                                   'generator')
+        key = _rename(body, dict(zip(args, (t.id for t in targets))))
+        if isinstance(key, ast.Tuple):
+            keys = [self._translate(elt) for elt in key.elts]
+
+            def read(row, index):
+                end = index + len(keys)
+                return tuple(row[index:end]), end
+
+        else:
+            keys = [self._translate(key)]
+            read = _read_column
+        return keys, read
+
+    def _translate_ordering(self, elt):
+        key, reverse = self.ordering
+        if key is None:
+            keys = [column for column in self._translate_projection(elt)[0]]
+        else:
+            (arg, ), body = _get_lambda(key)
+            body = _Substitute(arg, elt).visit(deepcopy(body))
+            if isinstance(body, ast.Tuple):
+                keys = [self._translate(node) for node in body.elts]
+            else:
+                keys = [self._translate(body)]
+        return [key + [' DESC' if reverse else ' ASC'] for key in keys]
+
+    def _translate_partition(self, partition):
+        start, stop, step = partition.start, partition.stop, partition.step
+        if step not in (None, 1) or any(
+                index is not None and index < 0 for index in (start, stop)):
+            raise TranslationError('Only slices with non-negative indexes '
+                                   'and no step are supported')
+        start = start or 0
+        limit = -1 if stop is None else max(stop - start, 0)
+        return [' LIMIT %d OFFSET %d' % (limit, start)]
+
+    def _translate_condition(self, node):
+        if not detect_names(node) & set(self._aliases):
+            return [self._parameter(node, convert=bool)]
+        return self._translate(node)
+
+    def _translate(self, node):
+        # Translate the expression `node` to a list of fragments of SQL.
+        if not detect_names(node) & set(self._aliases):
+            return [self._parameter(node)]
+        method = getattr(self, '_translate_%s' % type(node).__name__, None)
+        if method is None:
+            raise TranslationError('Unsupported expression in SQL: %s' %
+                                   get_source(node))
+        return method(node)
+
+    def _parameter(self, node, **kwargs):
+        parameter = _Parameter(node, **kwargs)
+        self._parameters.append(parameter)
+        return parameter
+
+    def _translate_Name(self, node):
+        raise TranslationError('Objects cannot be used as values in SQL: '
+                               '%s' % node.id)
+
+    def _translate_Attribute(self, node):
+        value = node.value
+        if isinstance(value, ast.Name) and value.id in self._aliases:
+            table = self._aliases[value.id]
+            try:
+                column = table.columns[node.attr]
+            except KeyError:
+                raise TranslationError('%s has no attribute %r' % (
+                    table, node.attr))
+            return ['%s.%s' % (_quote(value.id), _quote(column))]
+        else:
+            raise TranslationError('Unsupported expression in SQL: %s' %
+                                   get_source(node))
+
+    def _translate_Compare(self, node):
+        result, left = [], node.left
+        for op, right in zip(node.ops, node.comparators):
+            if result:
+                result.append(' AND ')
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if detect_names(right) & set(self._aliases):
+                    raise TranslationError('The right operand of in must not '
+                                           'depend on the targets: %s' %
+                                           get_source(node))
+                result.extend(self._translate(left))
+                result.append(' NOT IN ' if isinstance(op, ast.NotIn)
+                              else ' IN ')
+                result.append(self._parameter(right, expand=True))
+            else:
+                result.extend(self._translate(left))
+                result.append(' %s ' % _COMPARISONS[type(op).__name__])
+                result.extend(self._translate(right))
+            left = right
+        return ['('] + result + [')']
+
+    def _translate_BoolOp(self, node):
+        operator = ' AND ' if isinstance(node.op, ast.And) else ' OR '
+        parts = [self._translate_condition(value) for value in node.values]
+        return ['('] + _join(operator, parts) + [')']
+
+    def _translate_UnaryOp(self, node):
+        operator = _UNARY.get(type(node.op).__name__)
+        if operator is None:
+            raise TranslationError('Unsupported operator in SQL: %s' %
+                                   get_source(node))
+        if operator == 'NOT ':
+            operand = self._translate_condition(node.operand)
+        else:
+            operand = self._translate(node.operand)
+        return ['(', operator] + operand + [')']
+
+    def _translate_BinOp(self, node):
+        left, right = self._translate(node.left), self._translate(node.right)
+        if isinstance(node.op, ast.Div):
+            return ['(CAST('] + left + [' AS REAL) / '] + right + [')']
+        operator = _BINARY.get(type(node.op).__name__)
+        if operator is None:
+            raise TranslationError('Unsupported operator in SQL: %s' %
+                                   get_source(node))
+        return ['('] + left + [' %s ' % operator] + right + [')']
+
+    def _translate_IfExp(self, node):
+        return (['(CASE WHEN '] + self._translate_condition(node.test) +
+                [' THEN '] + self._translate(node.body) + [' ELSE '] +
+                self._translate(node.orelse) + [' END)'])
+
+    def _translate_Call(self, node):
+        if node.keywords or any(isinstance(arg, ast.Starred)
+                                for arg in node.args):
+            raise TranslationError('Unsupported call in SQL: %s' %
+                                   get_source(node))
+        func = node.func
+        if isinstance(func, ast.Attribute) and not node.args and \
+                func.attr in ('lower', 'upper'):
+            return ['%s(' % func.attr.upper()] + \
+                self._translate(func.value) + [')']
+        elif isinstance(func, ast.Name) and len(node.args) == 1 and \
+                func.id in _FUNCTIONS and \
+                not detect_names(func) & set(self._aliases):
+            function = _FUNCTIONS[func.id]
+            if self._evaluate(func) is function[0]:
+                return ['%s(' % function[1]] + \
+                    self._translate(node.args[0]) + [')']
+        raise TranslationError('Unsupported call in SQL: %s' %
+                               get_source(node))
+
+
+class _Parameter:
+    # A parameter of the SQL statement: the value of an expression evaluated
+    # in Python.  If `expand` the value is a collection whose items are the
+    # parameters.
+    def __init__(self, node, convert=None, expand=False):
+        self.node = node
+        self.convert = convert
+        self.expand = expand
+        self.placeholder = '(?, ...)' if expand else '?'
+
+    @memoized_property
+    def code(self):
+        expression = ast.fix_missing_locations(ast.Expression(self.node))
+        return compile(expression, '', 'eval')
+
+    def render(self, namespace, sql, values):
+        value = eval(self.code, namespace)
+        if self.expand:
+            value = list(value)
+            sql.append('(%s)' % ', '.join('?' * len(value)))
+            values.extend(value)
+        else:
+            sql.append('?')
+            values.append(self.convert(value) if self.convert else value)
+
+    def __str__(self):
+        return get_source(self.node)
+
+
+# The operators by the name of their node (the nodes of the QST are not the
+# classes of the `ast` module).
+_COMPARISONS = {
+    'Eq': '=',
+    'NotEq': '<>',
+    'Lt': '<',
+    'LtE': '<=',
+    'Gt': '>',
+    'GtE': '>=',
+    'Is': 'IS',
+    'IsNot': 'IS NOT',
+}
+
+_UNARY = {
+    'Not': 'NOT ',
+    'USub': '-',
+    'UAdd': '+',
+}
+
+_BINARY = {
+    'Add': '+',
+    'Sub': '-',
+    'Mult': '*',
+    'Mod': '%',
+}
+
+_FUNCTIONS = {
+    'len': (len, 'LENGTH'),
+    'abs': (abs, 'ABS'),
+}
+
+
+class _Substitute(ast.NodeTransformer):
+    # Replace the name `name` with the expression `node`.  A subscript of a
+    # tuple with a constant index is replaced by the item.
+    def __init__(self, name, node):
+        self.name = name
+        self.node = node
+
+    def visit_Name(self, node):
+        return deepcopy(self.node) if node.id == self.name else node
+
+    def visit_Subscript(self, node):
+        node = self.generic_visit(node)
+        index = getattr(node.slice, 'value', None)
+        if isinstance(node.value, ast.Tuple) and isinstance(index, ast.Num):
+            return node.value.elts[index.n]
+        return node
+
+
+def _rename(node, names):
+    # Rename the names in `node` following the mapping `names`.
+    node = deepcopy(node)
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and child.id in names:
+            child.id = names[child.id]
+    return node
+
+
+def _get_lambda(function):
+    # Return the names of the arguments of a lambda and the QST of its body.
+    import builtins
+    import inspect
+    try:
+        parameters = inspect.signature(function).parameters
+        body = get_predicate_object(function).qst
+    except Exception:
+        raise TranslationError('Cannot translate the function %r' % function)
+    args = list(parameters)
+    if any(param.kind not in (param.POSITIONAL_ONLY,
+                              param.POSITIONAL_OR_KEYWORD)
+           for param in parameters.values()):
+        raise TranslationError('The function %r must take only positional '
+                               'arguments' % function)
+    if detect_names(body) - set(args) - set(dir(builtins)):
+        raise TranslationError('The function %r cannot use free names' %
+                               function)
+    return args, body.body if isinstance(body, ast.Expression) else body
+
+
+def _is_isinstance(node, alias):
+    # True if `node` is ``isinstance(alias, ...)``.
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id == 'isinstance' and len(node.args) == 2 and
+            not node.keywords and isinstance(node.args[0], ast.Name) and
+            node.args[0].id == alias)
+
+
+def _read_column(row, index):
+    return row[index], index + 1
+
+
+def _join(separator, parts):
+    # Join the lists of fragments `parts` with the `separator`.
+    result = []
+    for part in parts:
+        if result:
+            result.append(separator)
+        result.extend(part)
+    return result
+
+
+def _quote(identifier):
+    return '"%s"' % identifier.replace('"', '""')
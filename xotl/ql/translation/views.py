@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+
+'''Materialized views of queries.
+
+A `MaterializedView`:class: keeps the results of a query over
+`observable collections <ObservableCollection>`:class: up to date: when an
+object is added to (or removed from) a collection, only the results that
+involve that object are computed (or removed).  So the cost of an update is
+proportional to the change, not to the whole collection::
+
+    people = ObservableCollection(...)
+    view = MaterializedView(get_predicate_object(
+        lambda: (p.name for p in people if p.age > 30)
+    ))
+    people.add(someone)
+    list(view)   # includes someone.name if someone.age > 30
+
+The views support query expressions with filters, projections and several
+generators (joins), and the aggregates `count` and `sum`:func: of those.
+Collections that are not observable are read only once, when the view is
+created; and the collections of generators which depend on other generators
+(like ``c`` in ``for p in people for c in p.children``) are not watched.
+The views cannot be built over `~xotl.ql.core.this`:obj: or a
+`~xotl.ql.translation.py.PythonObjectsCollection`:class:.
+
+'''
+
+import ast
+from collections import OrderedDict
+from copy import deepcopy
+
+from xoutil.future.collections import ChainMap
+
+from xotl.ql.core import Universe, normalize_query
+from xotl.ql.tools import detect_names
+
+from . import TranslationError
+from .aggregates import count
+from .batches import _comprehension
+from .optimizations import (
+    push_down_conditions,
+    _find_join,
+    _get_targets,
+    _lambda,
+)
+
+
+class ObservableCollection:
+    '''A collection that notifies the changes of its items.
+
+    The collection is a set of objects by identity: an object is in the
+    collection at most once, even if it's equal to another object in the
+    collection.  Objects are iterated in the order they were added.
+
+    '''
+    def __init__(self, items=()):
+        self._items = OrderedDict()
+        self._subscribers = []
+        self.update(items)
+
+    def subscribe(self, callback):
+        '''Call ``callback(collection, item, added)`` after each change.
+
+        `added` is True if the `item` was added to the `collection`, and
+        False if it was removed.
+
+        '''
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def add(self, item):
+        '''Add the `item` to the collection if it's not already in it.'''
+        if id(item) not in self._items:
+            self._items[id(item)] = item
+            self._notify(item, True)
+
+    def update(self, items):
+        '''Add all the `items` to the collection.'''
+        for item in items:
+            self.add(item)
+
+    def remove(self, item):
+        '''Remove the `item`; raise KeyError if it's not in the collection.'''
+        del self._items[id(item)]
+        self._notify(item, False)
+
+    def discard(self, item):
+        '''Remove the `item` if it's in the collection.'''
+        if id(item) in self._items:
+            self.remove(item)
+
+    def _notify(self, item, added):
+        for callback in list(self._subscribers):
+            callback(self, item, added)
+
+    def __contains__(self, item):
+        return id(item) in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return _ObservedIterator(self, iter(list(self._items.values())))
+
+    def __repr__(self):
+        return '<ObservableCollection of %d items>' % len(self)
+
+
+class _ObservedIterator:
+    # The iterator of an ObservableCollection.  A generator expression takes
+    # the iterator of its first collection, so the views need to know the
+    # collection of the iterator.
+    __slots__ = ('collection', 'iterator')
+
+    def __init__(self, collection, iterator):
+        self.collection = collection
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+
+class MaterializedView:
+    '''The results of a `query` kept up to date incrementally.
+
+    Iterating over the view gives its current results.  The order of the
+    results is the order they were computed in: results of later additions
+    come after, even if they would come before in the query.
+
+    If the query is an aggregate (`count` or `sum`:func:), its current value
+    is in the attribute `value`.
+
+    When an object is added to a collection, the results for it are computed
+    with the other generators over the current collections.  The equality
+    conditions joining a collection to the previous generators (like
+    ``p.city == c.id``) use a hash index of the collection which is also
+    kept up to date; so that joins don't read the whole collection either.
+
+    The objects must not change while they are in the collections (remove
+    them and add them again instead).  The view watches the observable
+    collections of the query until it's closed (see `close`:meth:).
+
+    '''
+    def __init__(self, query):
+        from .py import _split_aggregate
+        self.query = query = normalize_query(query)
+        aggregate, qst, keyed = _split_aggregate(query)
+        if keyed or getattr(query, 'groups', None) is not None or \
+                getattr(query, 'partition', None) is not None or \
+                getattr(query, 'ordering', None) is not None:
+            raise TranslationError('Views cannot have groups, partitions or '
+                                   'orderings')
+        if aggregate is not None and aggregate.name not in ('count', 'sum'):
+            raise TranslationError('The aggregate %s is not supported by the '
+                                   'views' % aggregate.name)
+        node = qst.body if isinstance(qst, ast.Expression) else qst
+        if not isinstance(node, ast.GeneratorExp):
+            raise TranslationError('Views need a query expression')
+        self.aggregate = aggregate
+        self.namespace = namespace = dict(ChainMap(query.locals,
+                                                   query.globals))
+        self.sources = sources = self._get_sources(node, namespace)
+        if not sources:
+            raise TranslationError('The query has no observable collections')
+        self.indexes = []
+        self._deltas = {
+            position: self._compile_delta(node, position)
+            for position in sources
+        }
+        self._rows = OrderedDict()
+        self._keys = {}
+        self.value = 0 if aggregate is not None else None
+        self._add_rows(self._compile_delta(node, None))
+        self.closed = False
+        for collection in set(sources.values()):
+            collection.subscribe(self._changed)
+
+    def _get_sources(self, node, namespace):
+        # Find the observable collections of the generators and bind them to
+        # the names ``__x_collection_<position>``.  The other collections
+        # which don't depend on the previous generators are read here; but
+        # not the whole universe of objects.
+        from .py import PythonObjectsCollection
+        sources = {}
+        targets = set()
+        for position, comp in enumerate(node.generators):
+            if not targets & detect_names(comp.iter):
+                code = compile(ast.fix_missing_locations(
+                    ast.Expression(deepcopy(comp.iter))), '', 'eval')
+                value = eval(code, namespace)
+                if isinstance(value, _ObservedIterator):
+                    value = value.collection
+                if isinstance(value, (Universe, PythonObjectsCollection)):
+                    raise TranslationError('Views cannot watch %r' % value)
+                elif isinstance(value, ObservableCollection):
+                    sources[position] = value
+                else:
+                    value = list(value)
+                namespace['__x_collection_%d' % position] = value
+            targets |= _get_targets(comp.target)
+        return sources
+
+    def _compile_delta(self, node, position):
+        # Compile the query so that it produces pairs of the ids of the items
+        # of the observable collections and the result.
+        #
+        # If `position` is not None, the generator at `position` is moved
+        # first and iterates over the item added (``__x_added``); and the
+        # previous generators over the same collection skip that item, so
+        # that each result is computed once.  The conditions are moved to
+        # the earliest generator that binds their names, and the equality
+        # joins use hash indexes.
+        node = deepcopy(node)
+        sources = self.sources
+        generators, tests, keys, first = [], [], [], []
+        for index, comp in enumerate(node.generators):
+            bound = set().union(*(_get_targets(comp.target)
+                                  for comp in generators))
+            if index in sources or not detect_names(comp.iter) & bound:
+                comp.iter = ast.Name('__x_collection_%d' % index, ast.Load())
+            comps = [comp]
+            if index in sources:
+                if isinstance(comp.target, ast.Name):
+                    item = comp.target.id
+                else:
+                    # Unpack the item in another loop.
+                    item = '__x_item_%d' % index
+                    comps.insert(0, _comprehension(
+                        ast.Name(item, ast.Store()), comp.iter, []
+                    ))
+                    comp.iter = ast.Tuple([ast.Name(item, ast.Load())],
+                                          ast.Load())
+                keys.append(_parse('id(%s)' % item))
+                if position is not None and index < position and \
+                        sources[index] is sources[position]:
+                    tests.append(_parse('%s is not __x_added[0]' % item))
+            if index == position:
+                comps[0].iter = ast.Name('__x_added', ast.Load())
+                first = comps
+            tests.extend(comp.ifs)
+            comp.ifs = []
+            generators.extend(comps)
+        generators = first + [comp for comp in generators
+                              if comp not in first]
+        generators[-1].ifs = tests
+        node.generators = generators
+        node.elt = ast.Tuple([ast.Tuple(keys, ast.Load()), node.elt],
+                             ast.Load())
+        node, _ = push_down_conditions(node)
+        if position is not None:
+            self._use_indexes(node)
+        expression = ast.fix_missing_locations(ast.Expression(node))
+        return compile(expression, '', 'eval')
+
+    def _use_indexes(self, node):
+        # Replace the loops over observable collections joined by equality
+        # to the previous generators with lookups in hash indexes.
+        bound = set()
+        for comp in node.generators:
+            iter = comp.iter
+            if bound and isinstance(iter, ast.Name) and \
+                    iter.id.startswith('__x_collection_'):
+                join = _find_join(comp, bound)
+                if join is not None:
+                    test, key, value = join
+                    comp.ifs.remove(test)
+                    index = _Index(
+                        self.sources[int(iter.id.rsplit('_', 1)[1])],
+                        eval(compile(ast.fix_missing_locations(
+                            ast.Expression(_lambda([comp.target.id], key))
+                        ), '', 'eval'), self.namespace)
+                    )
+                    name = '__x_index_%d' % len(self.indexes)
+                    self.indexes.append(index)
+                    self.namespace[name] = index
+                    comp.iter = ast.Call(
+                        ast.Attribute(ast.Name(name, ast.Load()), 'get',
+                                      ast.Load()),
+                        [value],
+                        []
+                    )
+            bound |= _get_targets(comp.target)
+
+    def _changed(self, collection, item, added):
+        for index in self.indexes:
+            if index.collection is collection:
+                if added:
+                    index.add(item)
+                else:
+                    index.remove(item)
+        if added:
+            self.namespace['__x_added'] = (item, )
+            for position, source in self.sources.items():
+                if source is collection:
+                    self._add_rows(self._deltas[position])
+        else:
+            keys = self._keys.pop((id(collection), id(item)), ())
+            for key in keys:
+                results = self._rows.pop(key, None)
+                if results is not None:
+                    self._update_value(results, -1)
+
+    def _add_rows(self, code):
+        # Run the `code` and add the results to the rows.
+        positions = list(self.sources)
+        for key, result in eval(code, self.namespace):
+            results = self._rows.get(key)
+            if results is None:
+                results = self._rows[key] = []
+                for position, item_id in zip(positions, key):
+                    self._keys.setdefault(
+                        (id(self.sources[position]), item_id), set()
+                    ).add(key)
+            results.append(result)
+            self._update_value([result], 1)
+
+    def _update_value(self, results, sign):
+        if self.aggregate is count:
+            self.value += sign * len(results)
+        elif self.aggregate is not None:
+            for result in results:
+                if sign > 0:
+                    self.value += result
+                else:
+                    self.value -= result
+
+    def close(self):
+        '''Stop watching the collections of the query.'''
+        if not self.closed:
+            for collection in set(self.sources.values()):
+                collection.unsubscribe(self._changed)
+            self.closed = True
+
+    def __iter__(self):
+        for results in list(self._rows.values()):
+            yield from results
+
+    def __len__(self):
+        return sum(len(results) for results in self._rows.values())
+
+
+class _Index:
+    # A hash index of the items of an observable `collection` by `key`,
+    # which is kept up to date by the view.  Keys that are not hashable (or
+    # that fail) are looked up by equality.
+    def __init__(self, collection, key):
+        self.collection = collection
+        self.key = key
+        self.keys = {}
+        self.index = {}
+        self.others = OrderedDict()
+        for item in collection:
+            self.add(item)
+
+    def add(self, item):
+        try:
+            key = self.key(item)
+            self.index.setdefault(key, OrderedDict())[id(item)] = item
+        except Exception:
+            self.others[id(item)] = item
+        else:
+            self.keys[id(item)] = key
+
+    def remove(self, item):
+        if id(item) in self.others:
+            del self.others[id(item)]
+        else:
+            key = self.keys.pop(id(item))
+            items = self.index[key]
+            del items[id(item)]
+            if not items:
+                del self.index[key]
+
+    def get(self, value):
+        try:
+            items = self.index.get(value)
+        except TypeError:
+            result = [item for items in self.index.values()
+                      for item in items.values() if self.keys[id(item)] ==
+                      value]
+        else:
+            result = list(items.values()) if items else []
+        # Evaluate the key of the other items, like the loop would.
+        result.extend(item for item in self.others.values()
+                      if self.key(item) == value)
+        return result
+
+
+def _parse(source):
+    return ast.parse(source, mode='eval').body